@@ -0,0 +1,139 @@
+import numpy as np
+from defaults import (ARC_CORNER_STEP, ARC_CORNER_ANGLE, ARC_MIN_POINTS, ARC_MAX_SEGMENTS, ARC_MAX_DISTANCE,
+                      ARC_DUPLICATE_TOLERANCE)
+from ellipse_math import fit_arcs, get_prefix_monomial_sums, get_segment_counts, get_segment_offsets, pack_contours
+from profiling import count, timed
+
+
+def get_cyclic_indices(offsets, counts, set_indices, local_indices):
+    """Переводит номера точек внутри замкнутых наборов (по модулю их длины) в номера в общем буфере"""
+    return offsets[set_indices] + local_indices % counts[set_indices]
+
+
+def find_corners(x, y, offsets, counts):
+    """Находит точки излома всех контуров: угол между направлениями на точки, отстоящие на ARC_CORNER_STEP
+    назад и вперед вдоль контура, больше ARC_CORNER_ANGLE и максимален в окрестности такого же размера.
+    Возвращает номера точек в общем буфере в порядке обхода контуров"""
+    set_indices = np.repeat(np.arange(len(offsets)), counts)
+    local_indices = np.arange(len(x)) - offsets[set_indices]
+
+    previous = get_cyclic_indices(offsets, counts, set_indices, local_indices - ARC_CORNER_STEP)
+    following = get_cyclic_indices(offsets, counts, set_indices, local_indices + ARC_CORNER_STEP)
+    backward_x, backward_y = x - x[previous], y - y[previous]
+    forward_x, forward_y = x[following] - x, y[following] - y
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosines = ((backward_x * forward_x + backward_y * forward_y) /
+                   np.hypot(backward_x, backward_y) / np.hypot(forward_x, forward_y))
+    angles = np.degrees(np.arccos(np.clip(np.nan_to_num(cosines, nan=1.0), -1.0, 1.0)))
+
+    # Из нескольких равных соседних углов точкой излома считается первый
+    is_corner = angles > ARC_CORNER_ANGLE
+    for shift in range(1, ARC_CORNER_STEP + 1):
+        is_corner &= angles >= angles[get_cyclic_indices(offsets, counts, set_indices, local_indices + shift)]
+        is_corner &= angles > angles[get_cyclic_indices(offsets, counts, set_indices, local_indices - shift)]
+
+    return np.flatnonzero(is_corner)
+
+
+def get_candidate_arcs(corners, set_indices, offsets, counts):
+    """Составляет дуги-кандидаты: от каждой точки излома до каждой из ARC_MAX_SEGMENTS следующих (по кругу).
+    Возвращает номера контуров, номера начальных точек излома внутри контуров, число охваченных участков,
+    начала и концы дуг"""
+    corner_counts = np.bincount(set_indices, minlength=len(offsets))
+    first_corners = get_segment_offsets(corner_counts)
+    local_corners = corners - offsets[set_indices]
+    corner_numbers = np.arange(len(corners)) - first_corners[set_indices]
+
+    arcs = []
+    for length in range(1, ARC_MAX_SEGMENTS + 1):
+        selected = np.flatnonzero(length <= corner_counts[set_indices])
+        sets = set_indices[selected]
+        end_numbers = corner_numbers[selected] + length
+        end_corners = first_corners[sets] + end_numbers % corner_counts[sets]
+        ends = local_corners[end_corners] + counts[sets] * (end_numbers // corner_counts[sets])
+        arcs.append((sets, corner_numbers[selected], np.full(len(selected), length), local_corners[selected],
+                     ends))
+
+    return [np.concatenate(column) for column in zip(*arcs)]
+
+
+def is_same_ellipse(first, second):
+    """Проверяет, совпадают ли эллипсы (центр, полуоси) с относительной точностью ARC_DUPLICATE_TOLERANCE"""
+    (first_center, first_axes), (second_center, second_axes) = first, second
+    size = max(max(first_axes), max(second_axes))
+
+    return (np.hypot(*np.subtract(first_center, second_center)) <= ARC_DUPLICATE_TOLERANCE * size and
+            np.all(np.abs(np.sort(first_axes) - np.sort(second_axes)) <= ARC_DUPLICATE_TOLERANCE * size))
+
+
+def select_arcs(arc_indices, corner_count, first_corners, lengths, starts, ends, ellipses):
+    """Выбирает дуги одного контура: сначала самые длинные, без общих участков с уже выбранными и без повторов
+    уже найденных эллипсов (контур незамкнутой линии обходит ее дважды, туда и обратно)"""
+    selected = []
+    used_segments = set()
+    for k in sorted(arc_indices, key=lambda k: ends[k] - starts[k], reverse=True):
+        segments = {(first_corners[k] + i) % corner_count for i in range(lengths[k])}
+        if segments & used_segments:
+            continue
+        if any(is_same_ellipse(ellipses[k], ellipses[other]) for other in selected):
+            continue
+
+        selected.append(k)
+        used_segments |= segments
+
+    return selected
+
+
+@timed('segment_contours')
+def segment_contours(contours):
+    """Разбивает контуры, сливающие несколько эллиптических дуг (перекрывающиеся или соприкасающиеся объекты),
+    на дуги, каждая из которых хорошо аппроксимируется одним эллипсом. Контуры разрезаются в точках излома, а
+    соседние участки объединяются в дуги-кандидаты не более чем по ARC_MAX_SEGMENTS. Все кандидаты
+    аппроксимируются разом по накопленным суммам одночленов, так что аппроксимация дуги не зависит от ее
+    длины, а число кандидатов линейно по числу точек излома. Контуры без изломов и контуры, для которых не
+    нашлось подходящих дуг, возвращаются целиком"""
+    candidates = [i for i, contour in enumerate(contours) if len(contour) >= 2 * ARC_MIN_POINTS]
+    if not candidates:
+        return list(contours)
+
+    points = [contours[i].reshape(-1, 2) for i in candidates]
+    x, y, offsets = pack_contours(points)
+    counts = get_segment_counts(offsets, len(x))
+
+    corners = find_corners(x, y, offsets, counts)
+    if len(corners) == 0:
+        return list(contours)
+
+    corner_sets = np.searchsorted(offsets, corners, side='right') - 1
+    sets, first_corners, lengths, starts, ends = get_candidate_arcs(corners, corner_sets, offsets, counts)
+
+    prefix_sums, means, scales = get_prefix_monomial_sums(x, y, offsets)
+    _, centers, axes, _, valid, distances = fit_arcs(prefix_sums, offsets, counts, means, scales, sets, starts,
+                                                     ends)
+    valid &= (distances <= ARC_MAX_DISTANCE) & (ends - starts >= ARC_MIN_POINTS)
+
+    corner_counts = np.bincount(corner_sets, minlength=len(offsets))
+    ellipses = list(zip(centers.tolist(), axes.tolist()))
+
+    arcs_by_set = {}
+    for k in np.flatnonzero(valid).tolist():
+        arcs_by_set.setdefault(int(sets[k]), []).append(k)
+
+    segmented = {}
+    for set_index, arc_indices in arcs_by_set.items():
+        contour_points = points[set_index]
+        segmented[candidates[set_index]] = [
+            np.take(contour_points, np.arange(starts[k], ends[k]), axis=0, mode='wrap').reshape(-1, 1, 2)
+            for k in select_arcs(arc_indices, corner_counts[set_index], first_corners, lengths, starts, ends,
+                                 ellipses)
+        ]
+
+    result = []
+    for i, contour in enumerate(contours):
+        result.extend(segmented.get(i, [contour]))
+
+    count('segmented_contours', len(segmented))
+    count('contour_arcs', sum(len(arcs) for arcs in segmented.values()))
+
+    return result
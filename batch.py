@@ -0,0 +1,209 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from defaults import FIT_MAX_POINTS, FIT_WORKERS
+from ellipse_detector import EllipseDetector
+from ellipse_results import EllipseResults
+from image_preprocessing import has_filters_before_gray
+from parameter_store import ParameterStore, load_parameters
+from profiling import PROFILE_MODES
+from utils import is_valid_image_extension, save_image
+
+ELLIPSE_FIELDS = ['center_x', 'center_y', 'axis_a', 'axis_b', 'angle', 'ellipse_area', 'contour_area']
+
+
+def get_output_name(path):
+    """Имя, под которым сохраняются результаты обработки изображения (без расширения)"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def collect_image_paths(source):
+    """Возвращает отсортированный список изображений из каталога или по шаблону пути. Результаты сохраняются по
+    имени файла без расширения, поэтому, если у нескольких изображений оно совпадает (например, a.jpg и a.png),
+    выбрасывается ValueError"""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+
+    paths = sorted(path for path in paths if os.path.isfile(path) and is_valid_image_extension(path))
+
+    paths_by_name = {}
+    for path in paths:
+        paths_by_name.setdefault(get_output_name(path), []).append(path)
+    collisions = [same_name for same_name in paths_by_name.values() if len(same_name) > 1]
+    if collisions:
+        raise ValueError('Несколько изображений с одинаковым именем без расширения: ' +
+                         '; '.join(', '.join(same_name) for same_name in collisions))
+
+    return paths
+
+
+def get_ellipse_records(ellipses):
+    """Возвращает параметры эллипсов в виде списка словарей из чисел"""
+    return [{
+        'center_x': ellipse['center'][0],
+        'center_y': ellipse['center'][1],
+        'axis_a': ellipse['axes'][0],
+        'axis_b': ellipse['axes'][1],
+        'angle': ellipse['angle'],
+        'ellipse_area': float(ellipse['ellipse_area']),
+        'contour_area': float(ellipse['contour_area']),
+    } for ellipse in ellipses]
+
+
+def write_ellipse_table(ellipses, path, table_format):
+    """Сохраняет таблицу эллипсов в формате JSON или CSV, а в форматах npz и npy - вместе с точками контуров
+    (npy - каталог файлов, которые можно загрузить отображением в память)"""
+    if table_format == 'npz':
+        EllipseResults.from_ellipses(ellipses).save(path)
+    elif table_format == 'npy':
+        EllipseResults.from_ellipses(ellipses).save_arrays(os.path.splitext(path)[0])
+    elif table_format == 'csv':
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=ELLIPSE_FIELDS)
+            writer.writeheader()
+            writer.writerows(get_ellipse_records(ellipses))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(get_ellipse_records(ellipses), f, ensure_ascii=False, indent=2)
+
+
+def write_run_report(report, path):
+    """Сохраняет замеры запуска и профиль в текстовый файл"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(report.format_status() + '\n\n')
+        for name, seconds in sorted(report.timers.items()):
+            f.write(f"{name}: {seconds * 1000:.2f} мс\n")
+        for name, value in sorted(report.counters.items()):
+            f.write(f"{name}: {value}\n")
+        if report.profile:
+            f.write('\n' + report.profile)
+
+
+def process_image(path, parameters, output_dir, table_format, annotate, full_resolution=False, profile_mode=None,
+                  fit_max_points=FIT_MAX_POINTS, fit_workers=FIT_WORKERS):
+    """Обрабатывает одно изображение и сохраняет результаты, возвращает сводку по нему"""
+    start_time = time.perf_counter()
+    name = get_output_name(path)
+
+    # Цвет нужен только фильтрам до преобразования в оттенки серого и для отрисовки результатов
+    grayscale = not annotate and not has_filters_before_gray(parameters)
+    detector = EllipseDetector(path, ParameterStore(parameters), full_resolution, grayscale, fit_max_points,
+                               fit_workers)
+    if detector.image is None:
+        return {'path': path, 'ellipses': 0, 'seconds': time.perf_counter() - start_time,
+                'error': 'Не удалось загрузить изображение'}
+
+    detector.request_profile(profile_mode)
+    try:
+        results = detector.find_ellipses()
+    finally:
+        detector.close()
+    if profile_mode:
+        write_run_report(detector.last_report, os.path.join(output_dir, f"{name}_profile.txt"))
+
+    write_ellipse_table(results['ellipses'], os.path.join(output_dir, f"{name}.{table_format}"), table_format)
+
+    error_message = ''
+    if annotate:
+        result_image = detector.draw_results(detector.image, results['ellipses'], results['contours'])
+        error_message = save_image(result_image, os.path.join(output_dir, f"{name}_result.png"))
+
+    return {'path': path, 'ellipses': len(results['ellipses']), 'seconds': time.perf_counter() - start_time,
+            'error': error_message}
+
+
+def run_batch(paths, parameters, output_dir, workers=1, table_format='json', annotate=False,
+              full_resolution=False, profile_mode=None, fit_max_points=FIT_MAX_POINTS, fit_workers=FIT_WORKERS):
+    """Обрабатывает изображения в пуле процессов и возвращает список сводок в порядке завершения"""
+    os.makedirs(output_dir, exist_ok=True)
+
+    if workers <= 1:
+        return [process_image(path, parameters, output_dir, table_format, annotate, full_resolution, profile_mode,
+                              fit_max_points, fit_workers)
+                for path in paths]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_image, path, parameters, output_dir, table_format, annotate,
+                                   full_resolution, profile_mode, fit_max_points, fit_workers)
+                   for path in paths]
+
+        return [future.result() for future in as_completed(futures)]
+
+
+def print_summary(summaries, elapsed):
+    """Выводит ошибки обработки и общую пропускную способность"""
+    for summary in summaries:
+        if summary['error']:
+            print(f"{summary['path']}: {summary['error']}", file=sys.stderr)
+
+    processed = len(summaries)
+    total_ellipses = sum(summary['ellipses'] for summary in summaries)
+    mean_time = sum(summary['seconds'] for summary in summaries) / processed if processed else 0.0
+    throughput = processed / elapsed if elapsed > 0 else 0.0
+
+    print(f"Изображений: {processed}, эллипсов: {total_ellipses}")
+    print(f"Время: {elapsed:.2f} с, {throughput:.2f} изобр./с, "
+          f"в среднем {mean_time * 1000:.1f} мс на изображение")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Пакетный поиск эллипсов на изображениях без графического '
+                                                 'интерфейса')
+    parser.add_argument('source', help='каталог с изображениями или шаблон пути (например, "images/*.png")')
+    parser.add_argument('-o', '--output', default='results', help='каталог для результатов')
+    parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='количество процессов')
+    parser.add_argument('-f', '--format', choices=['json', 'csv', 'npz', 'npy'], default='json',
+                        help='формат таблиц эллипсов (npz и npy - с точками контуров)')
+    parser.add_argument('-a', '--annotate', action='store_true',
+                        help='сохранять изображения с найденными эллипсами')
+    parser.add_argument('-r', '--full-resolution', action='store_true',
+                        help='обрабатывать изображения без уменьшения (по фрагментам)')
+    parser.add_argument('--profile', choices=PROFILE_MODES,
+                        help='сохранять для каждого изображения замеры и профиль вызовов или выделения памяти')
+    parser.add_argument('--fit-points', type=int, default=FIT_MAX_POINTS,
+                        help='прореживать контуры до этого числа точек перед аппроксимацией (0 - без прореживания)')
+    parser.add_argument('--fit-workers', type=int, default=FIT_WORKERS,
+                        help='количество процессов для аппроксимации контуров одного изображения '
+                             '(0 - по числу ядер)')
+
+    args = parser.parse_args(argv)
+    if 0 < args.fit_points < 5:
+        parser.error('для аппроксимации эллипсом нужно не меньше 5 точек')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    parameters = ParameterStore(load_parameters(args.params) if args.params else None).get_all()
+
+    try:
+        paths = collect_image_paths(args.source)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if not paths:
+        print('Изображения не найдены', file=sys.stderr)
+        return 1
+
+    start_time = time.perf_counter()
+    summaries = run_batch(paths, parameters, args.output, args.workers, args.format, args.annotate,
+                          args.full_resolution, args.profile, args.fit_points, args.fit_workers)
+    print_summary(summaries, time.perf_counter() - start_time)
+
+    return 0 if all(not summary['error'] for summary in summaries) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,2 @@
+"""Замеры скорости этапов поиска эллипсов и качества поиска на синтетических изображениях с известными
+эллипсами. Запуск: python -m benchmarks run / python -m benchmarks compare"""
@@ -0,0 +1,180 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import cv2
+import numpy as np
+from benchmarks.scenes import SCENES, generate_frames, generate_scene
+from benchmarks.stages import benchmark_scene, benchmark_stream
+from parameter_store import ParameterStore, load_parameters
+
+DEFAULT_SLOWDOWN_THRESHOLD = 0.2
+# Этапы быстрее этого времени (в миллисекундах) не сравниваются: их замеры слишком шумные
+DEFAULT_MIN_STAGE_TIME = 0.5
+DEFAULT_QUALITY_TOLERANCE = 0.005
+QUALITY_METRICS = ['recall', 'precision', 'f1']
+DEFAULT_STREAM_FRAMES = 30
+# Смещение эллипсов за кадр (в пикселях) в проверке потоковой обработки
+DEFAULT_STREAM_STEP = (0.1, 0.05)
+
+
+def run_benchmarks(scene_names, seed, repeat, parameters):
+    """Выполняет замеры на стандартных сценах и возвращает результаты в виде словаря для JSON"""
+    results = {
+        'meta': {
+            'seed': seed,
+            'repeat': repeat,
+            'parameters': parameters,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'scenes': {},
+    }
+
+    for name in scene_names:
+        image, truth = generate_scene(seed, **SCENES[name])
+        results['scenes'][name] = benchmark_scene(image, truth, parameters, repeat)
+
+    return results
+
+
+def run_stream_check(scene_names, seed, frame_count, step, parameters):
+    """Сравнивает потоковую обработку кадров движущихся сцен с начальным приближением и без него и возвращает
+    результаты по сценам"""
+    results = {}
+    for name in scene_names:
+        frames, truths = generate_frames(seed, frame_count, step, **SCENES[name])
+        results[name] = benchmark_stream(frames, truths, parameters)
+
+    return results
+
+
+def print_stream_results(results):
+    for name, scene in results.items():
+        print(f"{name}: кадров {scene['frames']}, без повторной аппроксимации "
+              f"{scene['seeded']['seeded_share'] * 100:.1f}% контуров, "
+              f"{scene['seeded']['time_ms']:.1f} мс (без приближения {scene['unseeded']['time_ms']:.1f} мс), "
+              f"F1 {scene['seeded']['f1']:.3f} (без приближения {scene['unseeded']['f1']:.3f})")
+        if scene['mismatched_frames']:
+            print(f"  эллипсы отличаются на кадрах: {', '.join(map(str, scene['mismatched_frames']))}")
+
+
+def print_results(results):
+    for name, scene in results['scenes'].items():
+        quality = scene['quality']
+        print(f"{name}: контуров {scene['contours']}, эллипсов {scene['fitted_ellipses']}, "
+              f"полнота {quality['recall']:.3f}, точность {quality['precision']:.3f}, F1 {quality['f1']:.3f}")
+        for stage, timing in scene['stages'].items():
+            print(f"  {stage:<34} {timing['median_ms']:10.2f} мс (мин. {timing['min_ms']:.2f})")
+        for fill_contours, show_ellipses in scene['render_mismatches']:
+            print(f"  отрисовка отличается от прямой (fill_contours={fill_contours}, show_ellipses={show_ellipses})")
+
+
+def compare_results(baseline, current, slowdown_threshold, min_stage_time, quality_tolerance):
+    """Сравнивает результаты с базовыми и возвращает список найденных замедлений и изменений качества"""
+    problems = []
+    for name, scene in current['scenes'].items():
+        baseline_scene = baseline['scenes'].get(name)
+        if baseline_scene is None:
+            continue
+
+        for stage, timing in scene['stages'].items():
+            baseline_timing = baseline_scene['stages'].get(stage)
+            if baseline_timing is None or max(baseline_timing['median_ms'], timing['median_ms']) < min_stage_time:
+                continue
+
+            ratio = timing['median_ms'] / baseline_timing['median_ms']
+            if ratio > 1 + slowdown_threshold:
+                problems.append(f"{name}/{stage}: медленнее в {ratio:.2f} раза "
+                                f"({baseline_timing['median_ms']:.2f} -> {timing['median_ms']:.2f} мс)")
+
+        for metric in QUALITY_METRICS:
+            difference = scene['quality'][metric] - baseline_scene['quality'][metric]
+            if abs(difference) > quality_tolerance:
+                problems.append(f"{name}/{metric}: изменилась на {difference:+.3f} "
+                                f"({baseline_scene['quality'][metric]:.3f} -> {scene['quality'][metric]:.3f})")
+
+    return problems
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description='Замеры скорости и качества поиска эллипсов на синтетических '
+                                                 'изображениях')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='выполнить замеры')
+    run_parser.add_argument('-o', '--output', help='JSON-файл для результатов')
+    run_parser.add_argument('-s', '--scenes', nargs='+', choices=list(SCENES), default=list(SCENES),
+                            help='сцены для замеров')
+    run_parser.add_argument('--seed', type=int, default=0, help='начальное значение генератора сцен')
+    run_parser.add_argument('-r', '--repeat', type=int, default=5, help='количество повторов каждого этапа')
+    run_parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров')
+
+    stream_parser = subparsers.add_parser('stream', help='сравнить потоковую обработку с начальным приближением '
+                                                         'по предыдущему кадру и без него')
+    stream_parser.add_argument('-s', '--scenes', nargs='+', choices=list(SCENES), default=['small', 'medium'],
+                               help='сцены для проверки')
+    stream_parser.add_argument('--seed', type=int, default=0, help='начальное значение генератора сцен')
+    stream_parser.add_argument('-n', '--frames', type=int, default=DEFAULT_STREAM_FRAMES, help='количество кадров')
+    stream_parser.add_argument('--step', type=float, nargs=2, default=DEFAULT_STREAM_STEP,
+                               help='смещение эллипсов за кадр по x и y (в пикселях)')
+    stream_parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров')
+
+    compare_parser = subparsers.add_parser('compare', help='сравнить результаты с базовыми')
+    compare_parser.add_argument('baseline', help='JSON-файл с базовыми результатами')
+    compare_parser.add_argument('current', help='JSON-файл с новыми результатами')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_SLOWDOWN_THRESHOLD,
+                                help='допустимое относительное замедление этапа')
+    compare_parser.add_argument('--min-time', type=float, default=DEFAULT_MIN_STAGE_TIME,
+                                help='этапы быстрее этого времени (в мс) не сравниваются')
+    compare_parser.add_argument('--quality-tolerance', type=float, default=DEFAULT_QUALITY_TOLERANCE,
+                                help='допустимое изменение полноты, точности и F1-меры')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == 'run':
+        parameters = ParameterStore(load_parameters(args.params) if args.params else None).get_all()
+        results = run_benchmarks(args.scenes, args.seed, args.repeat, parameters)
+        print_results(results)
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+
+        return 1 if any(scene['render_mismatches'] for scene in results['scenes'].values()) else 0
+
+    if args.command == 'stream':
+        parameters = ParameterStore(load_parameters(args.params) if args.params else None).get_all()
+        results = run_stream_check(args.scenes, args.seed, args.frames, args.step, parameters)
+        print_stream_results(results)
+
+        return 1 if any(scene['mismatched_frames'] for scene in results.values()) else 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)
+
+    if baseline['meta'].get('seed') != current['meta'].get('seed'):
+        print('Результаты получены на разных сценах (seed), качество несравнимо', file=sys.stderr)
+
+    problems = compare_results(baseline, current, args.threshold, args.min_time, args.quality_tolerance)
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print('Замедлений и изменений качества нет')
+
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
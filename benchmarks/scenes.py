@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+# Размеры изображений и количество эллипсов в стандартных сценах
+SCENES = {
+    'small': {'width': 640, 'height': 480, 'count': 15},
+    'medium': {'width': 1280, 'height': 960, 'count': 60},
+    'large': {'width': 2560, 'height': 1920, 'count': 240},
+}
+
+BACKGROUND_COLOR = 200
+# Диапазон яркости эллипсов (ниже порога бинаризации по умолчанию) и их полуосей (доля ширины изображения)
+ELLIPSE_BRIGHTNESS = (10, 35)
+AXIS_RANGE = (0.012, 0.05)
+MIN_AXES_RATIO = 0.55
+# Число дробных бит координат при отрисовке эллипсов с субпиксельной точностью
+DRAW_SHIFT = 4
+MAX_PLACEMENT_ATTEMPTS = 200
+
+
+def place_ellipse(rng, width, height, ellipses, at_border):
+    """Выбирает параметры эллипса, не пересекающегося с уже размещенными. Эллипс at_border выходит за границу
+    изображения. Возвращает None, если место найти не удалось"""
+    for _ in range(MAX_PLACEMENT_ATTEMPTS):
+        a = rng.uniform(*AXIS_RANGE) * width
+        b = a * rng.uniform(MIN_AXES_RATIO, 1.0)
+        if at_border:
+            side = rng.integers(4)
+            offset = rng.uniform(-0.5, 0.5) * b
+            along_x, along_y = rng.uniform(a, width - a), rng.uniform(a, height - a)
+            cx, cy = [(offset, along_y), (along_x, offset), (width - offset, along_y), (along_x, height - offset)][side]
+        else:
+            cx, cy = rng.uniform(a, width - a), rng.uniform(a, height - a)
+
+        if all(np.hypot(cx - other['center'][0], cy - other['center'][1]) > 1.1 * (a + other['axes'][0])
+               for other in ellipses):
+            return {'center': (cx, cy), 'axes': (a, b), 'angle': rng.uniform(0, 180)}
+
+    return None
+
+
+def add_occlusion(rng, image, ellipse):
+    """Закрывает часть эллипса полосой цвета фона, проходящей через его край"""
+    (cx, cy), (a, _) = ellipse['center'], ellipse['axes']
+    direction = np.deg2rad(rng.uniform(0, 360))
+    distance = a * rng.uniform(0.6, 0.9)
+    px, py = cx + distance * np.cos(direction), cy + distance * np.sin(direction)
+    half_width = a * rng.uniform(0.1, 0.25)
+
+    box = cv2.boxPoints(((px, py), (2 * half_width, 3 * a), np.rad2deg(direction)))
+    cv2.fillConvexPoly(image, box.astype(np.int32), (BACKGROUND_COLOR,) * 3)
+
+
+def generate_scene(seed, width, height, count, noise=8.0, occlusion=0.2, border=0.1, shift=(0.0, 0.0)):
+    """Генерирует изображение с count темными эллипсами на светлом фоне и возвращает его вместе со списком
+    эллипсов (словари с ключами center, axes, angle, border, occluded). Доля border эллипсов обрезана границей
+    изображения, доля occlusion частично закрыта, к изображению добавляется гауссов шум с СКО noise. Все эллипсы
+    и закрывающие их полосы сдвигаются на shift пикселей, так что сцены с одним seed и разными shift - кадры
+    движущейся сцены"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), BACKGROUND_COLOR, dtype=np.uint8)
+    scale = 1 << DRAW_SHIFT
+
+    ellipses = []
+    for k in range(count):
+        at_border = k < round(count * border)
+        ellipse = place_ellipse(rng, width, height, ellipses, at_border)
+        if ellipse is None:
+            continue
+
+        ellipse['center'] = (ellipse['center'][0] + shift[0], ellipse['center'][1] + shift[1])
+        ellipse['border'] = at_border
+        ellipse['occluded'] = False
+        ellipses.append(ellipse)
+
+        (cx, cy), (a, b) = ellipse['center'], ellipse['axes']
+        brightness = int(rng.integers(*ELLIPSE_BRIGHTNESS))
+        cv2.ellipse(image, (round(cx * scale), round(cy * scale)), (round(a * scale), round(b * scale)),
+                    ellipse['angle'], 0, 360, (brightness,) * 3, -1, cv2.LINE_AA, DRAW_SHIFT)
+
+    for ellipse in ellipses:
+        if not ellipse['border'] and rng.random() < occlusion:
+            add_occlusion(rng, image, ellipse)
+            ellipse['occluded'] = True
+
+    if noise > 0:
+        noisy_image = image + rng.normal(0, noise, image.shape)
+        image = np.clip(noisy_image, 0, 255).astype(np.uint8)
+
+    return image, ellipses
+
+
+def generate_frames(seed, frame_count, step, **scene):
+    """Генерирует кадры сцены, эллипсы которой смещаются на step = (dx, dy) пикселей за кадр. Возвращает списки
+    изображений и известных эллипсов каждого кадра"""
+    frames = [generate_scene(seed, shift=(k * step[0], k * step[1]), **scene) for k in range(frame_count)]
+
+    return [image for image, _ in frames], [truth for _, truth in frames]
@@ -0,0 +1,167 @@
+import statistics
+import time
+import cv2
+import numpy as np
+from defaults import (CONTOUR_COLOR, CONTOUR_THICKNESS, ELLIPSE_COLOR, ELLIPSE_END_ANGLE, ELLIPSE_START_ANGLE,
+                      ELLIPSE_THICKNESS, FILL_ALL_CONTOURS, FILL_COLOR)
+from ellipse_detector import EllipseDetector, calculate_ellipse_errors
+from ellipse_math import calculate_contour_area, calculate_ellipse_area_in_bounds, pack_contours
+from ellipse_table import EllipseTable
+from evaluation import evaluate_detection, match_ellipses
+from image_preprocessing import ImagePreprocessor
+from parameter_store import ParameterStore
+from rendering import ResultRenderer
+from stream import detect_frames
+from utils import find_contours
+
+ERROR_METHODS = ['algebraic', 'geometric', 'geometric_simple']
+
+
+def time_call(function, repeat):
+    """Вызывает функцию repeat раз и возвращает результат последнего вызова и время вызовов в миллисекундах"""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = function()
+        times.append((time.perf_counter() - start_time) * 1000)
+
+    return result, {'min_ms': min(times), 'median_ms': statistics.median(times)}
+
+
+def get_max_error(store):
+    return store.get_value('error_factor') / (10 ** int(store.get_value('error_exponent')))
+
+
+def draw_results_directly(image, ellipses, contours, closed_contours, fill_contours, show_ellipses):
+    """Отрисовка результатов прямыми вызовами OpenCV без кэшей слоев, с которой сравнивается ResultRenderer"""
+    result_image = image.copy()
+    if fill_contours and ellipses:
+        cv2.drawContours(result_image, closed_contours, -1, FILL_COLOR, FILL_ALL_CONTOURS)
+
+    cv2.drawContours(result_image, contours, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
+    if show_ellipses and ellipses:
+        for ellipse in ellipses:
+            center, axes = ellipse['center'], ellipse['axes']
+            cv2.ellipse(result_image, (int(center[0]), int(center[1])), (int(axes[0]), int(axes[1])),
+                        ellipse['angle'], ELLIPSE_START_ANGLE, ELLIPSE_END_ANGLE, ELLIPSE_COLOR, ELLIPSE_THICKNESS)
+
+    return result_image
+
+
+def check_rendering(detector, image, ellipses, contours):
+    """Сравнивает изображения ResultRenderer с прямой отрисовкой при всех сочетаниях заливки и отображения
+    эллипсов и возвращает сочетания (fill_contours, show_ellipses), при которых они отличаются"""
+    closed_contours = [detector.get_closed_contour(ellipse) for ellipse in ellipses]
+    mismatched = []
+    for fill_contours in (False, True):
+        for show_ellipses in (False, True):
+            rendered = detector.renderer.render(image, ellipses, contours, fill_contours, show_ellipses,
+                                                detector.get_closed_contour)
+            expected = draw_results_directly(image, ellipses, contours, closed_contours, fill_contours,
+                                             show_ellipses)
+            if not np.array_equal(rendered, expected):
+                mismatched.append([fill_contours, show_ellipses])
+
+    return mismatched
+
+
+def benchmark_scene(image, truth, parameters, repeat):
+    """Замеряет время каждого этапа поиска эллипсов по отдельности и качество поиска на одном изображении.
+    Каждый этап выполняется без кэшей, на результатах предыдущего этапа"""
+    store = ParameterStore(parameters)
+    stages = {}
+
+    (_, edges), stages['preprocess_image'] = time_call(
+        lambda: ImagePreprocessor(store).preprocess_image(image), repeat)
+    contours, stages['find_contours'] = time_call(
+        lambda: find_contours(edges, store.get_value('contour_method')), repeat)
+
+    detector = EllipseDetector(None, store)
+    detector.set_image(image)
+    fits, stages['fit_contours'] = time_call(lambda: detector.fit_contours(contours), repeat)
+    ellipses = [fit for fit in fits if fit is not None]
+
+    coordinates = pack_contours([ellipse['contour'] for ellipse in ellipses], detector.fit_max_points)
+    errors = {}
+    for error_method in ERROR_METHODS:
+        errors[error_method], stages[f"calculate_errors_{error_method}"] = time_call(
+            lambda: calculate_ellipse_errors(ellipses, coordinates, error_method), repeat)
+
+    height, width = image.shape[:2]
+    areas_in_bounds, stages['area_in_bounds'] = time_call(
+        lambda: [calculate_ellipse_area_in_bounds(ellipse['center'], ellipse['axes'], ellipse['angle'],
+                                                  (height, width))
+                 for ellipse in ellipses], repeat)
+    contour_areas, stages['contour_area'] = time_call(
+        lambda: [calculate_contour_area(ellipse['contour'], (height, width)) for ellipse in ellipses], repeat)
+
+    # Фильтрация по таблице эллипсов (заменила проверку каждого эллипса в is_ellipse_valid)
+    def filter_ellipses():
+        table = EllipseTable(ellipses)
+        indices = np.arange(len(ellipses))
+        error_method = store.get_value('error_method')
+        table.set_errors(error_method, indices, errors[error_method])
+        table.set_areas(indices, contour_areas, areas_in_bounds)
+
+        return table.get_valid_indices(error_method, get_max_error(store), store.get_value('min_area'),
+                                       store.get_value('max_aspect_ratio'), store.get_value('area_error'))
+
+    valid_indices, stages['filter_ellipses'] = time_call(filter_ellipses, repeat)
+    valid_ellipses = [ellipses[i] for i in valid_indices]
+
+    # Отрисовка без кэшей слоев: новый отрисовщик и копии эллипсов без сохраненных пикселей и замкнутых контуров
+    def draw_results():
+        detector.renderer = ResultRenderer()
+        return detector.draw_results(image, [dict(ellipse) for ellipse in valid_ellipses], contours)
+
+    _, stages['draw_results'] = time_call(draw_results, repeat)
+    render_mismatches = check_rendering(detector, image, valid_ellipses, contours)
+
+    def find_ellipses():
+        total_detector = EllipseDetector(None, ParameterStore(parameters))
+        total_detector.set_image(image)
+        return total_detector.find_ellipses()
+
+    results, stages['find_ellipses'] = time_call(find_ellipses, repeat)
+
+    return {
+        'stages': stages,
+        'contours': len(contours),
+        'fitted_ellipses': len(ellipses),
+        'quality': evaluate_detection(results['ellipses'], truth),
+        'render_mismatches': render_mismatches,
+    }
+
+
+def benchmark_stream(frames, truths, parameters):
+    """Обрабатывает кадры с эллипсами предыдущего кадра в качестве начального приближения и без них и сравнивает
+    результаты: на каждом кадре найденные эллипсы должны совпадать один к одному (в пределах допусков оценки
+    качества). Возвращает номера несовпавших кадров, долю контуров без повторной аппроксимации, время и качество
+    обоих вариантов"""
+    results = {}
+    for mode, seed in [('seeded', True), ('unseeded', False)]:
+        start_time = time.perf_counter()
+        frame_ellipses, seed_statistics = [], {}
+        for _, _, detector, frame_results in detect_frames(frames, parameters, seed):
+            frame_ellipses.append(frame_results['ellipses'])
+            seed_statistics = dict(detector.seed_statistics)
+
+        checked = seed_statistics['seeded'] + seed_statistics['fitted']
+        quality = [evaluate_detection(ellipses, truth) for ellipses, truth in zip(frame_ellipses, truths)]
+        results[mode] = {
+            'ellipses': frame_ellipses,
+            'time_ms': (time.perf_counter() - start_time) * 1000,
+            'seeded_share': seed_statistics['seeded'] / checked if checked else 0.0,
+            'f1': statistics.mean(item['f1'] for item in quality) if quality else 0.0,
+        }
+
+    mismatched = [k for k, (seeded, unseeded) in enumerate(zip(results['seeded']['ellipses'],
+                                                                results['unseeded']['ellipses']))
+                  if not len(seeded) == len(unseeded) == len(match_ellipses(seeded, unseeded))]
+
+    return {
+        'mismatched_frames': mismatched,
+        'frames': len(frames),
+        **{mode: {key: value for key, value in result.items() if key != 'ellipses'}
+           for mode, result in results.items()},
+    }
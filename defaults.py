@@ -10,12 +10,22 @@ CONTOUR_THICKNESS = 1
 # Математические параметры
 NEWTON_ACCURACY = 1e-5
 NEWTON_MAX_ITERATIONS = 20
+BISECTION_MAX_ITERATIONS = 150
+# Метод вычисления расстояния до эллипса: 'newton', 'newton_exact' (Ньютон с пересчетом ненадежных точек
+# методом Эберли) или 'exact'
+GEOMETRIC_DISTANCE_SOLVER = 'newton_exact'
 EIGENVALUE_THRESHOLD = 1e-10
-DETERMINANT_MIN_ERROR = 1e-3
+# Минимальный определитель матрицы моментов нормированных координат контура
+NORMALIZED_DETERMINANT_MIN_ERROR = 1e-8
 GEOMETRIC_ERROR_SCALE_MULTIPLIER = 0.01
 
 # Размер изображений
 RESIZE_WIDTH = 600
+# Декодировать JPEG сразу с уменьшением в 2, 4 или 8 раз, если изображение все равно будет уменьшено до RESIZE_WIDTH
+REDUCED_DECODE = True
+
+# Период опроса результатов фоновой обработки, мс
+DETECTION_POLL_INTERVAL = 30
 
 # Размеры окна настроек
 MIN_WINDOW_WIDTH = 640
@@ -29,6 +39,113 @@ CANNY_HIGH_THRESHOLD = 150
 MAX_THRESHOLD = 255
 MAX_CONTOUR_AREA_RATIO = 0.8
 MIN_KERNEL_SIZE = 1
+# Максимальное число промежуточных изображений в кэше предобработки
+PREPROCESSING_CACHE_SIZE = 24
+# Максимальное число контуров в кэше аппроксимаций
+FIT_CACHE_SIZE = 20000
+# Число точек, до которого прореживаются длинные контуры перед аппроксимацией и вычислением ошибок
+# (0 - без прореживания)
+FIT_MAX_POINTS = 0
+
+# Для аппроксимации и вычисления ошибок в пуле процессов
+# Число процессов (1 - в текущем процессе, 0 - по числу ядер)
+FIT_WORKERS = 1
+# Примерное число точек в порции контуров, передаваемой одному процессу
+FIT_CHUNK_POINTS = 200000
+# Наборы с меньшим числом точек обрабатываются в текущем процессе
+FIT_PARALLEL_MIN_POINTS = 400000
+
+# Для разбиения контуров на эллиптические дуги
+# Шаг вдоль контура (в точках), на котором измеряется угол излома
+ARC_CORNER_STEP = 5
+# Минимальный угол излома (в градусах), в котором контур разрезается
+ARC_CORNER_ANGLE = 50.0
+# Минимальное число точек дуги (контуры короче двух дуг не разбиваются)
+ARC_MIN_POINTS = 20
+# Максимальное число участков между изломами, объединяемых в одну дугу
+ARC_MAX_SEGMENTS = 6
+# Максимальное среднеквадратичное расстояние от точек дуги до эллипса (в пикселях)
+ARC_MAX_DISTANCE = 1.5
+# Относительная точность, с которой эллипсы дуг одного контура считаются совпадающими
+ARC_DUPLICATE_TOLERANCE = 0.05
+
+# Для обработки изображений без уменьшения по фрагментам
+# Сторона фрагмента (в пикселях)
+TILE_SIZE = 2048
+# Перекрытие фрагментов сверх радиусов фильтров: целые контуры в этой полосе берутся из фрагмента сразу
+TILE_OVERLAP = 64
+# Количество потоков (0 - по числу ядер)
+TILE_WORKERS = 0
+# Максимальная сторона окна, в котором заново ищется контур, обрезанный на стыке фрагментов
+SEAM_WINDOW_MAX_SIZE = 8192
+# Сторона ячейки сетки, по которой ищутся объемлющие контуры при выборе внешних контуров
+EXTERNAL_GRID_CELL_SIZE = 256
+
+# Для потоковой обработки видео и последовательностей изображений
+# Максимальное число декодированных кадров, ожидающих обработки
+STREAM_PREFETCH_SIZE = 8
+# Период вывода скорости обработки (в секундах)
+STREAM_REPORT_INTERVAL = 2.0
+# Максимальное расстояние от центра точек контура до центра эллипса предыдущего кадра (в пикселях)
+SEED_SEARCH_RADIUS = 8.0
+# Допустимый рост алгебраической ошибки эллипса предыдущего кадра на новом контуре
+SEED_ERROR_RATIO = 1.5
+
+# Для сервиса поиска эллипсов
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# Число процессов (0 - по числу ядер)
+SERVICE_WORKERS = 0
+# Число заданий, ожидающих свободного процесса, сверх которого запросы отклоняются
+SERVICE_QUEUE_SIZE = 16
+# Максимальный размер запроса (в байтах)
+SERVICE_MAX_REQUEST_SIZE = 64 * 1024 * 1024
+# Число последних запросов, по которым считается распределение времени ответа
+SERVICE_LATENCY_WINDOW = 1000
+
+# Количество строк профиля (функций или мест выделения памяти) в отчете о запуске
+PROFILE_TOP_ENTRIES = 25
+
+# Для сравнения найденных эллипсов с известными (оценка качества поиска)
+# Допустимое смещение центра: доля большей полуоси, но не меньше MATCH_MIN_CENTER_DISTANCE пикселей
+MATCH_CENTER_TOLERANCE = 0.1
+MATCH_MIN_CENTER_DISTANCE = 2.0
+# Допустимое относительное отличие каждой полуоси
+MATCH_AXES_TOLERANCE = 0.2
+
+# Для подбора параметров
+TUNING_TRIALS = 100
+# Число случайных проб, после которых байесовский поиск начинает использовать результаты предыдущих
+TUNING_STARTUP_TRIALS = 20
+# Доля лучших проб, по которым строится распределение перспективных значений
+TUNING_GAMMA = 0.25
+# Число кандидатов, из которых байесовский поиск выбирает следующую пробу
+TUNING_CANDIDATES = 24
+# Минимальная ширина ядра распределения числовых параметров (доля диапазона)
+TUNING_MIN_BANDWIDTH = 0.05
+# Число лучших наборов параметров, для которых замеряется время работы без кэшей
+TUNING_TOP = 10
+TUNING_TIMING_REPEAT = 3
+# Пространство поиска по умолчанию: список значений или диапазон (не заданные min, max и step берутся из
+# CONFIGURABLE_PARAMS). Диапазоны уже, чем у ползунков, чтобы случайные пробы не тратились на заведомо пустые
+# результаты
+TUNING_SEARCH_SPACE = {
+    'threshold': {'min': 10, 'max': 240, 'step': 5},
+    'aperture_size': [3, 5, 7],
+    'bilateral_enabled': [False, True],
+    'gaussian_blur_enabled': [False, True],
+    'gaussian_kernel_size': {'min': 3, 'max': 11},
+    'median_blur_enabled': [False, True],
+    'median_kernel_size': {'min': 3, 'max': 11},
+    'contour_method': ['external', 'list'],
+    'arc_segmentation': [False, True],
+    'error_exponent': {'min': 1, 'max': 8},
+    'error_factor': {'min': 1, 'max': 9, 'step': 0.5},
+    'min_area': {'min': 0, 'max': 2000},
+    'max_aspect_ratio': {'min': 0, 'max': 5},
+    'area_error': {'min': 0, 'max': 1},
+    'error_method': ['algebraic', 'geometric_simple'],
+}
 
 # Углы для отрисовки эллипсов
 ELLIPSE_START_ANGLE = 0
@@ -111,6 +228,12 @@ CONFIGURABLE_PARAMS = {
         'options': ['external', 'list'],
         'category': 'preprocessing'
     },
+    # Разбиение контуров, сливающих несколько объектов, на эллиптические дуги
+    'arc_segmentation': {
+        'default': False,
+        'type': 'boolean',
+        'category': 'preprocessing'
+    },
     # Предобработка изображения
     'threshold': {
         'default': 50,
@@ -0,0 +1,110 @@
+import queue
+import threading
+from profiling import activate_report
+
+
+class DetectionCancelled(Exception):
+    """Обработка прервана, так как поступил запрос с более новыми параметрами"""
+
+
+class DetectionWorker:
+    """Выполняет поиск эллипсов и отрисовку результата в фоновом потоке. Запросы объединяются: обрабатывается
+    только последний снимок параметров, а обработка устаревшего снимка прерывается на границе этапов"""
+
+    def __init__(self, detector):
+        self.detector = detector
+        self.condition = threading.Condition()
+        self.results = queue.Queue()
+
+        self.generation = 0
+        self.pending_params = None
+        self.pending_categories = set()
+        self.pending_clear_cache = False
+        self.is_running = True
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, params, categories=(), clear_cache=False):
+        """Ставит в очередь обработку с указанными значениями параметров, заменяя еще не начатый запрос.
+        categories - категории измененных параметров, clear_cache - полностью сбросить кэш детектора"""
+        with self.condition:
+            self.generation += 1
+            self.pending_params = params
+            self.pending_categories.update(categories)
+            self.pending_clear_cache = self.pending_clear_cache or clear_cache
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+
+    def check_cancelled(self, generation):
+        """Прерывает обработку, если после ее начала поступил новый запрос"""
+        if not self.is_running or generation != self.generation:
+            raise DetectionCancelled()
+
+    def take_request(self):
+        """Ожидает запрос и забирает его из очереди, возвращает None при остановке"""
+        with self.condition:
+            while self.is_running and self.pending_params is None:
+                self.condition.wait()
+
+            if not self.is_running:
+                return None
+
+            request = (self.generation, self.pending_params, self.pending_categories, self.pending_clear_cache)
+            self.pending_params = None
+            self.pending_categories = set()
+            self.pending_clear_cache = False
+
+            return request
+
+    def run(self):
+        while True:
+            request = self.take_request()
+            if request is None:
+                return
+
+            generation, params, categories, clear_cache = request
+            try:
+                result = self.detect(generation, params, categories, clear_cache)
+            except DetectionCancelled:
+                continue
+            except Exception as e:
+                result = {'error': str(e)}
+
+            result['generation'] = generation
+            self.results.put(result)
+
+    def detect(self, generation, params, categories, clear_cache):
+        detector = self.detector
+        detector.param_manager.update(params)
+
+        if clear_cache:
+            detector.clear_cache()
+        for category in categories:
+            detector.update_cache(category)
+
+        def check_cancelled():
+            self.check_cancelled(generation)
+
+        results = detector.find_ellipses(check_cancelled)
+        check_cancelled()
+
+        with activate_report(detector.last_report):
+            results['result_image'] = detector.draw_results(detector.image, results['ellipses'],
+                                                            results['contours'])
+        results['report'] = detector.last_report
+
+        return results
+
+    def get_latest_result(self):
+        """Возвращает последний готовый результат (более старые отбрасываются) или None"""
+        result = None
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return result
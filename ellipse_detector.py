@@ -1,155 +1,375 @@
+import hashlib
+from arc_segmentation import segment_contours
 from ellipse_math import *
+from ellipse_table import EllipseTable
 from image_preprocessing import ImagePreprocessor
-from utils import load_image, find_contours
+from parallel import ParallelFitter
+from profiling import RunReport, activate_report, count, timed, timer
+from rendering import ResultRenderer
+from tiling import find_contours_tiled
+from utils import LRUCache, load_image, find_contours
 
 
-def close_contours_at_border(contours, image_shape):
-    """Замыкание всех незамкнутых на границе контуров"""
-    if not contours:
-        return []
+def get_contour_key(contour, image_shape, max_points=0):
+    """Возвращает ключ контура в кэше аппроксимаций: хэш его точек, размера изображения и числа точек, до
+    которого прореживается контур"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(contour, dtype=np.int32).tobytes())
+    digest.update(np.array([*image_shape[:2], max_points], dtype=np.int64).tobytes())
 
-    return [close_contour_at_border(contour, image_shape) for contour in contours]
+    return digest.digest()
 
 
-def calculate_ellipse_error(ellipse, error_method):
-    """Вычисление ошибки аппроксимации контура эллипсом с помощью указанного метода"""
-    if error_method == 'geometric':
-        return calculate_error_geometric_newton(ellipse['center'],
-                                                ellipse['axes'],
-                                                ellipse['angle'],
-                                                ellipse['x_coordinates'],
-                                                ellipse['y_coordinates'])
-    elif error_method == 'geometric_simple':
-        return calculate_error_geometric_simple(ellipse['center'],
-                                                ellipse['axes'],
-                                                ellipse['angle'],
-                                                ellipse['x_coordinates'],
-                                                ellipse['y_coordinates'])
-    else:
-        return calculate_error_algebraic(ellipse['coefficients'],
-                                         ellipse['x_coordinates'],
-                                         ellipse['y_coordinates'])
+def calculate_ellipse_errors(ellipses, coordinates, error_method, fitter=None):
+    """Вычисление ошибок аппроксимации контуров эллипсами с помощью указанного метода сразу для всех эллипсов.
+    Если задан fitter (ParallelFitter), большие наборы точек обрабатываются в его пуле процессов"""
+    coefficients = np.array([ellipse['coefficients'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 6)
+    centers = np.array([ellipse['center'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 2)
+    axes = np.array([ellipse['axes'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 2)
+    angles = np.array([ellipse['angle'] for ellipse in ellipses], dtype=np.float64)
+
+    if fitter is not None:
+        return fitter.calculate_errors(error_method, coefficients, centers, axes, angles, *coordinates)
+
+    return calculate_errors(error_method, coefficients, centers, axes, angles, *coordinates)
+
+
+def get_seed_cell(x, y):
+    """Возвращает ячейку сетки поиска эллипсов предыдущего кадра, в которую попадает точка"""
+    return int(np.floor(x / SEED_SEARCH_RADIUS)), int(np.floor(y / SEED_SEARCH_RADIUS))
 
 
 class EllipseDetector:
-    def __init__(self, image_path, param_manager):
-        self.image = load_image(image_path)
+    def __init__(self, image_path, param_manager, full_resolution=False, grayscale=False,
+                 fit_max_points=FIT_MAX_POINTS, fit_workers=FIT_WORKERS):
+        """При full_resolution изображение не уменьшается, а предобработка и поиск контуров выполняются по
+        фрагментам. При grayscale изображение загружается сразу в оттенках серого (если цвет не нужен ни для
+        фильтров, ни для отрисовки результатов). Контуры длиннее fit_max_points точек прореживаются до
+        fit_max_points точек перед аппроксимацией и вычислением ошибок (0 - без прореживания). При fit_workers
+        больше 1 аппроксимация и вычисление ошибок для большого числа контуров выполняются в пуле процессов
+        (0 - по числу ядер)"""
+        self.full_resolution = full_resolution
+        self.fit_max_points = fit_max_points
+        self.image = load_image(image_path, full_resolution, grayscale) if image_path is not None else None
         self.param_manager = param_manager
         self.preprocessor = ImagePreprocessor(self.param_manager)
 
         self.cached_contours = None
         self.cached_ellipses = None
+        self.cached_table = None
         self.cached_contour_params = None
-        self.cached_errors = {
-            'algebraic': None,
-            'geometric': None,
-            'geometric_simple': None
-        }
+        self.fit_cache = LRUCache(FIT_CACHE_SIZE)
+        self.fitter = ParallelFitter(fit_workers)
+        self.renderer = ResultRenderer()
+        self.seed_ellipses = []
+        self.seed_grid = {}
+        self.seed_centroids = []
+        self.seed_statistics = {'seeded': 0, 'fitted': 0}
+        self.last_report = None
+        self.profile_mode = None
+
+    def set_image(self, image):
+        """Заменяет обрабатываемое изображение (например, очередным кадром видео). Кэш аппроксимаций контуров
+        сохраняется"""
+        self.image = image
+        self.clear_cache()
+
+    def close(self):
+        """Останавливает пул процессов, если он был запущен"""
+        self.fitter.close()
+
+    def request_profile(self, profile_mode):
+        """Включает для следующего запуска поиска запись профиля вызовов ('cprofile') или выделения памяти
+        ('tracemalloc') в отчет о запуске"""
+        self.profile_mode = profile_mode
+
+    def set_seed_ellipses(self, ellipses):
+        """Задает эллипсы предыдущего кадра. Контуры рядом с ними сначала проверяются на этих эллипсах и
+        аппроксимируются заново, только если ошибка заметно выросла или эллипс не проходит фильтр по ошибке"""
+        self.seed_ellipses = list(ellipses)
+        self.seed_grid = {}
+
+        missing = [ellipse for ellipse in self.seed_ellipses if 'algebraic' not in ellipse['errors']]
+        if missing:
+            coordinates = pack_contours([ellipse['contour'] for ellipse in missing], self.fit_max_points)
+            for ellipse, error in zip(missing, calculate_ellipse_errors(missing, coordinates, 'algebraic').tolist()):
+                ellipse['errors']['algebraic'] = error
+
+        self.seed_centroids = [decimate_points(ellipse['contour'].reshape(-1, 2), self.fit_max_points).mean(axis=0)
+                               for ellipse in self.seed_ellipses]
+        for i, ellipse in enumerate(self.seed_ellipses):
+            self.seed_grid.setdefault(get_seed_cell(*ellipse['center']), []).append(i)
+
+    def find_seed_ellipse(self, x, y):
+        """Возвращает номер ближайшего к точке эллипса предыдущего кадра в пределах SEED_SEARCH_RADIUS или None"""
+        cell_x, cell_y = get_seed_cell(x, y)
+        best_index = None
+        best_distance = SEED_SEARCH_RADIUS ** 2
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for i in self.seed_grid.get((cell_x + dx, cell_y + dy), ()):
+                    center_x, center_y = self.seed_ellipses[i]['center']
+                    distance = (center_x - x) ** 2 + (center_y - y) ** 2
+                    if distance <= best_distance:
+                        best_index = i
+                        best_distance = distance
+
+        return best_index
+
+    def get_seeded_fits(self, contours):
+        """Пытается аппроксимировать контуры эллипсами предыдущего кадра, сдвинутыми вместе с контурами.
+        Возвращает для каждого контура словарь с параметрами эллипса или None, если подходящего эллипса нет и
+        контур нужно аппроксимировать заново"""
+        fits = [None] * len(contours)
+        if not self.seed_ellipses or not contours:
+            return fits
+
+        matches = []
+        for i, contour in enumerate(contours):
+            # Видимая часть контура, обрезанного границей изображения, меняется при движении вместе с формой
+            # эллипса, поэтому такие контуры всегда аппроксимируются заново
+            if any(get_touched_borders(contour, self.image.shape[:2])[0]):
+                continue
+
+            centroid = decimate_points(contour.reshape(-1, 2), self.fit_max_points).mean(axis=0)
+            seed_index = self.find_seed_ellipse(*centroid)
+            if seed_index is not None:
+                matches.append((i, seed_index, centroid - self.seed_centroids[seed_index]))
+
+        if not matches:
+            return fits
+
+        # Эллипс сдвигается на смещение центра точек контура, поэтому центр найденного эллипса соответствует
+        # текущему кадру, а не предыдущему
+        seeds = [self.seed_ellipses[seed_index] for _, seed_index, _ in matches]
+        shifts = np.array([shift for _, _, shift in matches], dtype=np.float64)
+        coefficients = denormalize_coefficients(np.array([seed['coefficients'] for seed in seeds]), shifts,
+                                                np.ones(len(seeds)))
+        candidates = []
+        for k, seed in enumerate(seeds):
+            center = (seed['center'][0] + float(shifts[k, 0]), seed['center'][1] + float(shifts[k, 1]))
+            candidates.append({
+                'center': center,
+                'axes': seed['axes'],
+                'angle': seed['angle'],
+                'ellipse_area': seed['ellipse_area'],
+                'contour': contours[matches[k][0]],
+                'coefficients': coefficients[k],
+                'errors': {},
+            })
+
+        coordinates = pack_contours([candidate['contour'] for candidate in candidates], self.fit_max_points)
+        errors = calculate_errors_algebraic(coefficients, *coordinates)
+
+        # Эллипс принимается, только если он проходит текущий фильтр по ошибке: иначе эллипс, аппроксимированный
+        # заново, мог бы пройти фильтр, а эллипс предыдущего кадра - нет
+        error_method = self.param_manager.get_value('error_method')
+        filter_errors = errors if error_method == 'algebraic' else calculate_ellipse_errors(
+            candidates, coordinates, error_method, self.fitter)
+        max_error = self.get_max_error()
+
+        for k, candidate in enumerate(candidates):
+            # Порог считается от ошибки на контуре, по которому эллипс был аппроксимирован, а не на последнем
+            # контуре, чтобы ошибка не накапливалась от кадра к кадру
+            fit_error = seeds[k].get('fit_error', seeds[k]['errors']['algebraic'])
+            if not (errors[k] <= fit_error * SEED_ERROR_RATIO and filter_errors[k] <= max_error):
+                continue
+
+            candidate['errors']['algebraic'] = float(errors[k])
+            candidate['errors'][error_method] = float(filter_errors[k])
+            candidate['fit_error'] = fit_error
+            fits[matches[k][0]] = candidate
+
+        return fits
 
     def clear_cache(self):
         self.cached_contours = None
         self.cached_ellipses = None
+        self.cached_table = None
         self.cached_contour_params = None
-        self.cached_errors = {'algebraic': None, 'geometric': None, 'geometric_simple': None}
 
     def update_cache(self, param_category):
         if param_category == 'preprocessing':
             self.clear_cache()
 
-    def get_errors(self, error_method):
-        """Возвращает массив ошибок для указанного метода"""
-        if not self.param_manager.get_value('show_ellipses'):
-            return []
+    @timed('calculate_errors')
+    def calculate_errors(self, indices, error_method):
+        """Вычисляет ошибки указанным методом для эллипсов с индексами indices и записывает их в таблицу. Ошибки
+        хранятся и в самих эллипсах, поэтому вычисляются только для контуров, которых еще не было в кэше
+        аппроксимаций"""
+        ellipses = [self.cached_ellipses[i] for i in indices.tolist()]
+        missing = [ellipse for ellipse in ellipses if error_method not in ellipse['errors']]
+        if missing:
+            coordinates = pack_contours([ellipse['contour'] for ellipse in missing], self.fit_max_points)
+            errors = calculate_ellipse_errors(missing, coordinates, error_method, self.fitter)
+            for ellipse, error in zip(missing, errors.tolist()):
+                ellipse['errors'][error_method] = error
+
+        self.cached_table.set_errors(error_method, indices, [ellipse['errors'][error_method] for ellipse in ellipses])
+
+    @timed('fit_contours')
+    def fit_contours(self, contours):
+        """Аппроксимирует сразу все заданные контуры и возвращает для каждого из них словарь с параметрами
+        эллипса и контура или None, если контур не удалось аппроксимировать"""
+        selected = [i for i, contour in enumerate(contours) if len(contour) >= 5]
+        coefficients, centers, axes, angles, valid = self.fitter.fit_ellipses(
+            *pack_contours([contours[i] for i in selected], self.fit_max_points))
+
+        ellipses = [None] * len(contours)
+        for k in np.flatnonzero(valid):
+            center = (float(centers[k, 0]), float(centers[k, 1]))
+            ellipse_axes = (float(axes[k, 0]), float(axes[k, 1]))
+
+            ellipses[selected[k]] = {
+                'center': center,
+                'axes': ellipse_axes,
+                'angle': float(angles[k]),
+                'ellipse_area': np.pi * ellipse_axes[0] * ellipse_axes[1],
+                'contour': contours[selected[k]],
+                'coefficients': coefficients[k],
+                'errors': {},
+            }
+
+        return ellipses
+
+    def get_ellipses_from_contours(self, contours):
+        """Возвращает список словарей со всеми основными параметрами эллипсов и контуров, которые они
+        аппроксимируют, по заданным контурам. Результаты аппроксимации хранятся в кэше по хэшу точек контура,
+        поэтому заново аппроксимируются только новые или изменившиеся контуры. Если заданы эллипсы предыдущего
+        кадра, они проверяются раньше полной аппроксимации. Такие результаты в кэш не попадают, чтобы он не
+        зависел от истории кадров"""
+        # Эллипс нельзя провести меньше чем через 5 точек, такие контуры отбрасываются до вычисления ключей
+        contours = [contour for contour in contours if len(contour) >= 5]
+        keys = [get_contour_key(contour, self.image.shape, self.fit_max_points) for contour in contours]
+        fits = [None] * len(contours)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.fit_cache:
+                fits[i] = self.fit_cache.get(key)
+            else:
+                missing.append(i)
+
+        count('fit_cache_hits', len(contours) - len(missing))
+        count('fit_cache_misses', len(missing))
+
+        if missing and self.seed_ellipses:
+            seeded_fits = self.get_seeded_fits([contours[i] for i in missing])
+            for i, fit in zip(missing, seeded_fits):
+                fits[i] = fit
+
+            missing = [i for i, fit in zip(missing, seeded_fits) if fit is None]
+            seeded_count = sum(fit is not None for fit in seeded_fits)
+            self.seed_statistics['seeded'] += seeded_count
+            count('seeded_fits', seeded_count)
 
-        if self.cached_errors[error_method]:
-            return self.cached_errors[error_method]
+        if missing:
+            for i, fit in zip(missing, self.fit_contours([contours[i] for i in missing])):
+                fits[i] = fit
+                self.fit_cache.put(keys[i], fit)
 
-        errors = []
-        for ellipse in self.cached_ellipses:
-            error = calculate_ellipse_error(ellipse, error_method)
-            errors.append(error)
-        self.cached_errors[error_method] = errors
+            self.seed_statistics['fitted'] += len(missing)
 
-        return errors
+        return [fit for fit in fits if fit is not None]
 
     def get_ellipse_from_contour(self, contour):
         """Возвращает словарь со всеми основными параметрами эллипса и контура, который он аппроксимирует,
         по заданному контуру"""
-        points = contour.squeeze()
-        if len(points) < 5:
-            return None
+        ellipses = self.get_ellipses_from_contours([contour])
 
-        x = points[:, 0].astype(np.float64)
-        y = points[:, 1].astype(np.float64)
-        coefficients = get_approximation_ellipse(x, y)
+        return ellipses[0] if ellipses else None
 
-        if coefficients is None:
-            return None
+    def get_ellipse_area_in_bounds(self, ellipse):
+        """Возвращает площадь эллипса в границах изображения, вычисляя ее один раз для каждой аппроксимации"""
+        if 'area_in_bounds' not in ellipse:
+            height, width = self.image.shape[:2]
+            ellipse['area_in_bounds'] = calculate_ellipse_area_in_bounds(
+                ellipse['center'], ellipse['axes'], ellipse['angle'], (height, width))
 
-        ellipse_params = get_ellipse_geometric_params(coefficients)
-        if ellipse_params is None:
-            return None
+        return ellipse['area_in_bounds']
 
-        ellipse_area = np.pi * ellipse_params['axes'][0] * ellipse_params['axes'][1]
-        height, width = self.image.shape[:2]
-        contour_area = calculate_contour_area(contour, (height, width))
+    def get_closed_contour(self, ellipse):
+        """Возвращает замкнутый на границе изображения контур эллипса, замыкая его один раз для каждой
+        аппроксимации. Он нужен и для площади контура, и для заливки при отрисовке"""
+        if 'closed_contour' not in ellipse:
+            height, width = self.image.shape[:2]
+            ellipse['closed_contour'] = close_contour_at_border(ellipse['contour'], (height, width))
 
-        return {
-            'int_center': (int(ellipse_params['center'][0]), int(ellipse_params['center'][1])),
-            'int_axes': (int(ellipse_params['axes'][0]), int(ellipse_params['axes'][1])),
-            'center': ellipse_params['center'],
-            'axes': ellipse_params['axes'],
-            'angle': ellipse_params['angle'],
-            'ellipse_area': ellipse_area,
-            'contour_area': contour_area,
-            'contour': contour,
-            'coefficients': coefficients,
-            'x_coordinates': x,
-            'y_coordinates': y,
-        }
+        return ellipse['closed_contour']
+
+    def get_contour_area(self, ellipse):
+        """Возвращает площадь замкнутого на границе контура, вычисляя ее один раз для каждой аппроксимации"""
+        if 'contour_area' not in ellipse:
+            ellipse['contour_area'] = cv2.contourArea(self.get_closed_contour(ellipse))
 
-    def is_ellipse_valid(self, ellipse, error):
-        """Проверка, удовлетворяет ли переданный эллипс (и контур) параметрам фильтрации эллиптических объектов"""
+        return ellipse['contour_area']
+
+    def get_max_error(self):
+        """Максимальная ошибка аппроксимации, с которой эллипс проходит фильтрацию"""
         error_factor = self.param_manager.get_value('error_factor')
         error_exponent = self.param_manager.get_value('error_exponent')
-        max_error = error_factor / (10 ** int(error_exponent))
 
-        if error > max_error:
-            return False
+        return error_factor / (10 ** int(error_exponent))
 
-        min_area = self.param_manager.get_value('min_area')
-        if ellipse['ellipse_area'] < min_area:
-            return False
+    @timed('filter_ellipses')
+    def get_valid_ellipses(self, error_method):
+        """Возвращает эллипсы (и контуры), удовлетворяющие параметрам фильтрации эллиптических объектов. Условия
+        проверяются от дешевых к дорогим: сначала площадь и отношение полуосей эллипса, затем ошибка
+        аппроксимации, и только потом площадь контура (с замыканием на границе). Ошибки и площади вычисляются
+        лишь для эллипсов, прошедших предыдущие условия"""
+        table = self.cached_table
+        indices = table.get_shape_candidates(self.param_manager.get_value('min_area'),
+                                             self.param_manager.get_value('max_aspect_ratio'))
+        count('shape_candidates', len(indices))
 
-        max_aspect_ratio = self.param_manager.get_value('max_aspect_ratio')
-        if max_aspect_ratio > 0:
-            a_axis, b_axis = ellipse['axes']
-            if a_axis == 0 or b_axis == 0:
-                return False
+        missing = table.get_missing_errors(error_method, indices)
+        if len(missing):
+            self.calculate_errors(missing, error_method)
 
-            ratio = max(a_axis, b_axis) / min(a_axis, b_axis)
-            if ratio > max_aspect_ratio:
-                return False
+        indices = indices[table.get_error_mask(indices, error_method, self.get_max_error())]
 
         area_error = self.param_manager.get_value('area_error')
         if area_error > 0:
-            height, width = self.image.shape[:2]
-            contour_area = ellipse['contour_area']
-            ellipse_area_in_image = calculate_ellipse_area_in_bounds(
-                ellipse['int_center'], ellipse['int_axes'], ellipse['angle'], (height, width))
+            missing = table.get_missing_areas(indices)
+            ellipses = [self.cached_ellipses[i] for i in missing.tolist()]
+            table.set_areas(missing, [self.get_contour_area(ellipse) for ellipse in ellipses],
+                            [self.get_ellipse_area_in_bounds(ellipse) for ellipse in ellipses])
+            indices = indices[table.get_area_error_mask(indices, area_error)]
 
-            if contour_area == 0 or ellipse_area_in_image == 0:
-                return False
+        valid_ellipses = [self.cached_ellipses[i] for i in np.sort(indices).tolist()]
+        for ellipse in valid_ellipses:
+            self.get_contour_area(ellipse)
 
-            area_diff = abs(contour_area - ellipse_area_in_image) / contour_area
-            if area_diff > area_error:
-                return False
+        return valid_ellipses
 
-        return True
+    def segment_contours(self, contours):
+        """Разбивает контуры на эллиптические дуги, если это включено параметром arc_segmentation"""
+        if not self.param_manager.get_value('arc_segmentation'):
+            return contours
 
-    def find_ellipses(self):
+        return segment_contours(contours)
+
+    def find_ellipses(self, check_cancelled=None):
         """Возвращает словарь со всеми валидными эллипсами и контурами объектов, предобработанное изображение и
-        изображение с границами объектов"""
+        изображение с границами объектов. Функция check_cancelled вызывается между этапами обработки и может
+        прервать ее, выбросив исключение. Замеры времени и счетчики запуска сохраняются в last_report"""
+        report = RunReport()
+        profile_mode, self.profile_mode = self.profile_mode, None
+        try:
+            with activate_report(report, profile_mode), report.timer('find_ellipses'):
+                results = self.find_ellipses_in_image(check_cancelled)
+        except Exception:
+            # Прерванный запуск не считается: профиль будет записан при следующем
+            self.profile_mode = self.profile_mode or profile_mode
+            raise
+
+        self.last_report = report
+
+        return results
+
+    def find_ellipses_in_image(self, check_cancelled):
+        if check_cancelled is None:
+            check_cancelled = lambda: None
+
         if self.image is None:
             return {
                 'ellipses': [],
@@ -158,41 +378,43 @@ class EllipseDetector:
                 'edges': None
             }
 
-        thresholded, edges = self.preprocessor.preprocess_image(self.image)
-        if edges is None:
-            return {
-                'ellipses': [],
-                'contours': [],
-                'thresholded': thresholded,
-                'edges': edges
-            }
-
-        if self.cached_contours is None:
-            contour_method = self.param_manager.get_value('contour_method')
-            self.cached_contours = find_contours(edges, contour_method)
+        if self.full_resolution:
+            # Полноразмерные бинарное изображение и границы не создаются, чтобы не занимать память
+            thresholded, edges = None, None
+            if self.cached_contours is None:
+                with timer('find_contours'):
+                    self.cached_contours = self.segment_contours(find_contours_tiled(
+                        self.image, self.param_manager.get_snapshot('preprocessing'),
+                        self.param_manager.get_value('contour_method')))
+        else:
+            thresholded, edges = self.preprocessor.preprocess_image(self.image)
+            if edges is None:
+                return {
+                    'ellipses': [],
+                    'contours': [],
+                    'thresholded': thresholded,
+                    'edges': edges
+                }
+
+            check_cancelled()
+            if self.cached_contours is None:
+                contour_method = self.param_manager.get_value('contour_method')
+                with timer('find_contours'):
+                    self.cached_contours = self.segment_contours(find_contours(edges, contour_method))
 
         contours = self.cached_contours
+        count('contours', len(contours))
 
         valid_ellipses = []
         if self.param_manager.get_value('show_ellipses'):
+            check_cancelled()
             if self.cached_ellipses is None:
-                all_ellipses = []
-                for contour in contours:
-                    ellipse = self.get_ellipse_from_contour(contour)
-                    if ellipse:
-                        all_ellipses.append(ellipse)
-
-                self.cached_ellipses = all_ellipses
-            else:
-                all_ellipses = self.cached_ellipses
-
-            error_method = self.param_manager.get_value('error_method')
-            errors = self.get_errors(error_method)
+                self.cached_ellipses = self.get_ellipses_from_contours(contours)
+                self.cached_table = EllipseTable(self.cached_ellipses)
 
-            for i, ellipse in enumerate(all_ellipses):
-                if i < len(errors):
-                    if self.is_ellipse_valid(ellipse, errors[i]):
-                        valid_ellipses.append(ellipse)
+            check_cancelled()
+            valid_ellipses = self.get_valid_ellipses(self.param_manager.get_value('error_method'))
+            count('valid_ellipses', len(valid_ellipses))
 
         return {
             'ellipses': valid_ellipses,
@@ -201,20 +423,9 @@ class EllipseDetector:
             'edges': edges
         }
 
+    @timed('draw_results')
     def draw_results(self, image, ellipses, contours):
-        result_image = image.copy()
-
-        if self.param_manager.get_value('fill_contours') and ellipses:
-            valid_contours = [ellipse['contour'] for ellipse in ellipses]
-            if valid_contours:
-                height, width = result_image.shape[:2]
-                closed_contours = close_contours_at_border(valid_contours, (height, width))
-                cv2.drawContours(result_image, closed_contours, -1, FILL_COLOR, FILL_ALL_CONTOURS)
-
-        cv2.drawContours(result_image, contours, -1, CONTOUR_COLOR, CONTOUR_THICKNESS)
-        if self.param_manager.get_value('show_ellipses') and ellipses:
-            for ellipse in ellipses:
-                cv2.ellipse(result_image, ellipse['int_center'], ellipse['int_axes'],
-                            ellipse['angle'], ELLIPSE_START_ANGLE, ELLIPSE_END_ANGLE, ELLIPSE_COLOR, ELLIPSE_THICKNESS)
-
-        return result_image
+        """Возвращает изображение с контурами и эллипсами. Слои контуров, заливки и эллипсов кэшируются и
+        перерисовываются, только если изменились сами контуры или набор эллипсов"""
+        return self.renderer.render(image, ellipses, contours, self.param_manager.get_value('fill_contours'),
+                                    self.param_manager.get_value('show_ellipses'), self.get_closed_contour)
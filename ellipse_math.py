@@ -1,36 +1,114 @@
 import numpy as np
 import cv2
-from numpy import linalg
 from defaults import *
+from profiling import count, timed
 
 
-def close_contour_at_border(contour, image_shape):
-    """Возвращает замкнутый на границе изображение контур"""
-    height, width = image_shape
-    mask = np.zeros((height, width), dtype=np.uint8)
-
+def draw_border_frame(mask):
+    """Рисует на маске рамку толщиной в один пиксель по ее границе"""
     mask[0, :-1] = 255
     mask[-1, :] = 255
     mask[:-1, 0] = 255
     mask[:-1, -1] = 255
 
-    cv2.drawContours(mask, [contour], FILL_ALL_CONTOURS, (255, 255, 255), FILL_ALL_CONTOURS)
-    new_contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
 
-    if new_contours:
-        max_contour_area = (height * width) * MAX_CONTOUR_AREA_RATIO
-        filtered_contours = [c for c in new_contours if cv2.contourArea(c) < max_contour_area]
-        
-        if filtered_contours:
-            return max(filtered_contours, key=cv2.contourArea)
-    
+def get_touched_borders(contour, image_shape):
+    """Возвращает флаги касания контуром левой, верхней, правой и нижней границ изображения, а также его
+    ограничивающий прямоугольник"""
+    height, width = image_shape
+    x, y, w, h = cv2.boundingRect(contour)
+
+    return (x <= 1, y <= 1, x + w >= width - 1, y + h >= height - 1), (x, y, w, h)
+
+
+def close_contour_in_window(contour, window, max_contour_area, open_sides=(False, False, False, False)):
+    """Замыкает контур на рамке окна (x0, y0, x1, y1) и возвращает наибольший из получившихся контуров с площадью
+    меньше max_contour_area. Контуры, касающиеся открытых сторон окна (не совпадающих с границей изображения),
+    не рассматриваются, так как за пределами окна они продолжаются"""
+    x0, y0, x1, y1 = window
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    draw_border_frame(mask)
+
+    cv2.drawContours(mask, [contour], FILL_ALL_CONTOURS, (255, 255, 255), FILL_ALL_CONTOURS, offset=(-x0, -y0))
+    new_contours, _ = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE, offset=(x0, y0))
+
+    open_left, open_top, open_right, open_bottom = open_sides
+    filtered_contours = []
+    for new_contour in new_contours:
+        x, y, w, h = cv2.boundingRect(new_contour)
+        if ((open_left and x == x0) or (open_top and y == y0) or
+                (open_right and x + w == x1) or (open_bottom and y + h == y1)):
+            continue
+
+        if cv2.contourArea(new_contour) < max_contour_area:
+            filtered_contours.append(new_contour)
+
+    if filtered_contours:
+        return max(filtered_contours, key=cv2.contourArea)
+
     return contour
 
 
+@timed('close_contour_at_border')
+def close_contour_at_border(contour, image_shape):
+    """Возвращает замкнутый на границе изображения контур. Контуры, не касающиеся границы, возвращаются без
+    изменений, остальные замыкаются в окне вокруг контура, если результат в нем совпадает с результатом для
+    всего изображения"""
+    height, width = image_shape
+    (left, top, right, bottom), (x, y, w, h) = get_touched_borders(contour, image_shape)
+    if not (left or top or right or bottom):
+        return contour
+
+    max_contour_area = (height * width) * MAX_CONTOUR_AREA_RATIO
+    window = (0 if left else x - 2, 0 if top else y - 2,
+              width if right else x + w + 2, height if bottom else y + h + 2)
+    x0, y0, x1, y1 = window
+
+    # Окно должно оставлять снаружи себя связную часть изображения: тогда все открытые области окна образуют
+    # на полном изображении одну область, и если ее площадь заведомо больше допустимой, она будет отброшена
+    is_outside_connected = not (left and right) and not (top and bottom)
+    if (is_outside_connected and (left or x0 >= 2) and (top or y0 >= 2) and
+            (right or x1 <= width - 2) and (bottom or y1 <= height - 2)):
+        inner_window_area = (min(y1, height - 1) - max(y0, 1)) * (min(x1, width - 1) - max(x0, 1))
+        outside_area = (height - 2) * (width - 2) - inner_window_area
+
+        if outside_area > max_contour_area:
+            count('border_closings')
+            return close_contour_in_window(contour, window, max_contour_area,
+                                           (not left, not top, not right, not bottom))
+
+    count('border_closings')
+    count('border_closings_full_frame')
+    return close_contour_in_window(contour, (0, 0, width, height), max_contour_area)
+
+
+def get_ellipse_half_extents(axes, angle):
+    """Возвращает половины ширины и высоты прямоугольника, описанного вокруг эллипса"""
+    a, b = axes
+    angle_rad = np.radians(angle)
+    cos_angle, sin_angle = np.cos(angle_rad), np.sin(angle_rad)
+
+    return np.hypot(a * cos_angle, b * sin_angle), np.hypot(a * sin_angle, b * cos_angle)
+
+
+@timed('area_in_bounds')
 def calculate_ellipse_area_in_bounds(center, axes, angle, image_shape):
-    """Возвращает площадь эллипса в границах изображения"""
-    mask = np.zeros((image_shape[0], image_shape[1]), dtype=np.uint8)
-    cv2.ellipse(mask, center, axes,
+    """Возвращает площадь эллипса в границах изображения: для эллипса, целиком лежащего в изображении, - точную
+    площадь, для обрезанного границей - число пикселей его заливки в пределах описанного прямоугольника"""
+    height, width = image_shape
+    half_width, half_height = get_ellipse_half_extents(axes, angle)
+
+    x0, x1 = int(np.floor(center[0] - half_width)) - 1, int(np.ceil(center[0] + half_width)) + 2
+    y0, y1 = int(np.floor(center[1] - half_height)) - 1, int(np.ceil(center[1] + half_height)) + 2
+    if x0 >= 0 and y0 >= 0 and x1 <= width and y1 <= height:
+        return np.pi * axes[0] * axes[1]
+
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if x0 >= x1 or y0 >= y1:
+        return 0
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.ellipse(mask, (int(center[0]) - x0, int(center[1]) - y0), (int(axes[0]), int(axes[1])),
                 angle, 0, 360, (255, 255, 255), -1)
 
     return np.count_nonzero(mask)
@@ -43,120 +121,291 @@ def calculate_contour_area(contour, image_shape):
     return cv2.contourArea(closed_contour)
 
 
-def calc_xy_sums(x, y):
-    return {
-        'x4': np.sum(x ** 4), 'x3': np.sum(x ** 3), 'x2': np.sum(x ** 2), 'x': np.sum(x),
-        'y4': np.sum(y ** 4), 'y3': np.sum(y ** 3), 'y2': np.sum(y ** 2), 'y': np.sum(y),
-        'x3y': np.sum(x ** 3 * y), 'xy3': np.sum(x * y ** 3), 'x2y2': np.sum(x ** 2 * y ** 2),
-        'x2y': np.sum(x ** 2 * y), 'xy2': np.sum(x * y ** 2), 'xy': np.sum(x * y), 'n': len(x)
-    }
+def decimate_points(points, max_points):
+    """Прореживает точки контура до max_points, выбирая их через равные промежутки вдоль цепочки. Соседние точки
+    контура, найденного без сжатия, отстоят друг от друга на 1 или sqrt(2) пикселя, поэтому выбранные точки
+    распределены по длине дуги почти равномерно и сохраняют вес каждого участка контура в средних ошибках"""
+    if max_points <= 0 or len(points) <= max_points:
+        return points
 
+    return points[np.arange(max_points) * len(points) // max_points]
 
-def make_matrix_a(sums):
-    return np.array([
-        [sums['x4'], sums['x3y'], sums['x2y2'], sums['x3'], sums['x2y'], sums['x2']],
-        [sums['x3y'], sums['x2y2'], sums['xy3'], sums['x2y'], sums['xy2'], sums['xy']],
-        [sums['x2y2'], sums['xy3'], sums['y4'], sums['xy2'], sums['y3'], sums['y2']],
-        [sums['x3'], sums['x2y'], sums['xy2'], sums['x2'], sums['xy'], sums['x']],
-        [sums['x2y'], sums['xy2'], sums['y3'], sums['xy'], sums['y2'], sums['y']],
-        [sums['x2'], sums['xy'], sums['y2'], sums['x'], sums['y'], sums['n']]
-    ])
 
+def get_segment_offsets(counts):
+    """Возвращает смещения, с которых начинается каждый набор точек в общем буфере, по количеству точек в
+    наборах"""
+    counts = np.asarray(counts)
+    offsets = np.zeros(len(counts), dtype=counts.dtype)
+    np.cumsum(counts[:-1], out=offsets[1:])
 
-def make_matrix_b():
-    return np.array([
-        [0, 0, 2, 0, 0, 0],
-        [0, -1, 0, 0, 0, 0],
-        [2, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0],
-        [0, 0, 0, 0, 0, 0]
-    ])
+    return offsets
 
 
-def get_approximation_ellipse(x, y):
-    """Возвращает эллипсе, аппроксимирующий заданный набор точек методом наименьших квадратов"""
-    sums = calc_xy_sums(x, y)
-    matrix_a = make_matrix_a(sums)
-    matrix_b = make_matrix_b()
+def pack_contours(contours, max_points=0):
+    """Объединяет точки контуров (прореженных до max_points точек) в общие буферы координат x и y и возвращает
+    их вместе со смещениями, с которых начинается каждый контур"""
+    points = [decimate_points(contour.reshape(-1, 2), max_points) for contour in contours]
+    offsets = get_segment_offsets(np.fromiter((len(p) for p in points), dtype=np.intp, count=len(points)))
+    if len(offsets) == 0:
+        return np.empty(0), np.empty(0), offsets
 
-    if np.abs(linalg.det(matrix_a)) < DETERMINANT_MIN_ERROR:
-        return None
+    points = np.concatenate(points)
 
-    try:
-        result_matrix = linalg.inv(matrix_a) @ matrix_b
-    except linalg.LinAlgError:
-        return None
+    return points[:, 0].astype(np.float64), points[:, 1].astype(np.float64), offsets
 
-    eigenvalues, eigenvectors = linalg.eig(result_matrix)
-    eigenvectors = eigenvectors.transpose()
 
-    for i in range(len(eigenvalues)):
-        eigenvalue = np.real(eigenvalues[i])
-        if eigenvalue > EIGENVALUE_THRESHOLD:
-            temp = eigenvectors[i] @ (matrix_a @ eigenvectors[i]) * eigenvalues[i]
-            if temp < 0:
-                break
+def get_segment_counts(offsets, total_count):
+    """Возвращает количество точек в каждом наборе по смещениям их начала"""
+    return np.diff(np.append(offsets, total_count))
 
-            multiplier = 1 / np.sqrt(temp)
 
-            return eigenvectors[i] * multiplier
+# Степени (x, y) одночленов, из которых состоит матрица рассеяния, и номера одночленов для ее элементов
+MONOMIAL_POWERS = np.array([(i, j) for i in range(5) for j in range(5 - i)])
+DESIGN_POWERS = np.array([(2, 0), (1, 1), (0, 2), (1, 0), (0, 1), (0, 0)])
+SCATTER_MONOMIAL_INDICES = np.array([
+    [MONOMIAL_POWERS.tolist().index((row + column).tolist()) for column in DESIGN_POWERS]
+    for row in DESIGN_POWERS
+])
 
-    return None
 
+def normalize_coordinates(x, y, offsets):
+    """Переносит начало координат каждого набора точек в его центр масс и масштабирует точки к единичному
+    среднеквадратичному отклонению, возвращает нормированные координаты, центры и масштабы наборов"""
+    counts = get_segment_counts(offsets, len(x))
+    means = np.stack([np.add.reduceat(x, offsets), np.add.reduceat(y, offsets)], axis=1) / counts[:, None]
 
-def get_ellipse_geometric_params(coefficients):
-    """Возвращает словарь с основными геометрическими параметрами эллипса по его коэффициентам"""
-    a, b, c, d, e, f = np.real(coefficients)
+    x_centered = x - np.repeat(means[:, 0], counts)
+    y_centered = y - np.repeat(means[:, 1], counts)
+    scales = np.sqrt(np.add.reduceat(x_centered ** 2 + y_centered ** 2, offsets) / (2 * counts))
+    scales[scales == 0] = 1.0
 
-    theta_rad = np.arctan2(-b, c - a) / 2
-    if not np.isreal(theta_rad):
-        return None
+    point_scales = np.repeat(scales, counts)
 
-    theta_degrees = np.rad2deg(float(np.real(theta_rad)))
+    return x_centered / point_scales, y_centered / point_scales, means, scales
 
-    sqr_val = (a - c) ** 2 + b ** 2
-    if sqr_val < 0:
-        return None
 
-    sqrt_val = np.sqrt(sqr_val)
-    common_factor = 2 * (a * e ** 2 + c * d ** 2 - b * d * e + (b ** 2 - 4 * a * c) * f)
-    
-    a_sqr_val = common_factor * ((a + c) + sqrt_val)
-    b_sqr_val = common_factor * ((a + c) - sqrt_val)
-    if a_sqr_val < 0 or b_sqr_val < 0:
-        return None
+def get_monomials(x, y):
+    """Возвращает значения всех одночленов x^i * y^j степени не выше 4 для каждой точки в виде массива
+    (число одночленов, число точек)"""
+    x_powers = [np.ones_like(x), x, x * x]
+    x_powers += [x_powers[2] * x, x_powers[2] * x_powers[2]]
+    y_powers = [np.ones_like(y), y, y * y]
+    y_powers += [y_powers[2] * y, y_powers[2] * y_powers[2]]
+
+    monomials = np.empty((len(MONOMIAL_POWERS), len(x)))
+    for k, (i, j) in enumerate(MONOMIAL_POWERS):
+        np.multiply(x_powers[i], y_powers[j], out=monomials[k])
+
+    return monomials
+
+
+def make_scatter_matrices(monomial_sums):
+    """Собирает матрицы рассеяния (N, 6, 6) из сумм одночленов по каждому набору точек"""
+    return monomial_sums[:, SCATTER_MONOMIAL_INDICES]
+
+
+def solve_ellipses_from_scatter(scatter_matrices):
+    """Находит коэффициенты эллипсов по матрицам рассеяния методом Халира-Флюссера, сведенным к задаче 3x3,
+    и возвращает их вместе с маской успешных аппроксимаций"""
+    set_count = len(scatter_matrices)
+    s1 = scatter_matrices[:, :3, :3]
+    s2 = scatter_matrices[:, :3, 3:]
+    s3 = scatter_matrices[:, 3:, 3:].copy()
+
+    valid = np.all(np.isfinite(scatter_matrices), axis=(1, 2)) & (s3[:, 2, 2] > 0)
+    s3[~valid] = np.eye(3)
+    valid &= np.linalg.det(s3 / s3[:, 2:, 2:]) > NORMALIZED_DETERMINANT_MIN_ERROR
+    s3[~valid] = np.eye(3)
+
+    t = -np.linalg.solve(s3, np.transpose(s2, (0, 2, 1)))
+    m = s1 + s2 @ t
+    reduced = np.stack([m[:, 2] / 2, -m[:, 1], m[:, 0] / 2], axis=1)
+    reduced[~valid] = np.eye(3)
+
+    _, eigenvectors = np.linalg.eig(reduced)
+    eigenvectors = np.real(eigenvectors)
+
+    conditions = 4 * eigenvectors[:, 0] * eigenvectors[:, 2] - eigenvectors[:, 1] ** 2
+    best = np.argmax(conditions, axis=1)
+    valid &= conditions[np.arange(set_count), best] > EIGENVALUE_THRESHOLD
+
+    a1 = eigenvectors[np.arange(set_count), :, best]
+    a2 = (t @ a1[:, :, None])[:, :, 0]
+
+    coefficients = np.concatenate([a1, a2], axis=1)
+    coefficients[~valid] = 0.0
+
+    return coefficients, valid
+
+
+def denormalize_coefficients(coefficients, means, scales):
+    """Переводит коэффициенты эллипсов из нормированных координат в координаты изображения и приводит их к виду
+    4ac - b^2 = 1, a + c > 0"""
+    a, b, c, d, e, f = coefficients.T
+    mx, my = means.T
+    scales_sqr = scales ** 2
+
+    result = np.stack([
+        a / scales_sqr,
+        b / scales_sqr,
+        c / scales_sqr,
+        d / scales - (2 * a * mx + b * my) / scales_sqr,
+        e / scales - (b * mx + 2 * c * my) / scales_sqr,
+        f - (d * mx + e * my) / scales + (a * mx ** 2 + b * mx * my + c * my ** 2) / scales_sqr
+    ], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm = np.sqrt(4 * result[:, 0] * result[:, 2] - result[:, 1] ** 2)
+        norm *= np.sign(result[:, 0] + result[:, 2])
+
+        return result / norm[:, None]
+
+
+@timed('fit_ellipses')
+def fit_ellipses(x, y, offsets):
+    """Аппроксимирует эллипсами методом наименьших квадратов сразу все наборы точек, объединенные в общие буферы
+    x, y со смещениями offsets. Возвращает коэффициенты и геометрические параметры эллипсов и маску успешных
+    аппроксимаций"""
+    if len(offsets) == 0:
+        return np.empty((0, 6)), np.empty((0, 2)), np.empty((0, 2)), np.empty(0), np.zeros(0, dtype=bool)
+
+    x_normalized, y_normalized, means, scales = normalize_coordinates(x, y, offsets)
+    monomial_sums = np.add.reduceat(get_monomials(x_normalized, y_normalized), offsets, axis=1).T
+
+    coefficients, valid = solve_ellipses_from_scatter(make_scatter_matrices(monomial_sums))
+    coefficients = denormalize_coefficients(coefficients, means, scales)
+
+    centers, axes, angles, valid_params = get_ellipses_geometric_params(coefficients)
+    valid &= valid_params
+    valid &= get_segment_counts(offsets, len(x)) >= 5
+
+    count('fits_attempted', len(offsets))
+    count('fits_rejected', int(np.count_nonzero(~valid)))
+
+    return coefficients, centers, axes, angles, valid
+
+
+def get_prefix_monomial_sums(x, y, offsets):
+    """Вычисляет накопленные суммы одночленов вдоль всех наборов точек, объединенных в общие буферы. Каждый
+    набор нормируется целиком, поэтому сумма по любой дуге [i, j) набора - разность двух строк. Возвращает
+    накопленные суммы (число точек + 1, число одночленов), центры и масштабы наборов"""
+    x_normalized, y_normalized, means, scales = normalize_coordinates(x, y, offsets)
+
+    prefix_sums = np.zeros((len(x) + 1, len(MONOMIAL_POWERS)))
+    np.cumsum(get_monomials(x_normalized, y_normalized).T, axis=0, out=prefix_sums[1:])
+
+    return prefix_sums, means, scales
+
+
+def get_arc_monomial_sums(prefix_sums, offsets, counts, set_indices, starts, ends):
+    """Возвращает суммы одночленов по дугам [starts, ends) замкнутых наборов точек с номерами set_indices.
+    Конец дуги может переходить через начало набора (starts < ends <= starts + число точек набора)"""
+    base = offsets[set_indices]
+    set_counts = counts[set_indices]
+
+    sums = prefix_sums[base + np.minimum(ends, set_counts)] - prefix_sums[base + starts]
+    wrapped = ends > set_counts
+    sums[wrapped] += prefix_sums[base[wrapped] + ends[wrapped] - set_counts[wrapped]] - prefix_sums[base[wrapped]]
+
+    return sums
+
+
+@timed('fit_arcs')
+def fit_arcs(prefix_sums, offsets, counts, means, scales, set_indices, starts, ends):
+    """Аппроксимирует эллипсами дуги [starts, ends) наборов точек по накопленным суммам одночленов, не
+    обращаясь к самим точкам. Кроме параметров эллипсов возвращает оценку среднеквадратичного расстояния от
+    точек дуги до эллипса в пикселях: сумма квадратов невязок, деленная на сумму квадратов градиента"""
+    scatter_matrices = make_scatter_matrices(get_arc_monomial_sums(prefix_sums, offsets, counts, set_indices,
+                                                                   starts, ends))
+    coefficients, valid = solve_ellipses_from_scatter(scatter_matrices)
+
+    a, b, c, d, e, _ = coefficients.T
+    residuals = np.einsum('ni,nij,nj->n', coefficients, scatter_matrices, coefficients)
+    linear_scatter = scatter_matrices[:, 3:, 3:]
+    gradient_x = np.stack([2 * a, b, d], axis=1)
+    gradient_y = np.stack([b, 2 * c, e], axis=1)
+    gradients = (np.einsum('ni,nij,nj->n', gradient_x, linear_scatter, gradient_x) +
+                 np.einsum('ni,nij,nj->n', gradient_y, linear_scatter, gradient_y))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = scales[set_indices] * np.sqrt(np.abs(residuals) / gradients)
+
+    coefficients = denormalize_coefficients(coefficients, means[set_indices], scales[set_indices])
+    centers, axes, angles, valid_params = get_ellipses_geometric_params(coefficients)
+    valid &= valid_params & np.isfinite(distances)
+
+    count('arc_fits', len(starts))
+
+    return coefficients, centers, axes, angles, valid, distances
 
-    denominator = b ** 2 - 4 * a * c
-    a_axis = -np.sqrt(a_sqr_val) / denominator
-    b_axis = -np.sqrt(b_sqr_val) / denominator
 
-    if not all(np.isreal([a_axis, b_axis])):
+def get_approximation_ellipse(x, y):
+    """Возвращает эллипс, аппроксимирующий заданный набор точек методом наименьших квадратов"""
+    coefficients, _, _, _, valid = fit_ellipses(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                                np.zeros(1, dtype=np.intp))
+    if not valid[0]:
         return None
 
-    x0 = (2 * c * d - b * e) / denominator
-    y0 = (2 * a * e - b * d) / denominator
+    return coefficients[0]
+
+
+def get_ellipses_geometric_params(coefficients):
+    """Возвращает центры, полуоси и углы поворота эллипсов по их коэффициентам и маску эллипсов, для которых
+    параметры удалось вычислить"""
+    a, b, c, d, e, f = np.real(coefficients).reshape(-1, 6).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles = np.rad2deg(np.arctan2(-b, c - a) / 2)
+
+        sqrt_val = np.sqrt((a - c) ** 2 + b ** 2)
+        common_factor = 2 * (a * e ** 2 + c * d ** 2 - b * d * e + (b ** 2 - 4 * a * c) * f)
+
+        a_sqr_val = common_factor * ((a + c) + sqrt_val)
+        b_sqr_val = common_factor * ((a + c) - sqrt_val)
+        valid = (a_sqr_val >= 0) & (b_sqr_val >= 0)
+
+        denominator = b ** 2 - 4 * a * c
+        axes = np.stack([-np.sqrt(np.abs(a_sqr_val)), -np.sqrt(np.abs(b_sqr_val))], axis=1) / denominator[:, None]
+        centers = np.stack([2 * c * d - b * e, 2 * a * e - b * d], axis=1) / denominator[:, None]
+
+    valid &= np.all(np.isfinite(axes), axis=1) & np.all(np.isfinite(centers), axis=1)
+
+    return centers, axes, angles, valid
+
 
-    if not all(np.isreal([x0, y0])):
+def get_ellipse_geometric_params(coefficients):
+    """Возвращает словарь с основными геометрическими параметрами эллипса по его коэффициентам"""
+    centers, axes, angles, valid = get_ellipses_geometric_params(coefficients)
+    if not valid[0]:
         return None
 
     return {
-        'center': (float(np.real(x0)), float(np.real(y0))),
-        'axes': (float(np.real(a_axis)), float(np.real(b_axis))),
-        'angle': theta_degrees
+        'center': (float(centers[0, 0]), float(centers[0, 1])),
+        'axes': (float(axes[0, 0]), float(axes[0, 1])),
+        'angle': float(angles[0])
     }
 
 
+@timed('calculate_errors_algebraic')
+def calculate_errors_algebraic(coefficients, x, y, offsets):
+    """Вычисляет алгебраические ошибки аппроксимации сразу для всех эллипсов, точки которых объединены в общие
+    буферы x, y со смещениями offsets"""
+    if len(offsets) == 0:
+        return np.empty(0)
+
+    counts = get_segment_counts(offsets, len(x))
+    point_coefficients = np.repeat(np.asarray(coefficients), counts, axis=0)
+    a, b, c, d, e, f = point_coefficients.T
+
+    ellipse_value = a * x ** 2 + b * x * y + c * y ** 2 + d * x + e * y
+    point_errors = np.abs(ellipse_value + f) / (np.abs(ellipse_value) + np.abs(f))
+
+    return np.add.reduceat(point_errors, offsets) / counts
+
+
 def calculate_error_algebraic(coefficients, x, y):
     """Вычисляет алгебраическую ошибку аппроксимации набора точек эллипсом"""
-    a, b, c, d, e, f = coefficients
-    total_error = 0.0
-    
-    for i in range(len(x)):
-        ellipse_value = a * x[i] ** 2 + b * x[i] * y[i] + c * y[i] ** 2 + d * x[i] + e * y[i]
-        total_error += np.abs(ellipse_value + f) / (np.abs(ellipse_value) + np.abs(f))
-
-    return total_error / len(x)
+    return calculate_errors_algebraic([coefficients], x, y, np.zeros(1, dtype=np.intp))[0]
 
 
 def get_rotated_point(x, y, center, angle):
@@ -169,62 +418,204 @@ def get_rotated_point(x, y, center, angle):
     return x_rotated, y_rotated
 
 
-def get_distance_to_ellipse_newton(x, y, a, b):
-    """Возвращает расстояние от точки до эллипса, рассчитанное методом Ньютона"""
-    if x == 0 and y == 0:
-        return min(a, b)
-
+def get_newton_distances(x, y, a, b):
+    """Возвращает расстояния от точек до эллипсов, рассчитанные методом Ньютона одновременно для всех точек
+    (a, b - полуоси эллипса, соответствующего каждой точке), и маску точек с ненадежным результатом: метод не
+    сошелся или сошелся к точке эллипса из другой четверти (ближайшая точка всегда лежит в той же четверти)"""
+    x, y, a, b = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (x, y, a, b)))
     t = np.arctan2(y, x)
+    active = np.ones(t.shape, dtype=bool)
 
-    for i in range(NEWTON_MAX_ITERATIONS):
-        cos_t = np.cos(t)
-        sin_t = np.sin(t)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i in range(NEWTON_MAX_ITERATIONS):
+            indices = np.flatnonzero(active)
+            if len(indices) == 0:
+                break
 
-        x_ellipse = a * cos_t
-        y_ellipse = b * sin_t
+            count('newton_iterations')
+            count('newton_point_iterations', len(indices))
 
-        dx_dt = -a * sin_t
-        dy_dt = b * cos_t
+            t_active, a_active, b_active = t[indices], a[indices], b[indices]
+            cos_t = np.cos(t_active)
+            sin_t = np.sin(t_active)
 
-        f = (x_ellipse - x) * dx_dt + (y_ellipse - y) * dy_dt
+            x_diff = a_active * cos_t - x[indices]
+            y_diff = b_active * sin_t - y[indices]
 
-        df_dt = dx_dt ** 2 + dy_dt ** 2 + (x_ellipse - x) * (-a * cos_t) + (y_ellipse - y) * (-b * sin_t)
+            dx_dt = -a_active * sin_t
+            dy_dt = b_active * cos_t
 
-        if abs(f) < NEWTON_ACCURACY:
-            break
+            f = x_diff * dx_dt + y_diff * dy_dt
+            df_dt = dx_dt ** 2 + dy_dt ** 2 + x_diff * (-a_active * cos_t) + y_diff * (-b_active * sin_t)
+
+            converged = np.abs(f) < NEWTON_ACCURACY
+            active[indices[converged]] = False
 
-        t = t - f / df_dt
+            not_converged = ~converged
+            t[indices[not_converged]] = t_active[not_converged] - f[not_converged] / df_dt[not_converged]
 
     x_ellipse = a * np.cos(t)
     y_ellipse = b * np.sin(t)
+    distances = np.hypot(x - x_ellipse, y - y_ellipse)
+    # Для точки на оси эллипса произведение координат равно нулю, и переход в другую четверть им не виден, а
+    # метод Ньютона из такой точки может сойтись к неверной точке эллипса
+    unreliable = active | (x * x_ellipse < 0) | (y * y_ellipse < 0) | ((x == 0) != (y == 0))
 
-    return np.sqrt((x - x_ellipse) ** 2 + (y - y_ellipse) ** 2)
+    at_center = (x == 0) & (y == 0)
+    distances[at_center] = np.minimum(a, b)[at_center]
+    unreliable[at_center] = False
 
+    count('newton_unreliable_points', int(np.count_nonzero(unreliable)))
 
-def calculate_error_geometric_newton(center, axes, angle, x, y):
-    """Вычисляет геометрическую ошибку аппроксимации набора точек эллипсом"""
-    a, b = axes
+    return distances, unreliable
 
-    total_distance = 0.0
-    angle_rad = np.radians(angle)
-    
-    for i in range(len(x)):
-        x_rotated, y_rotated = get_rotated_point(x[i], y[i], center, angle_rad)
-        total_distance += get_distance_to_ellipse_newton(x_rotated, y_rotated, a, b)
 
-    return total_distance * GEOMETRIC_ERROR_SCALE_MULTIPLIER / (np.sqrt(a ** 2 + b ** 2) * len(x))
+def get_ellipse_root(r0, z0, z1, g):
+    """Находит бисекцией корень функции расстояния из метода Эберли одновременно для всех точек"""
+    n0 = r0 * z0
+    s0 = z1 - 1
+    s1 = np.where(g < 0, 0.0, np.hypot(n0, z1) - 1)
+    s = np.zeros_like(s0)
+    active = g != 0
+
+    for i in range(BISECTION_MAX_ITERATIONS):
+        if not active.any():
+            break
+
+        s = np.where(active, (s0 + s1) / 2, s)
+        active &= (s != s0) & (s != s1)
+
+        ratio0 = n0 / (s + r0)
+        ratio1 = z1 / (s + 1)
+        g = ratio0 ** 2 + ratio1 ** 2 - 1
+
+        s0 = np.where(active & (g > 0), s, s0)
+        s1 = np.where(active & (g < 0), s, s1)
+        active &= g != 0
+
+    return s
+
+
+@timed('get_exact_distances')
+def get_exact_distances(x, y, a, b):
+    """Возвращает точные расстояния от точек до эллипсов (метод Эберли с поиском корня бисекцией)
+    одновременно для всех точек"""
+    x, y, a, b = np.broadcast_arrays(*(np.asarray(v, dtype=np.float64) for v in (x, y, a, b)))
+
+    swap = a < b
+    e0 = np.where(swap, b, a)
+    e1 = np.where(swap, a, b)
+    y0 = np.abs(np.where(swap, y, x))
+    y1 = np.abs(np.where(swap, x, y))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z0 = y0 / e0
+        z1 = y1 / e1
+        g = z0 ** 2 + z1 ** 2 - 1
+        r0 = (e0 / e1) ** 2
+
+        general = (y0 > 0) & (y1 > 0)
+        s = get_ellipse_root(r0[general], z0[general], z1[general], g[general])
+
+        general_distances = np.zeros_like(y0)
+        general_distances[general] = np.hypot(r0[general] * y0[general] / (s + r0[general]) - y0[general],
+                                              y1[general] / (s + 1) - y1[general])
+
+        numer0 = e0 * y0
+        denom0 = e0 ** 2 - e1 ** 2
+        inside = numer0 < denom0
+        xde0 = numer0 / denom0
+        axis_distances = np.where(inside,
+                                  np.hypot(e0 * xde0 - y0, e1 * np.sqrt(np.maximum(1 - xde0 ** 2, 0))),
+                                  np.abs(y0 - e0))
+
+    return np.select([general, y1 > 0], [general_distances, np.abs(y1 - e1)], axis_distances)
+
+
+def get_distances_to_ellipse(x, y, a, b, solver=GEOMETRIC_DISTANCE_SOLVER):
+    """Возвращает расстояния от точек до эллипсов указанным методом: 'newton' - метод Ньютона,
+    'exact' - метод Эберли, 'newton_exact' - метод Ньютона с пересчетом ненадежных точек методом Эберли"""
+    if solver == 'exact':
+        return get_exact_distances(x, y, a, b)
+
+    distances, unreliable = get_newton_distances(x, y, a, b)
+    if solver == 'newton_exact' and unreliable.any():
+        distances[unreliable] = get_exact_distances(*(np.broadcast_to(v, distances.shape)[unreliable]
+                                                      for v in (x, y, a, b)))
+
+    return distances
+
+
+def get_distance_to_ellipse_newton(x, y, a, b):
+    """Возвращает расстояние от точки до эллипса, рассчитанное методом Ньютона"""
+    distances, _ = get_newton_distances(x, y, a, b)
+
+    return float(distances)
+
+
+def get_rotated_points(x, y, centers, axes, angles, offsets):
+    """Переводит точки всех наборов в систему координат, связанную с соответствующим эллипсом, и возвращает их
+    вместе с полуосями эллипса для каждой точки"""
+    counts = get_segment_counts(offsets, len(x))
+    point_centers = np.repeat(np.asarray(centers, dtype=np.float64), counts, axis=0)
+    point_axes = np.repeat(np.asarray(axes, dtype=np.float64), counts, axis=0)
+    point_angles = np.repeat(np.radians(np.asarray(angles, dtype=np.float64)), counts)
+
+    x_rotated, y_rotated = get_rotated_point(x, y, point_centers.T, point_angles)
+
+    return x_rotated, y_rotated, point_axes[:, 0], point_axes[:, 1]
+
+
+@timed('calculate_errors_geometric_newton')
+def calculate_errors_geometric_newton(centers, axes, angles, x, y, offsets, solver=GEOMETRIC_DISTANCE_SOLVER):
+    """Вычисляет геометрические ошибки аппроксимации сразу для всех эллипсов, точки которых объединены в общие
+    буферы x, y со смещениями offsets"""
+    if len(offsets) == 0:
+        return np.empty(0)
+
+    x_rotated, y_rotated, a, b = get_rotated_points(x, y, centers, axes, angles, offsets)
+    distances = get_distances_to_ellipse(x_rotated, y_rotated, a, b, solver)
+
+    axes = np.asarray(axes, dtype=np.float64)
+    counts = get_segment_counts(offsets, len(x))
+
+    return (np.add.reduceat(distances, offsets) * GEOMETRIC_ERROR_SCALE_MULTIPLIER /
+            (np.hypot(axes[:, 0], axes[:, 1]) * counts))
+
+
+@timed('calculate_errors_geometric_simple')
+def calculate_errors_geometric_simple(centers, axes, angles, x, y, offsets):
+    """Вычисляет упрощенные геометрические ошибки аппроксимации сразу для всех эллипсов, точки которых
+    объединены в общие буферы x, y со смещениями offsets"""
+    if len(offsets) == 0:
+        return np.empty(0)
+
+    x_rotated, y_rotated, a, b = get_rotated_points(x, y, centers, axes, angles, offsets)
+    distances = np.sqrt((x_rotated / a) ** 2 + (y_rotated / b) ** 2)
+    point_errors = np.abs(distances - 1.0) / (distances + 1.0)
+
+    counts = get_segment_counts(offsets, len(x))
+
+    return np.add.reduceat(point_errors, offsets) * GEOMETRIC_ERROR_SCALE_MULTIPLIER / counts
+
+
+def calculate_errors(error_method, coefficients, centers, axes, angles, x, y, offsets):
+    """Вычисляет ошибки аппроксимации указанным методом сразу для всех эллипсов, заданных массивами
+    коэффициентов и геометрических параметров"""
+    if error_method == 'geometric':
+        return calculate_errors_geometric_newton(centers, axes, angles, x, y, offsets)
+    if error_method == 'geometric_simple':
+        return calculate_errors_geometric_simple(centers, axes, angles, x, y, offsets)
+
+    return calculate_errors_algebraic(coefficients, x, y, offsets)
+
+
+def calculate_error_geometric_newton(center, axes, angle, x, y, solver=GEOMETRIC_DISTANCE_SOLVER):
+    """Вычисляет геометрическую ошибку аппроксимации набора точек эллипсом"""
+    return calculate_errors_geometric_newton([center], [axes], [angle], x, y, np.zeros(1, dtype=np.intp),
+                                             solver)[0]
 
 
 def calculate_error_geometric_simple(center, axes, angle, x, y):
     """Вычисляет упрощенную геометрическую ошибку аппроксимации набора точек эллипсом"""
-    a, b = axes
-    
-    total_distance = 0.0
-    angle_rad = np.radians(angle)
-    
-    for i in range(len(x)):
-        x_rotated, y_rotated = get_rotated_point(x[i], y[i], center, angle_rad)
-        distance = np.sqrt((x_rotated / a) ** 2 + (y_rotated / b) ** 2)
-        total_distance += abs(distance - 1.0) / (distance + 1.0)
-
-    return total_distance * GEOMETRIC_ERROR_SCALE_MULTIPLIER / len(x)
+    return calculate_errors_geometric_simple([center], [axes], [angle], x, y, np.zeros(1, dtype=np.intp))[0]
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+from defaults import CONFIGURABLE_PARAMS
+from ellipse_math import get_segment_offsets
+
+ERROR_METHODS = CONFIGURABLE_PARAMS['error_method']['options']
+
+# Скалярные параметры эллипса; ошибки, которые не вычислялись, равны NaN
+ELLIPSE_DTYPE = np.dtype(
+    [(name, np.float64) for name in ['center_x', 'center_y', 'axis_a', 'axis_b', 'angle', 'ellipse_area',
+                                     'contour_area']] +
+    [(f"{method}_error", np.float64) for method in ERROR_METHODS]
+)
+
+ARRAY_NAMES = ['ellipses', 'points', 'offsets']
+
+
+class EllipseResults:
+    """Компактное представление найденных эллипсов: структурированный массив скалярных параметров, общий буфер
+    точек контуров (N, 2) и смещения, с которых начинается контур каждого эллипса. Сохраняется в один файл .npz
+    или в каталог файлов .npy, которые можно загрузить отображением в память"""
+
+    def __init__(self, ellipses, points, offsets):
+        self.ellipses = ellipses
+        self.points = points
+        self.offsets = offsets
+
+    @classmethod
+    def from_ellipses(cls, ellipses):
+        """Создает результаты по списку словарей эллипсов, которые возвращает EllipseDetector"""
+        records = np.full(len(ellipses), np.nan, dtype=ELLIPSE_DTYPE)
+        if ellipses:
+            records['center_x'], records['center_y'] = np.array([ellipse['center'] for ellipse in ellipses]).T
+            records['axis_a'], records['axis_b'] = np.array([ellipse['axes'] for ellipse in ellipses]).T
+            records['angle'] = [ellipse['angle'] for ellipse in ellipses]
+            records['ellipse_area'] = [ellipse['ellipse_area'] for ellipse in ellipses]
+            records['contour_area'] = [ellipse.get('contour_area', np.nan) for ellipse in ellipses]
+            for method in ERROR_METHODS:
+                records[f"{method}_error"] = [ellipse['errors'].get(method, np.nan) for ellipse in ellipses]
+
+        contours = [ellipse['contour'].reshape(-1, 2) for ellipse in ellipses]
+        offsets = get_segment_offsets(np.fromiter((len(contour) for contour in contours), dtype=np.int64,
+                                                  count=len(contours)))
+        points = np.concatenate(contours).astype(np.int32) if contours else np.empty((0, 2), dtype=np.int32)
+
+        return cls(records, points, offsets)
+
+    @classmethod
+    def load(cls, path, mmap_mode=None):
+        """Загружает результаты из файла .npz или каталога файлов .npy. mmap_mode передается в np.load и
+        действует только для каталога"""
+        if os.path.isdir(path):
+            return cls(*[np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES])
+
+        with np.load(path) as data:
+            return cls(*[data[name] for name in ARRAY_NAMES])
+
+    def __len__(self):
+        return len(self.ellipses)
+
+    def get_contour(self, index):
+        """Возвращает точки контура эллипса в формате OpenCV (без копирования)"""
+        end = self.offsets[index + 1] if index + 1 < len(self.offsets) else len(self.points)
+
+        return self.points[self.offsets[index]:end].reshape(-1, 1, 2)
+
+    def save(self, path):
+        """Сохраняет результаты в файл .npz"""
+        np.savez(path, **dict(zip(ARRAY_NAMES, [self.ellipses, self.points, self.offsets])))
+
+    def save_arrays(self, path):
+        """Сохраняет результаты в каталог файлов ellipses.npy, points.npy и offsets.npy"""
+        os.makedirs(path, exist_ok=True)
+        for name, array in zip(ARRAY_NAMES, [self.ellipses, self.points, self.offsets]):
+            np.save(os.path.join(path, f"{name}.npy"), array)
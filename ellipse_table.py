@@ -0,0 +1,100 @@
+import numpy as np
+
+
+def get_sorted_index(values):
+    """Возвращает порядок сортировки значений и отсортированные значения"""
+    order = np.argsort(values, kind='stable')
+
+    return order, values[order]
+
+
+class EllipseTable:
+    """Столбцовое хранилище параметров аппроксимированных эллипсов. Условие по площади выполняется двоичным
+    поиском по отсортированному индексу, остальные - векторными масками над кандидатами. Ошибки аппроксимации и
+    площади контуров заполняются по мере надобности только для эллипсов, прошедших более дешевые условия"""
+
+    def __init__(self, ellipses):
+        self.ellipses = ellipses
+        self.count = len(ellipses)
+
+        axes = np.array([ellipse['axes'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 2)
+        self.axis_a = axes[:, 0]
+        self.axis_b = axes[:, 1]
+        self.ellipse_area = np.array([ellipse['ellipse_area'] for ellipse in ellipses], dtype=np.float64)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.aspect_ratio = np.maximum(self.axis_a, self.axis_b) / np.minimum(self.axis_a, self.axis_b)
+
+        self.contour_area = np.full(self.count, np.nan)
+        self.area_in_bounds = np.full(self.count, np.nan)
+        self.errors = {}
+        self.known_errors = {}
+        self.area_index = get_sorted_index(self.ellipse_area)
+
+    def get_missing_errors(self, error_method, indices):
+        """Индексы эллипсов из indices, ошибки которых указанным методом еще не заданы"""
+        if error_method not in self.errors:
+            self.errors[error_method] = np.full(self.count, np.nan)
+            self.known_errors[error_method] = np.zeros(self.count, dtype=bool)
+
+        return indices[~self.known_errors[error_method][indices]]
+
+    def set_errors(self, error_method, indices, errors):
+        self.get_missing_errors(error_method, indices)
+        self.errors[error_method][indices] = errors
+        self.known_errors[error_method][indices] = True
+
+    def get_missing_areas(self, indices):
+        """Индексы эллипсов из indices, для которых еще не заданы площадь контура и площадь в границах изображения"""
+        return indices[np.isnan(self.contour_area[indices])]
+
+    def set_areas(self, indices, contour_areas, areas_in_bounds):
+        self.contour_area[indices] = contour_areas
+        self.area_in_bounds[indices] = areas_in_bounds
+
+    def get_min_area_candidates(self, min_area):
+        """Индексы эллипсов с площадью не меньше min_area, найденные двоичным поиском"""
+        order, sorted_area = self.area_index
+
+        return order[np.searchsorted(sorted_area, min_area, side='left'):]
+
+    def get_aspect_ratio_mask(self, indices, max_aspect_ratio):
+        """Маска эллипсов с отношением полуосей не больше max_aspect_ratio (0 - без ограничения)"""
+        if max_aspect_ratio <= 0:
+            return np.ones(len(indices), dtype=bool)
+
+        return ((self.axis_a[indices] != 0) & (self.axis_b[indices] != 0) &
+                ~(self.aspect_ratio[indices] > max_aspect_ratio))
+
+    def get_shape_candidates(self, min_area, max_aspect_ratio):
+        """Индексы эллипсов, удовлетворяющих условиям на площадь и отношение полуосей. Для проверки этих условий
+        нужны только параметры эллипсов, поэтому они проверяются первыми"""
+        indices = self.get_min_area_candidates(min_area)
+
+        return indices[self.get_aspect_ratio_mask(indices, max_aspect_ratio)]
+
+    def get_error_mask(self, indices, error_method, max_error):
+        """Маска эллипсов с ошибкой не больше max_error или неопределенной ошибкой"""
+        return ~(self.errors[error_method][indices] > max_error)
+
+    def get_area_error_mask(self, indices, area_error):
+        """Маска эллипсов, площадь которых в границах изображения отличается от площади контура не больше чем
+        на долю area_error (0 - без ограничения)"""
+        if area_error <= 0:
+            return np.ones(len(indices), dtype=bool)
+
+        contour_area = self.contour_area[indices]
+        area_in_bounds = self.area_in_bounds[indices]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            area_diff = np.abs(contour_area - area_in_bounds) / contour_area
+
+        return (contour_area != 0) & (area_in_bounds != 0) & ~(area_diff > area_error)
+
+    def get_valid_indices(self, error_method, max_error, min_area, max_aspect_ratio, area_error):
+        """Возвращает индексы эллипсов, удовлетворяющих всем параметрам фильтрации. Ошибки кандидатов (и площади,
+        если задан area_error) должны быть заданы заранее"""
+        indices = self.get_shape_candidates(min_area, max_aspect_ratio)
+        indices = indices[self.get_error_mask(indices, error_method, max_error)]
+        indices = indices[self.get_area_error_mask(indices, area_error)]
+
+        return np.sort(indices)
@@ -0,0 +1,57 @@
+import numpy as np
+from defaults import MATCH_CENTER_TOLERANCE, MATCH_MIN_CENTER_DISTANCE, MATCH_AXES_TOLERANCE
+
+
+def get_ellipse_arrays(ellipses):
+    """Возвращает центры (N, 2) и упорядоченные по убыванию полуоси (N, 2) эллипсов"""
+    centers = np.array([ellipse['center'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 2)
+    axes = np.sort(np.array([ellipse['axes'] for ellipse in ellipses], dtype=np.float64).reshape(-1, 2), axis=1)
+
+    return centers, axes[:, ::-1]
+
+
+def match_ellipses(detected, truth):
+    """Сопоставляет найденные эллипсы известным один к одному. Пара допустима, если центры и обе полуоси
+    отличаются не больше чем на MATCH_CENTER_TOLERANCE и MATCH_AXES_TOLERANCE, из допустимых пар жадно выбираются
+    пары с ближайшими центрами. Возвращает список пар (номер найденного, номер известного)"""
+    if not detected or not truth:
+        return []
+
+    detected_centers, detected_axes = get_ellipse_arrays(detected)
+    truth_centers, truth_axes = get_ellipse_arrays(truth)
+
+    distances = np.hypot(*(detected_centers[:, None, :] - truth_centers[None, :, :]).transpose(2, 0, 1))
+    max_distances = np.maximum(MATCH_CENTER_TOLERANCE * truth_axes[:, 0], MATCH_MIN_CENTER_DISTANCE)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        axes_errors = np.abs(detected_axes[:, None, :] - truth_axes[None, :, :]) / truth_axes[None, :, :]
+
+    feasible = (distances <= max_distances[None, :]) & np.all(axes_errors <= MATCH_AXES_TOLERANCE, axis=2)
+    detected_indices, truth_indices = np.nonzero(feasible)
+    order = np.argsort(distances[detected_indices, truth_indices], kind='stable')
+
+    matches = []
+    used_detected, used_truth = set(), set()
+    for i, j in zip(detected_indices[order].tolist(), truth_indices[order].tolist()):
+        if i not in used_detected and j not in used_truth:
+            used_detected.add(i)
+            used_truth.add(j)
+            matches.append((i, j))
+
+    return matches
+
+
+def evaluate_detection(detected, truth):
+    """Возвращает полноту, точность и F1-меру поиска эллипсов по известным эллипсам"""
+    true_positives = len(match_ellipses(detected, truth))
+    recall = true_positives / len(truth) if truth else 1.0
+    precision = true_positives / len(detected) if detected else 1.0
+    f1 = 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0.0
+
+    return {
+        'true_positives': true_positives,
+        'detected': len(detected),
+        'truth': len(truth),
+        'recall': recall,
+        'precision': precision,
+        'f1': f1,
+    }
@@ -2,9 +2,12 @@ import os
 from tkinter import filedialog, messagebox
 from ttkthemes import ThemedStyle
 from ellipse_detector import EllipseDetector
+from detection_worker import DetectionWorker
 from defaults import *
 from utils import get_supported_formats, save_image
 from parameter_manager import ParameterManager
+from parameter_store import ParameterStore
+from profiling import PROFILE_MODES
 from gui_helper import *
 
 
@@ -17,6 +20,8 @@ class EllipseDetectorApp(tk.Tk):
         self.maxsize(MAX_WINDOW_WIDTH, MAX_WINDOW_HEIGHT)
 
         self.detector = None
+        self.detection_worker = None
+        self.poll_job = None
         self.image_windows = {}
         self.current_result_image = None
 
@@ -157,6 +162,10 @@ class EllipseDetectorApp(tk.Tk):
         contour_var = self.param_manager.get_parameter_var('contour_method')
         create_radio_buttons(contour_frame, contour_var,
                              contour_options, self.param_manager.create_change_handler('contour_method'))
+        create_checkboxes(contour_frame, [
+            ('Разбивать на дуги', self.param_manager.get_parameter_var('arc_segmentation'),
+             self.param_manager.create_change_handler('arc_segmentation'))
+        ])
 
         self.create_filter_parameters(params_frame)
 
@@ -188,8 +197,18 @@ class EllipseDetectorApp(tk.Tk):
                 pass
         self.image_windows = {}
 
+    def stop_detection_worker(self):
+        if self.poll_job:
+            self.after_cancel(self.poll_job)
+            self.poll_job = None
+
+        if self.detection_worker:
+            self.detection_worker.stop()
+            self.detection_worker = None
+
     def reset_app_state(self):
         self.close_image_windows()
+        self.stop_detection_worker()
 
         self.detector = None
         self.current_result_image = None
@@ -216,7 +235,16 @@ class EllipseDetectorApp(tk.Tk):
         window.protocol('WM_DELETE_WINDOW', on_window_close)
         label = ttk.Label(window)
         label.pack()
-        return {'window': window, 'label': label}
+
+        # source - отображаемое изображение OpenCV, pending - изображение, полученное, пока окно было свернуто
+        window_data = {'window': window, 'label': label, 'photo': None, 'source': None, 'pending': None}
+
+        def on_window_map(event):
+            if event.widget is window and window_data['pending'] is not None:
+                self.show_window_image(window_data, window_data['pending'])
+
+        window.bind('<Map>', on_window_map)
+        return window_data
 
     def create_image_windows(self):
         self.close_image_windows()
@@ -240,47 +268,81 @@ class EllipseDetectorApp(tk.Tk):
             key_map = {'Итоговое': 'Result', 'Обработанное': 'Processed', 'Границы': 'Edges'}
             self.image_windows[key_map.get(key)] = window_data
 
+    def show_window_image(self, window_data, cv_img):
+        """Отображает изображение в окне, по возможности копируя его в уже созданный PhotoImage"""
+        photo = cv2_to_tkimage(cv_img, window_data['photo'])
+        if photo is not window_data['photo']:
+            window_data['label'].config(image=photo)
+            window_data['photo'] = photo
+
+        window_data['source'] = cv_img
+        window_data['pending'] = None
+
     def update_image_window(self, name, cv_img):
+        """Обновляет изображение в окне, только если оно изменилось. Результаты предобработки берутся из кэша
+        этапов, поэтому неизменившееся изображение - тот же объект. В свернутом или скрытом окне изображение
+        только запоминается и отображается, когда окно будет развернуто"""
         try:
             window_data = self.image_windows.get(name)
-            if window_data and window_data['window'].winfo_exists():
-                img = cv2_to_tkimage(cv_img)
-                window_data['label'].config(image=img)
-                window_data['label'].image = img
+            if not window_data or not window_data['window'].winfo_exists():
+                return
+
+            if window_data['window'].state() in ('iconic', 'withdrawn'):
+                window_data['pending'] = None if cv_img is window_data['source'] else cv_img
+            elif cv_img is not window_data['source']:
+                self.show_window_image(window_data, cv_img)
         except tk.TclError:
             if name in self.image_windows:
                 del self.image_windows[name]
 
-    def update_images(self):
-        if not self.detector or self.detector.image is None:
+    def update_images(self, categories=(), clear_cache=False):
+        """Запрашивает обработку изображения с текущими параметрами в фоновом потоке"""
+        if not self.detection_worker:
             return
 
-        try:
-            results = self.detector.find_ellipses()
-            ellipses = results['ellipses']
-            contours = results['contours']
-            thresholded = results['thresholded']
-            edges = results['edges']
+        self.detection_worker.submit(self.param_manager.get_all(), categories, clear_cache)
 
-            self.ellipse_count_label.config(text=f"Найдено эллипсов: {len(ellipses)}")
+    def poll_detection_results(self):
+        """Периодически забирает результаты фоновой обработки и отображает последний из них"""
+        if not self.detection_worker:
+            return
 
-            self.current_result_image = self.detector.draw_results(
-                self.detector.image.copy(), ellipses, contours
-            )
+        results = self.detection_worker.get_latest_result()
+        if results:
+            self.show_results(results)
 
-            images = {'Result': self.current_result_image, 'Processed': thresholded, 'Edges': edges}
-            for name, img in images.items():
-                self.update_image_window(name, img)
+        self.poll_job = self.after(DETECTION_POLL_INTERVAL, self.poll_detection_results)
 
-        except Exception as e:
-            messagebox.showerror('Ошибка', f"Ошибка обработки изображения:\n{str(e)}")
+    def show_results(self, results):
+        if 'error' in results:
+            messagebox.showerror('Ошибка', f"Ошибка обработки изображения:\n{results['error']}")
+            return
+
+        self.ellipse_count_label.config(text=f"Найдено эллипсов: {len(results['ellipses'])}")
+        self.current_result_image = results['result_image']
+
+        report = results.get('report')
+        if report is not None:
+            self.status_bar.config(text=report.format_status())
+            if report.profile:
+                show_text_window(self, 'Профиль запуска', report.profile)
+
+        images = {'Result': self.current_result_image, 'Processed': results['thresholded'],
+                  'Edges': results['edges']}
+        for name, img in images.items():
+            if img is not None:
+                self.update_image_window(name, img)
 
     def create_detector(self, image_path):
         try:
-            self.detector = EllipseDetector(image_path, self.param_manager)
+            self.stop_detection_worker()
+            self.detector = EllipseDetector(image_path, ParameterStore())
             self.param_manager.reset_all_parameters()
             self.create_image_windows()
+
+            self.detection_worker = DetectionWorker(self.detector)
             self.update_images()
+            self.poll_detection_results()
             self.status_bar.config(text=f"Загружено изображение: {os.path.basename(image_path)}")
         except Exception as e:
             messagebox.showerror('Ошибка', f"Не удалось загрузить изображение! \n{str(e)}")
@@ -314,6 +376,15 @@ class EllipseDetectorApp(tk.Tk):
             else:
                 messagebox.showinfo('Сохранение', 'Файл сохранён!')
 
+    def profile_next_run(self):
+        if not self.detector:
+            messagebox.showwarning('Предупреждение', 'Загрузите изображение!')
+            return
+
+        self.detector.request_profile(self.profile_mode.get())
+        self.update_images()
+        self.status_bar.config(text='Профилирование запуска...')
+
     def reset_to_defaults(self):
         if not self.detector:
             messagebox.showwarning('Предупреждение', 'Загрузите изображение!')
@@ -322,9 +393,7 @@ class EllipseDetectorApp(tk.Tk):
         for param_name, config in self.param_manager.parameter_configs.items():
             self.param_manager.set_value(param_name, config['default'])
 
-        self.detector.clear_cache()
-
-        self.update_images()
+        self.update_images(clear_cache=True)
         self.status_bar.config(text='Параметры сброшены к значениям по умолчанию')
 
     def setup_common_controls(self, parent):
@@ -340,6 +409,15 @@ class EllipseDetectorApp(tk.Tk):
         for text, command in buttons:
             ttk.Button(buttons_frame, text=text, command=command).pack(side=tk.LEFT, padx=5)
 
+        profile_frame = ttk.Frame(parent)
+        profile_frame.pack(fill=tk.X)
+
+        self.profile_mode = tk.StringVar(value=PROFILE_MODES[0])
+        ttk.Combobox(profile_frame, textvariable=self.profile_mode, values=PROFILE_MODES, state='readonly',
+                     width=12).pack(side=tk.LEFT, padx=5)
+        ttk.Button(profile_frame, text='Профилировать запуск', command=self.profile_next_run).pack(side=tk.LEFT,
+                                                                                                 padx=5)
+
         self.status_bar = ttk.Label(parent, text='Готово к работе', relief=tk.SUNKEN, anchor=tk.W)
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
 
@@ -372,13 +450,13 @@ class EllipseDetectorApp(tk.Tk):
 
     def on_close(self):
         self.close_image_windows()
+        self.stop_detection_worker()
         self.destroy()
 
     def parameter_changed(self, param_name):
         if self.detector:
             category = self.param_manager.get_parameter_category(param_name)
-            self.detector.update_cache(category)
-            self.update_images()
+            self.update_images([category])
 
 
 def run_app():
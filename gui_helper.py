@@ -4,9 +4,15 @@ from PIL import Image, ImageTk
 from utils import convert_bgr_to_rgb
 
 
-def cv2_to_tkimage(cv_image):
-    rgb_img = convert_bgr_to_rgb(cv_image)
-    return ImageTk.PhotoImage(Image.fromarray(rgb_img))
+def cv2_to_tkimage(cv_image, photo=None):
+    """Преобразует изображение OpenCV в PhotoImage. Если задан photo того же размера, изображение копируется в
+    него, и новый PhotoImage не создается"""
+    image = Image.fromarray(convert_bgr_to_rgb(cv_image))
+    if photo is not None and (photo.width(), photo.height()) == image.size:
+        photo.paste(image)
+        return photo
+
+    return ImageTk.PhotoImage(image)
 
 
 def create_labeled_frame(parent, text):
@@ -83,3 +89,19 @@ def create_filter_section(parent, title, enabled_var, before_gray_var,
             )
 
         params_frame.columnconfigure(1, weight=1)
+
+
+def show_text_window(parent, title, text):
+    window = tk.Toplevel(parent)
+    window.title(title)
+
+    text_widget = tk.Text(window, wrap=tk.NONE, width=120, height=40)
+    scrollbar = ttk.Scrollbar(window, orient=tk.VERTICAL, command=text_widget.yview)
+    text_widget.configure(yscrollcommand=scrollbar.set)
+    scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+    text_widget.pack(fill=tk.BOTH, expand=True)
+
+    text_widget.insert('1.0', text)
+    text_widget.configure(state=tk.DISABLED)
+
+    return window
@@ -1,7 +1,9 @@
+import time
 import cv2
 import numpy as np
 from defaults import *
-from utils import validate_kernel_size
+from profiling import add_time, count, timed
+from utils import validate_kernel_size, LRUCache
 
 
 def find_edges(image, aperture_size):
@@ -51,82 +53,160 @@ def get_threshold_image(image, threshold_value):
     return thresholded
 
 
+def convert_to_gray(image):
+    """Преобразует цветное изображение в оттенки серого"""
+    if image.ndim == 2:
+        return image
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+
+def get_bilateral_params(params, is_before_gray):
+    if params['bilateral_enabled'] and params['bilateral_before_gray'] == is_before_gray:
+        return params['bilateral_kernel_size'], params['sigma_color'], params['sigma_space']
+
+    return None
+
+
+def get_gaussian_params(params, is_before_gray):
+    if params['gaussian_blur_enabled'] and params['gaussian_before_gray'] == is_before_gray:
+        return params['gaussian_kernel_size'], params['gaussian_sigma_x'], params['gaussian_sigma_y']
+
+    return None
+
+
+def get_median_params(params, is_before_gray):
+    if params['median_blur_enabled'] and params['median_before_gray'] == is_before_gray:
+        return params['median_kernel_size'],
+
+    return None
+
+
+def get_morphology_params(params):
+    if params['erode'] or params['dilate']:
+        return params['morph_kernel'], params['morph_iterations'], params['erode'], params['dilate']
+
+    return None
+
+
+# Этапы предобработки в порядке применения: название, функция получения параметров этапа из снимка параметров
+# предобработки (None - этап пропускается) и функция обработки
+PREPROCESSING_STAGES = [
+    ('bilateral_before_gray', lambda params: get_bilateral_params(params, True), apply_bilateral_filter),
+    ('gaussian_before_gray', lambda params: get_gaussian_params(params, True), apply_gaussian_blur),
+    ('median_before_gray', lambda params: get_median_params(params, True), apply_median_blur),
+    ('gray', lambda params: (), convert_to_gray),
+    ('bilateral_after_gray', lambda params: get_bilateral_params(params, False), apply_bilateral_filter),
+    ('gaussian_after_gray', lambda params: get_gaussian_params(params, False), apply_gaussian_blur),
+    ('median_after_gray', lambda params: get_median_params(params, False), apply_median_blur),
+    ('morphology', get_morphology_params, apply_morphological_operations),
+    ('threshold', lambda params: (params['threshold'],), get_threshold_image),
+    ('edges', lambda params: (params['aperture_size'],), find_edges),
+]
+
+
+def has_filters_before_gray(params):
+    """Проверяет, выполняется ли хотя бы один фильтр до преобразования в оттенки серого (то есть нужен ли для
+    предобработки цвет)"""
+    return any(get_params(params, True) is not None
+               for get_params in (get_bilateral_params, get_gaussian_params, get_median_params))
+
+
+def get_preprocessing_margin(params):
+    """Возвращает расстояние (в пикселях), на котором результат предобработки зависит от соседних пикселей: сумму
+    радиусов всех включенных фильтров. Дальше этого расстояния от края фрагмента изображения результат его
+    предобработки совпадает с предобработкой всего изображения"""
+    margin = 0
+    for is_before_gray in (True, False):
+        for get_params in (get_bilateral_params, get_gaussian_params, get_median_params):
+            stage_params = get_params(params, is_before_gray)
+            if stage_params is not None:
+                margin += validate_kernel_size(stage_params[0]) // 2
+
+    morphology_params = get_morphology_params(params)
+    if morphology_params is not None:
+        kernel_size, iterations, erode, dilate = morphology_params
+        margin += validate_kernel_size(kernel_size) // 2 * iterations * (bool(erode) + bool(dilate))
+
+    # Оператор Собеля и подавление немаксимумов в методе Кэнни. Гистерезис не распространяется дальше, так как
+    # на бинарном изображении все перепады яркости дают градиент выше CANNY_HIGH_THRESHOLD
+    margin += params['aperture_size'] // 2 + 1
+
+    return margin
+
+
+def apply_preprocessing_stages(image, params):
+    """Выполняет все этапы предобработки без кэширования (например, для фрагмента изображения) и возвращает
+    бинарное изображение и изображение с границами объектов"""
+    outputs = {}
+    for name, get_params, stage_function in PREPROCESSING_STAGES:
+        stage_params = get_params(params)
+        if stage_params is not None:
+            image = stage_function(image, *stage_params)
+            outputs[name] = image
+
+    return outputs['threshold'], outputs['edges']
+
+
 class ImagePreprocessor:
+    """Выполняет предобработку изображения по этапам. Результат каждого этапа кэшируется по параметрам этого и
+    всех предшествующих этапов, поэтому при изменении параметра пересчитываются только последующие этапы"""
+
     def __init__(self, param_manager):
         self.param_manager = param_manager
-        self.cached_processed_images = {}
-        self.cached_params = {}
-
-    def are_params_changed(self):
-        preprocessing_params = self.param_manager.get_parameters_by_category('preprocessing')
-
-        for param_name in preprocessing_params:
-            current_value = self.param_manager.get_value(param_name)
-            cached_value = self.cached_params.get(param_name)
-            
-            if current_value != cached_value:
-                return True
-        
-        return False
-
-    def apply_filters(self, image, is_before_gray):
-        """Применяет к изображению фильтры, для которых флаг о порядке применения равен is_before_gray"""
-        current_image = image.copy()
-
-        if (self.param_manager.get_value('bilateral_enabled') and
-                self.param_manager.get_value('bilateral_before_gray') == is_before_gray):
-            current_image = apply_bilateral_filter(
-                current_image,
-                self.param_manager.get_value('bilateral_kernel_size'),
-                self.param_manager.get_value('sigma_color'),
-                self.param_manager.get_value('sigma_space')
-            )
-
-        if (self.param_manager.get_value('gaussian_blur_enabled') and
-                self.param_manager.get_value('gaussian_before_gray') == is_before_gray):
-            current_image = apply_gaussian_blur(
-                current_image,
-                self.param_manager.get_value('gaussian_kernel_size'),
-                self.param_manager.get_value('gaussian_sigma_x'),
-                self.param_manager.get_value('gaussian_sigma_y')
-            )
-
-        if (self.param_manager.get_value('median_blur_enabled') and
-                self.param_manager.get_value('median_before_gray') == is_before_gray):
-            current_image = apply_median_blur(
-                current_image,
-                self.param_manager.get_value('median_kernel_size')
-            )
-
-        return current_image
-
+        self.source_image = None
+        self.stage_cache = LRUCache(PREPROCESSING_CACHE_SIZE)
+        self.stage_statistics = {name: {'hits': 0, 'misses': 0} for name, _, _ in PREPROCESSING_STAGES}
+
+    def get_stage_statistics(self):
+        """Возвращает количество попаданий и промахов кэша для каждого этапа"""
+        return {name: dict(statistics) for name, statistics in self.stage_statistics.items()}
+
+    def get_stage_keys(self, params):
+        """Возвращает ключи кэша для выполняемых этапов: каждый ключ включает параметры всех предыдущих этапов"""
+        stage_keys = {}
+        key = ()
+        for name, get_params, _ in PREPROCESSING_STAGES:
+            stage_params = get_params(params)
+            if stage_params is not None:
+                key += ((name, stage_params),)
+                stage_keys[name] = key
+
+        return stage_keys
+
+    def get_stage_output(self, image, stage_keys, name):
+        """Возвращает результат этапа из кэша или вычисляет его, при необходимости вычисляя предыдущие этапы"""
+        key = stage_keys[name]
+        cached_image = self.stage_cache.get(key)
+        if cached_image is not None:
+            self.stage_statistics[name]['hits'] += 1
+            count('preprocess_cache_hits')
+            return cached_image
+
+        self.stage_statistics[name]['misses'] += 1
+        count('preprocess_cache_misses')
+
+        (_, stage_params), previous_key = key[-1], key[:-1]
+        input_image = self.get_stage_output(image, stage_keys, previous_key[-1][0]) if previous_key else image
+
+        stage_function = next(function for stage_name, _, function in PREPROCESSING_STAGES if stage_name == name)
+        start_time = time.perf_counter()
+        output_image = stage_function(input_image, *stage_params)
+        add_time(f"preprocess:{name}", time.perf_counter() - start_time)
+        self.stage_cache.put(key, output_image)
+
+        return output_image
+
+    @timed('preprocess_image')
     def preprocess_image(self, image):
         """Основная функция предобработки изображения"""
-        if not self.are_params_changed():
-            return (self.cached_processed_images['thresholded'],
-                    self.cached_processed_images['edges'])
-        
-        self.cached_processed_images.clear()
-        self.cached_params = self.param_manager.get_all()
-        
-        current_image = image.copy()
-
-        current_image = self.apply_filters(current_image, True)
-        current_image = cv2.cvtColor(current_image, cv2.COLOR_BGR2GRAY)
-        current_image = self.apply_filters(current_image, False)
-
-        current_image = apply_morphological_operations(
-            current_image,
-            self.param_manager.get_value('morph_kernel'),
-            self.param_manager.get_value('morph_iterations'),
-            self.param_manager.get_value('erode'),
-            self.param_manager.get_value('dilate')
-        )
-
-        thresholded = get_threshold_image(current_image, self.param_manager.get_value('threshold'))
-        edges = find_edges(thresholded, self.param_manager.get_value('aperture_size'))
-
-        self.cached_processed_images['thresholded'] = thresholded
-        self.cached_processed_images['edges'] = edges
+        if image is not self.source_image:
+            self.stage_cache.clear()
+            self.source_image = image
+
+        stage_keys = self.get_stage_keys(self.param_manager.get_snapshot('preprocessing'))
+
+        thresholded = self.get_stage_output(image, stage_keys, 'threshold')
+        edges = self.get_stage_output(image, stage_keys, 'edges')
 
         return thresholded, edges
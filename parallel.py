@@ -0,0 +1,150 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from defaults import FIT_WORKERS, FIT_CHUNK_POINTS, FIT_PARALLEL_MIN_POINTS
+from ellipse_math import calculate_errors, fit_ellipses
+from profiling import count
+
+
+def get_chunks(offsets, point_count, chunk_points=FIT_CHUNK_POINTS):
+    """Делит наборы точек на порции примерно по chunk_points точек, не разрезая наборы. Возвращает пары
+    (первый набор, следующий за последним). Деление зависит только от данных, а не от числа процессов"""
+    if len(offsets) == 0:
+        return []
+
+    bounds = np.searchsorted(offsets, np.arange(chunk_points, point_count, chunk_points), side='left')
+    bounds = np.unique(np.concatenate([[0], bounds, [len(offsets)]]))
+
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+class SharedPoints:
+    """Координаты точек всех наборов и смещения наборов в одном блоке общей памяти, доступном процессам пула"""
+
+    def __init__(self, x, y, offsets):
+        self.point_count = len(x)
+        self.set_count = len(offsets)
+        self.memory = shared_memory.SharedMemory(create=True, size=max(self.get_size(), 1))
+
+        shared_x, shared_y, shared_offsets = get_shared_arrays(self.memory, self.point_count, self.set_count)
+        shared_x[:] = x
+        shared_y[:] = y
+        shared_offsets[:] = offsets
+
+    def get_size(self):
+        return 16 * self.point_count + 8 * self.set_count
+
+    def get_descriptor(self):
+        return self.memory.name, self.point_count, self.set_count
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def get_shared_arrays(memory, point_count, set_count):
+    """Возвращает массивы x, y и смещений, лежащие в блоке общей памяти"""
+    x = np.ndarray(point_count, dtype=np.float64, buffer=memory.buf)
+    y = np.ndarray(point_count, dtype=np.float64, buffer=memory.buf, offset=8 * point_count)
+    offsets = np.ndarray(set_count, dtype=np.int64, buffer=memory.buf, offset=16 * point_count)
+
+    return x, y, offsets
+
+
+def call_on_chunk(memory, point_count, set_count, chunk, function):
+    """Вызывает function(x, y, offsets) для точек порции наборов chunk, лежащих в блоке общей памяти"""
+    x, y, offsets = get_shared_arrays(memory, point_count, set_count)
+    first, last = chunk
+    start = offsets[first]
+    end = offsets[last] if last < set_count else point_count
+
+    return function(x[start:end], y[start:end], offsets[first:last] - start)
+
+
+def get_chunk_points(descriptor, chunk, function):
+    """Подключается к общей памяти в процессе пула и вызывает function для точек порции наборов chunk"""
+    name, point_count, set_count = descriptor
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        return call_on_chunk(memory, point_count, set_count, chunk, function)
+    finally:
+        memory.close()
+
+
+def fit_chunk(descriptor, chunk):
+    return get_chunk_points(descriptor, chunk, fit_ellipses)
+
+
+def calculate_errors_chunk(descriptor, chunk, error_method, coefficients, centers, axes, angles):
+    return get_chunk_points(descriptor, chunk, lambda x, y, offsets: calculate_errors(
+        error_method, coefficients, centers, axes, angles, x, y, offsets))
+
+
+class ParallelFitter:
+    """Аппроксимация и вычисление ошибок для больших наборов контуров в пуле процессов. Точки передаются через
+    общую память, а процессы возвращают только массивы результатов для своих порций наборов. Каждый набор
+    обрабатывается независимо от остальных, поэтому результаты не зависят от числа процессов. Небольшие наборы
+    (меньше FIT_PARALLEL_MIN_POINTS точек) и workers = 1 обрабатываются в текущем процессе"""
+
+    def __init__(self, workers=FIT_WORKERS):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = None
+
+    def is_parallel(self, point_count):
+        return self.workers > 1 and point_count >= FIT_PARALLEL_MIN_POINTS
+
+    def get_executor(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        return self.executor
+
+    def map_chunks(self, function, x, y, offsets, get_chunk_args):
+        """Вызывает function(descriptor, chunk, *get_chunk_args(first, last)) для всех порций в пуле процессов и
+        возвращает результаты в порядке порций"""
+        chunks = get_chunks(offsets, len(x))
+        count('parallel_chunks', len(chunks))
+
+        with SharedPoints(x, y, offsets) as points:
+            descriptor = points.get_descriptor()
+            futures = [self.get_executor().submit(function, descriptor, chunk, *get_chunk_args(*chunk))
+                       for chunk in chunks]
+
+            return [future.result() for future in futures]
+
+    def fit_ellipses(self, x, y, offsets):
+        """То же, что fit_ellipses, но для большого числа точек - в пуле процессов"""
+        if not self.is_parallel(len(x)):
+            return fit_ellipses(x, y, offsets)
+
+        results = self.map_chunks(fit_chunk, x, y, offsets, lambda first, last: ())
+        coefficients, centers, axes, angles, valid = [np.concatenate(column) for column in zip(*results)]
+
+        count('fits_attempted', len(offsets))
+        count('fits_rejected', int(np.count_nonzero(~valid)))
+
+        return coefficients, centers, axes, angles, valid
+
+    def calculate_errors(self, error_method, coefficients, centers, axes, angles, x, y, offsets):
+        """То же, что calculate_errors, но для большого числа точек - в пуле процессов"""
+        if not self.is_parallel(len(x)):
+            return calculate_errors(error_method, coefficients, centers, axes, angles, x, y, offsets)
+
+        results = self.map_chunks(
+            calculate_errors_chunk, x, y, offsets,
+            lambda first, last: (error_method, coefficients[first:last], centers[first:last], axes[first:last],
+                                 angles[first:last]))
+
+        return np.concatenate(results)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -1,12 +1,15 @@
 import tkinter as tk
-from defaults import CONFIGURABLE_PARAMS
+from parameter_store import ParameterStore
 from utils import validate_kernel_size
 
 
-class ParameterManager:
+class ParameterManager(ParameterStore):
+    """Связывает значения параметров из ParameterStore с переменными Tk для элементов интерфейса. Значения
+    читаются из хранилища без обращения к Tcl, а изменения переменных Tk переносятся в хранилище"""
+
     def __init__(self, app=None):
+        super().__init__()
         self.app = app
-        self.parameter_configs = CONFIGURABLE_PARAMS
         self.parameter_vars = {}
         self.init_parameter_vars()
 
@@ -22,21 +25,21 @@ class ParameterManager:
             else:
                 var = tk.StringVar(value=default)
 
+            var.trace_add('write', self.create_var_trace(name, var))
             self.parameter_vars[name] = var
 
-    def get_value(self, name):
-        var = self.parameter_vars.get(name)
-        return var.get()
-
-    def set_value(self, name, value):
-        var = self.parameter_vars.get(name)
-        var.set(value)
+    def create_var_trace(self, name, var):
+        def trace(*args):
+            try:
+                ParameterStore.set_value(self, name, var.get())
+            except (tk.TclError, ValueError):
+                pass
 
-    def get_all(self):
-        return {name: var.get() for name, var in self.parameter_vars.items()}
+        return trace
 
-    def get_parameters_by_category(self, category):
-        return [name for name, config in self.parameter_configs.items() if config['category'] == category]
+    def set_value(self, name, value):
+        super().set_value(name, value)
+        self.parameter_vars[name].set(self.get_value(name))
 
     def get_parameter_var(self, name):
         return self.parameter_vars.get(name)
@@ -74,9 +77,8 @@ class ParameterManager:
         if not self.app.detector:
             return
 
-        for param_name, var in self.parameter_vars.items():
-            default_value = self.parameter_configs[param_name]['default']
-            var.set(default_value)
+        for param_name, config in self.parameter_configs.items():
+            self.set_value(param_name, config['default'])
     
     def get_filter_parameters(self):
         filter_params = []
@@ -90,6 +92,3 @@ class ParameterManager:
                 ))
 
         return filter_params
-
-    def get_parameter_category(self, param_name):
-        return self.parameter_configs[param_name].get('category')
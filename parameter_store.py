@@ -0,0 +1,103 @@
+import json
+from defaults import CONFIGURABLE_PARAMS
+
+
+def convert_parameter_value(config, value):
+    """Приводит значение параметра к типу, указанному в его описании"""
+    if config['type'] == 'boolean':
+        return bool(value)
+    elif config['type'] == 'int':
+        return int(value)
+    elif config['type'] == 'double':
+        return float(value)
+
+    return str(value)
+
+
+def load_parameters(path):
+    """Загружает значения параметров из JSON-файла"""
+    with open(path, 'r', encoding='utf-8') as f:
+        values = json.load(f)
+
+    if not isinstance(values, dict):
+        raise ValueError('Файл параметров должен содержать JSON-объект')
+
+    return values
+
+
+class ParameterSnapshot:
+    """Неизменяемый снимок значений параметров. Снимки можно сравнивать между собой и использовать как ключи
+    кэша"""
+
+    def __init__(self, values):
+        self.items = tuple(sorted(values.items()))
+        self.values = dict(self.items)
+        self.hash = hash(self.items)
+
+    def __eq__(self, other):
+        return isinstance(other, ParameterSnapshot) and self.items == other.items
+
+    def __hash__(self):
+        return self.hash
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __repr__(self):
+        return f"ParameterSnapshot({self.values!r})"
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def get_all(self):
+        return dict(self.values)
+
+
+class ParameterStore:
+    """Хранилище значений настраиваемых параметров, не зависящее от Tk"""
+
+    def __init__(self, values=None):
+        self.parameter_configs = CONFIGURABLE_PARAMS
+        self.values = {name: config['default'] for name, config in self.parameter_configs.items()}
+        self.cached_snapshots = {}
+
+        if values:
+            self.update(values)
+
+    def get_value(self, name):
+        return self.values[name]
+
+    def set_value(self, name, value):
+        config = self.parameter_configs.get(name)
+        if config is None:
+            raise KeyError(f"Неизвестный параметр: {name}")
+
+        value = convert_parameter_value(config, value)
+        if self.values[name] != value:
+            self.values[name] = value
+            self.cached_snapshots.pop(config['category'], None)
+            self.cached_snapshots.pop(None, None)
+
+    def update(self, values):
+        for name, value in values.items():
+            self.set_value(name, value)
+
+    def get_all(self):
+        return dict(self.values)
+
+    def get_snapshot(self, category=None):
+        """Возвращает снимок значений параметров указанной категории (или всех параметров). Пока параметры
+        категории не менялись, возвращается один и тот же объект"""
+        snapshot = self.cached_snapshots.get(category)
+        if snapshot is None:
+            names = self.values if category is None else self.get_parameters_by_category(category)
+            snapshot = ParameterSnapshot({name: self.values[name] for name in names})
+            self.cached_snapshots[category] = snapshot
+
+        return snapshot
+
+    def get_parameters_by_category(self, category):
+        return [name for name, config in self.parameter_configs.items() if config['category'] == category]
+
+    def get_parameter_category(self, param_name):
+        return self.parameter_configs[param_name].get('category')
@@ -0,0 +1,147 @@
+import cProfile
+import functools
+import io
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from defaults import PROFILE_TOP_ENTRIES
+
+PROFILE_MODES = ['cprofile', 'tracemalloc']
+
+# Отчет, в который записываются замеры текущего запуска (None - замеры не ведутся)
+active_report = None
+
+
+class RunReport:
+    """Отчет об одном запуске поиска эллипсов: суммарное время по этапам и счетчики событий"""
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.profile = None
+
+    def add_time(self, name, seconds):
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def get_time_ms(self, name):
+        return self.timers.get(name, 0.0) * 1000
+
+    @contextmanager
+    def timer(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_time)
+
+    def to_dict(self):
+        return {
+            'timers_ms': {name: seconds * 1000 for name, seconds in self.timers.items()},
+            'counters': dict(self.counters),
+            'profile': self.profile,
+        }
+
+    def format_status(self):
+        """Краткая сводка для строки состояния"""
+        stages = [('предобработка', 'preprocess_image'), ('контуры', 'find_contours'),
+                  ('аппроксимация', 'fit_contours'), ('ошибки', 'calculate_errors'),
+                  ('фильтрация', 'filter_ellipses'), ('отрисовка', 'draw_results')]
+        stage_times = ', '.join(f"{title} {self.get_time_ms(name):.0f}" for title, name in stages
+                                if name in self.timers)
+        counters = self.counters
+
+        return (f"Поиск: {self.get_time_ms('find_ellipses'):.0f} мс ({stage_times}) | "
+                f"контуров {counters.get('contours', 0)}, "
+                f"аппроксимировано {counters.get('fits_attempted', 0)}, "
+                f"отброшено {counters.get('fits_rejected', 0)}, "
+                f"из кэша {counters.get('fit_cache_hits', 0)}, "
+                f"итераций Ньютона {counters.get('newton_iterations', 0)}")
+
+
+def add_time(name, seconds):
+    """Добавляет время к таймеру текущего отчета (если замеры ведутся)"""
+    if active_report is not None:
+        active_report.add_time(name, seconds)
+
+
+def count(name, value=1):
+    """Увеличивает счетчик текущего отчета (если замеры ведутся)"""
+    if active_report is not None:
+        active_report.count(name, value)
+
+
+@contextmanager
+def timer(name):
+    """Добавляет время выполнения блока к таймеру name текущего отчета"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start_time)
+
+
+def timed(name):
+    """Декоратор, добавляющий время выполнения функции к таймеру name текущего отчета"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            report = active_report
+            if report is None:
+                return function(*args, **kwargs)
+
+            start_time = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                report.add_time(name, time.perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
+
+
+def format_cprofile(profiler):
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(PROFILE_TOP_ENTRIES)
+
+    return stream.getvalue()
+
+
+def format_tracemalloc(snapshot, peak):
+    lines = [f"Пик выделенной памяти: {peak / 1024 / 1024:.1f} МБ"]
+    lines.extend(str(statistic) for statistic in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES])
+
+    return '\n'.join(lines)
+
+
+@contextmanager
+def activate_report(report, profile_mode=None):
+    """Делает отчет текущим на время выполнения блока. При profile_mode 'cprofile' или 'tracemalloc' в отчет
+    дополнительно записывается профиль вызовов или распределение выделенной памяти"""
+    global active_report
+    previous_report = active_report
+    active_report = report
+
+    profiler = None
+    if profile_mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile_mode == 'tracemalloc':
+        tracemalloc.start()
+
+    try:
+        yield report
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            report.profile = format_cprofile(profiler)
+        elif profile_mode == 'tracemalloc':
+            _, peak = tracemalloc.get_traced_memory()
+            report.profile = format_tracemalloc(tracemalloc.take_snapshot(), peak)
+            tracemalloc.stop()
+
+        active_report = previous_report
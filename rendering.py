@@ -0,0 +1,142 @@
+import cv2
+import numpy as np
+from defaults import *
+from ellipse_math import get_ellipse_half_extents
+from profiling import count
+
+
+def is_same_items(first, second):
+    """Проверяет, состоят ли списки из одних и тех же объектов в том же порядке"""
+    return len(first) == len(second) and all(a is b for a, b in zip(first, second))
+
+
+def get_region_pixels(image_shape, region, draw):
+    """Рисует функцией draw(mask, offset) на пустой маске области region = (x0, y0, x1, y1) изображения и
+    возвращает номера закрашенных пикселей во всем изображении. offset переводит координаты изображения в
+    координаты маски. Область обрезается границами изображения, поэтому рисунок, целиком лежащий в области,
+    совпадает с нарисованным на всем изображении"""
+    height, width = image_shape[:2]
+    x0, y0, x1, y1 = region
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if x0 >= x1 or y0 >= y1:
+        return np.empty(0, dtype=np.intp)
+
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    draw(mask, (-x0, -y0))
+    points = cv2.findNonZero(mask)
+    if points is None:
+        return np.empty(0, dtype=np.intp)
+
+    points = points.reshape(-1, 2).astype(np.intp)
+
+    return (points[:, 1] + y0) * width + (points[:, 0] + x0)
+
+
+def get_ellipse_pixels(ellipse, image_shape):
+    """Номера пикселей контура эллипса толщиной ELLIPSE_THICKNESS"""
+    center = (int(ellipse['center'][0]), int(ellipse['center'][1]))
+    axes = (int(ellipse['axes'][0]), int(ellipse['axes'][1]))
+    half_width, half_height = get_ellipse_half_extents(axes, ellipse['angle'])
+    margin = ELLIPSE_THICKNESS + 2
+    region = (int(center[0] - half_width) - margin, int(center[1] - half_height) - margin,
+              int(center[0] + half_width) + margin + 1, int(center[1] + half_height) + margin + 1)
+
+    return get_region_pixels(image_shape, region, lambda mask, offset: cv2.ellipse(
+        mask, (center[0] + offset[0], center[1] + offset[1]), axes, ellipse['angle'], ELLIPSE_START_ANGLE,
+        ELLIPSE_END_ANGLE, 255, ELLIPSE_THICKNESS))
+
+
+def get_fill_pixels(closed_contours, image_shape):
+    """Номера пикселей заливки замкнутых контуров одним вызовом cv2.drawContours: как и при отрисовке на всем
+    изображении, вложенные и пересекающиеся контуры образуют отверстия"""
+    if not closed_contours:
+        return np.empty(0, dtype=np.intp)
+
+    x0, y0, x1, y1 = np.inf, np.inf, -np.inf, -np.inf
+    for closed_contour in closed_contours:
+        x, y, w, h = cv2.boundingRect(closed_contour)
+        x0, y0, x1, y1 = min(x0, x), min(y0, y), max(x1, x + w), max(y1, y + h)
+    region = (int(x0) - 1, int(y0) - 1, int(x1) + 1, int(y1) + 1)
+
+    return get_region_pixels(image_shape, region, lambda mask, offset: cv2.drawContours(
+        mask, closed_contours, -1, 255, FILL_ALL_CONTOURS, offset=offset))
+
+
+def paint_pixels(image, pixels, color):
+    """Закрашивает пиксели изображения с номерами pixels цветом color (для одноканального изображения - первой
+    составляющей цвета, как это делает OpenCV)"""
+    if image.ndim == 2:
+        image.reshape(-1)[pixels] = color[0]
+        return
+
+    # Закраска по каналам выполняется вдвое быстрее, чем присваивание цвета строкам (N, 3)
+    channels = image.reshape(-1, image.shape[2])
+    for channel, value in enumerate(color[:image.shape[2]]):
+        channels[:, channel][pixels] = value
+
+
+class ResultRenderer:
+    """Отрисовка результатов по слоям: заливка контуров эллипсов, все контуры и эллипсы. Слой хранится как номера
+    закрашенных пикселей и перестраивается, только когда меняются его входные данные (сами объекты контуров или
+    эллипсов) или размер изображения. Заливка всех контуров эллипсов рисуется одним вызовом. Пиксели контура
+    каждого эллипса рисуются в его описанном прямоугольнике и хранятся, пока эллипс входит в слой, поэтому после
+    изменения фильтров рисуются только эллипсы, которые еще не отображались. Итоговое изображение собирается из
+    копии исходного закраской пикселей слоев, что совпадает с последовательной отрисовкой сплошными цветами"""
+
+    def __init__(self):
+        self.layers = {}
+        # Пиксели отдельных эллипсов слоев: {слой: {id(эллипс): (эллипс, пиксели)}}. Кэш хранится здесь, а не в
+        # словарях эллипсов, которые живут в кэше аппроксимаций детектора
+        self.item_pixels = {}
+
+    def get_layer(self, name, items, image_shape, get_pixels):
+        """Возвращает номера пикселей слоя name, построенного функцией get_pixels() по списку объектов items"""
+        cached = self.layers.get(name)
+        if cached is not None and cached[0] == image_shape[:2] and is_same_items(cached[1], items):
+            return cached[2]
+
+        count('render_layers_built')
+        pixels = get_pixels()
+        self.layers[name] = (image_shape[:2], list(items), pixels)
+
+        return pixels
+
+    def get_ellipses_layer(self, name, ellipses, image_shape, get_pixels):
+        """Слой из пикселей всех эллипсов. Пиксели эллипса, который уже был в слое при том же размере
+        изображения, берутся из кэша, остальные вычисляются функцией get_pixels(ellipse). В кэше остаются только
+        эллипсы нового слоя"""
+        def get_layer_pixels():
+            cached = self.layers.get(name)
+            previous = self.item_pixels.get(name, {}) if cached is not None and cached[0] == image_shape[:2] else {}
+            current = {}
+            for ellipse in ellipses:
+                item = previous.get(id(ellipse))
+                # Эллипс хранится вместе с пикселями, поэтому его id не может достаться другому объекту
+                if item is None or item[0] is not ellipse:
+                    item = (ellipse, get_pixels(ellipse))
+                current[id(ellipse)] = item
+            self.item_pixels[name] = current
+
+            return np.concatenate([current[id(ellipse)][1] for ellipse in ellipses])
+
+        return self.get_layer(name, ellipses, image_shape, get_layer_pixels)
+
+    def render(self, image, ellipses, contours, fill_contours, show_ellipses, get_closed_contour):
+        """Возвращает изображение с результатами. get_closed_contour(ellipse) возвращает замкнутый на границе
+        контур эллипса для заливки"""
+        result_image = image.copy()
+        shape = image.shape
+
+        if fill_contours and ellipses:
+            paint_pixels(result_image, self.get_layer('fill', ellipses, shape, lambda: get_fill_pixels(
+                [get_closed_contour(ellipse) for ellipse in ellipses], shape)), FILL_COLOR)
+
+        paint_pixels(result_image, self.get_layer('contours', contours, shape, lambda: get_region_pixels(
+            shape, (0, 0, shape[1], shape[0]), lambda mask, offset: cv2.drawContours(
+                mask, contours, -1, 255, CONTOUR_THICKNESS))), CONTOUR_COLOR)
+
+        if show_ellipses and ellipses:
+            paint_pixels(result_image, self.get_ellipses_layer(
+                'ellipse', ellipses, shape, lambda ellipse: get_ellipse_pixels(ellipse, shape)), ELLIPSE_COLOR)
+
+        return result_image
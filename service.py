@@ -0,0 +1,374 @@
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import cv2
+import numpy as np
+from batch import get_ellipse_records
+from defaults import (SERVICE_HOST, SERVICE_PORT, SERVICE_WORKERS, SERVICE_QUEUE_SIZE, SERVICE_MAX_REQUEST_SIZE,
+                      SERVICE_LATENCY_WINDOW)
+from ellipse_detector import EllipseDetector
+from image_preprocessing import has_filters_before_gray
+from parameter_store import ParameterStore, load_parameters
+from utils import decode_image
+
+# Детектор процесса пула: создается один раз при запуске процесса, поэтому модули уже загружены, а кэш
+# аппроксимаций контуров переживает отдельные запросы
+worker_detector = None
+
+
+class ServiceBusy(Exception):
+    """Очередь заданий заполнена"""
+
+
+class ServiceError(Exception):
+    """Ошибка, возвращенная сервисом"""
+
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+        self.message = message
+
+
+def init_worker():
+    global worker_detector
+    worker_detector = EllipseDetector(None, ParameterStore())
+
+
+def get_worker_pid():
+    return os.getpid()
+
+
+def run_detection(image_data, parameters, annotate, full_resolution):
+    """Выполняет задание в процессе пула. Возвращает ответ без изображения, PNG с эллипсами (или None) и время
+    этапов в миллисекундах"""
+    started = time.time()
+    start_time = time.perf_counter()
+    timings = {}
+
+    values = ParameterStore(parameters).get_all()
+    grayscale = not annotate and not has_filters_before_gray(values)
+    image = decode_image(image_data, full_resolution, grayscale)
+    if image is None:
+        raise ValueError('Не удалось декодировать изображение')
+    timings['decode_ms'] = (time.perf_counter() - start_time) * 1000
+
+    detector = worker_detector
+    detector.param_manager.update(values)
+    detector.full_resolution = full_resolution
+    detector.set_image(image)
+
+    stage_time = time.perf_counter()
+    results = detector.find_ellipses()
+    timings['detect_ms'] = (time.perf_counter() - stage_time) * 1000
+
+    report = detector.last_report.to_dict()
+    response = {
+        'ellipses': get_ellipse_records(results['ellipses']),
+        'image_size': [image.shape[1], image.shape[0]],
+        'report': {'timers_ms': report['timers_ms'], 'counters': report['counters']},
+    }
+
+    png_data = None
+    if annotate:
+        stage_time = time.perf_counter()
+        result_image = detector.draw_results(image, results['ellipses'], results['contours'])
+        success, encoded_image = cv2.imencode('.png', result_image)
+        png_data = encoded_image.tobytes() if success else None
+        timings['draw_ms'] = (time.perf_counter() - stage_time) * 1000
+
+    return started, response, png_data, timings
+
+
+class DetectionService:
+    """Очередь заданий поиска эллипсов и пул процессов, которые их выполняют. Одновременно принимается не больше
+    workers + queue_size заданий, остальные запросы сразу отклоняются"""
+
+    def __init__(self, workers=SERVICE_WORKERS, queue_size=SERVICE_QUEUE_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.capacity = self.workers + queue_size
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        self.slots = threading.BoundedSemaphore(self.capacity)
+
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'completed': 0, 'rejected': 0, 'failed': 0, 'in_flight': 0}
+        self.latencies = deque(maxlen=SERVICE_LATENCY_WINDOW)
+        self.start_time = time.time()
+
+    def warm_up(self):
+        """Запускает все процессы пула заранее, чтобы первые запросы не ждали загрузки модулей"""
+        futures = [self.executor.submit(get_worker_pid) for _ in range(self.workers)]
+
+        return sorted({future.result() for future in futures})
+
+    def update_counters(self, **changes):
+        with self.lock:
+            for name, value in changes.items():
+                self.counters[name] += value
+
+    def detect(self, image_data, parameters, annotate=False, full_resolution=False):
+        """Ставит задание в очередь и ждет результата. Если очередь заполнена, выбрасывает ServiceBusy"""
+        self.update_counters(requests=1)
+        if not self.slots.acquire(blocking=False):
+            self.update_counters(rejected=1)
+            raise ServiceBusy('Очередь заданий заполнена')
+
+        submitted = time.time()
+        start_time = time.perf_counter()
+        self.update_counters(in_flight=1)
+        try:
+            future = self.executor.submit(run_detection, image_data, parameters, annotate, full_resolution)
+            started, response, png_data, timings = future.result()
+        except Exception:
+            self.update_counters(failed=1)
+            raise
+        finally:
+            self.update_counters(in_flight=-1)
+            self.slots.release()
+
+        total_ms = (time.perf_counter() - start_time) * 1000
+        response['timing'] = {'queue_ms': max(started - submitted, 0.0) * 1000, **timings, 'total_ms': total_ms}
+        if png_data is not None:
+            response['image'] = base64.b64encode(png_data).decode('ascii')
+
+        with self.lock:
+            self.counters['completed'] += 1
+            self.latencies.append(total_ms)
+
+        return response
+
+    def get_health(self):
+        with self.lock:
+            in_flight = self.counters['in_flight']
+
+        return {'status': 'ok', 'workers': self.workers, 'in_flight': in_flight, 'capacity': self.capacity}
+
+    def get_metrics(self):
+        with self.lock:
+            metrics = dict(self.counters)
+            latencies = np.array(self.latencies)
+
+        metrics['uptime_s'] = time.time() - self.start_time
+        if len(latencies):
+            metrics['latency_ms'] = {
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'max': float(latencies.max()),
+            }
+
+        return metrics
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP-интерфейс сервиса: POST /detect, GET /health и GET /metrics"""
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.server.service.get_health())
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.service.get_metrics())
+        else:
+            self.send_json(404, {'error': f"Неизвестный путь: {self.path}"})
+
+    def do_POST(self):
+        if self.path != '/detect':
+            self.send_json(404, {'error': f"Неизвестный путь: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0:
+                raise ValueError(f"отрицательная длина {length}")
+        except ValueError as e:
+            self.send_json(400, {'error': f"Некорректный заголовок Content-Length: {e}"})
+            return
+
+        if length > SERVICE_MAX_REQUEST_SIZE:
+            self.send_json(413, {'error': 'Слишком большой запрос'})
+            return
+
+        try:
+            request = json.loads(self.rfile.read(length))
+            image_data = base64.b64decode(request['image'], validate=True)
+            parameters = request.get('parameters') or {}
+            if not isinstance(parameters, dict):
+                raise ValueError('Параметры должны быть JSON-объектом')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': f"Некорректный запрос: {e}"})
+            return
+
+        try:
+            response = self.server.service.detect(image_data, parameters, bool(request.get('annotate')),
+                                                  bool(request.get('full_resolution')))
+        except ServiceBusy as e:
+            self.send_json(503, {'error': str(e)}, {'Retry-After': '1'})
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': str(e.args[0]) if e.args else str(e)})
+        except Exception as e:
+            self.send_json(500, {'error': f"Ошибка обработки: {e}"})
+        else:
+            self.send_json(200, response)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def create_server(service, host=SERVICE_HOST, port=SERVICE_PORT, verbose=False):
+    server = ThreadingHTTPServer((host, port), ServiceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+
+    return server
+
+
+class ServiceClient:
+    """Клиент сервиса поиска эллипсов"""
+
+    def __init__(self, url=f"http://{SERVICE_HOST}:{SERVICE_PORT}", timeout=300):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        request = urllib.request.Request(self.url + path, data=body, method=method,
+                                         headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get('error', e.reason)
+            except ValueError:
+                message = e.reason
+            raise ServiceError(e.code, message)
+
+    def detect(self, image_data, parameters=None, annotate=False, full_resolution=False):
+        """Отправляет изображение (байты файла) на обработку. Изображение с эллипсами, если оно запрошено,
+        возвращается в поле image в виде байтов PNG"""
+        response = self.request('POST', '/detect', {
+            'image': base64.b64encode(image_data).decode('ascii'),
+            'parameters': parameters or {},
+            'annotate': annotate,
+            'full_resolution': full_resolution,
+        })
+        if 'image' in response:
+            response['image'] = base64.b64decode(response['image'])
+
+        return response
+
+    def health(self):
+        return self.request('GET', '/health')
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+
+def serve(args):
+    service = DetectionService(args.workers, args.queue_size)
+    pids = service.warm_up()
+    server = create_server(service, args.host, args.port, args.verbose)
+    print(f"Сервис запущен на http://{args.host}:{server.server_port}, процессов: {len(pids)}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+    return 0
+
+
+def run_client(args):
+    client = ServiceClient(args.url)
+    try:
+        if args.command == 'health':
+            response = client.health()
+        elif args.command == 'metrics':
+            response = client.metrics()
+        else:
+            with open(args.image, 'rb') as f:
+                image_data = f.read()
+            parameters = load_parameters(args.params) if args.params else None
+            response = client.detect(image_data, parameters, bool(args.annotate), args.full_resolution)
+            if args.annotate and response.get('image') is not None:
+                with open(args.annotate, 'wb') as f:
+                    f.write(response.pop('image'))
+    except (ServiceError, urllib.error.URLError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    text = json.dumps(response, ensure_ascii=False, indent=2)
+    if getattr(args, 'output', None):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Локальный сервис поиска эллипсов')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='запустить сервис')
+    serve_parser.add_argument('--host', default=SERVICE_HOST, help='адрес сервиса')
+    serve_parser.add_argument('--port', type=int, default=SERVICE_PORT, help='порт сервиса')
+    serve_parser.add_argument('-w', '--workers', type=int, default=SERVICE_WORKERS,
+                              help='количество процессов (0 - по числу ядер)')
+    serve_parser.add_argument('-q', '--queue-size', type=int, default=SERVICE_QUEUE_SIZE,
+                              help='количество ожидающих заданий, сверх которого запросы отклоняются')
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help='выводить журнал запросов')
+
+    url = f"http://{SERVICE_HOST}:{SERVICE_PORT}"
+    detect_parser = subparsers.add_parser('detect', help='отправить изображение на обработку')
+    detect_parser.add_argument('image', help='файл изображения')
+    detect_parser.add_argument('--url', default=url, help='адрес сервиса')
+    detect_parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров')
+    detect_parser.add_argument('-o', '--output', help='JSON-файл для ответа')
+    detect_parser.add_argument('-a', '--annotate', help='PNG-файл для изображения с найденными эллипсами')
+    detect_parser.add_argument('-r', '--full-resolution', action='store_true',
+                               help='обрабатывать изображение без уменьшения')
+
+    for command, help_text in [('health', 'проверить состояние сервиса'), ('metrics', 'получить статистику')]:
+        command_parser = subparsers.add_parser(command, help=help_text)
+        command_parser.add_argument('--url', default=url, help='адрес сервиса')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == 'serve':
+        return serve(args)
+
+    return run_client(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
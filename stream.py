@@ -0,0 +1,245 @@
+import argparse
+import glob
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import cv2
+from batch import get_ellipse_records
+from defaults import FIT_MAX_POINTS, FIT_WORKERS, STREAM_PREFETCH_SIZE, STREAM_REPORT_INTERVAL
+from ellipse_detector import EllipseDetector
+from parameter_store import ParameterStore, load_parameters
+from utils import is_valid_image_extension, load_image, resize_image
+
+DEFAULT_VIDEO_FPS = 25.0
+
+
+def get_natural_sort_key(path):
+    """Ключ сортировки, при котором frame2.png идет раньше frame10.png"""
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(path))]
+
+
+def get_sequence_paths(source):
+    """Возвращает кадры последовательности изображений из каталога или по шаблону пути в порядке номеров.
+    Для остальных источников (видеофайлы, камеры, шаблоны вида frame_%04d.png) возвращает None"""
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    elif glob.has_magic(source):
+        paths = glob.glob(source)
+    else:
+        return None
+
+    paths = [path for path in paths if os.path.isfile(path) and is_valid_image_extension(path)]
+
+    return sorted(paths, key=get_natural_sort_key)
+
+
+def open_video_capture(source):
+    """Открывает видеофайл, шаблон последовательности вида frame_%04d.png или камеру по номеру"""
+    return cv2.VideoCapture(int(source) if source.isdigit() else source)
+
+
+def get_source_fps(source):
+    """Возвращает частоту кадров источника или DEFAULT_VIDEO_FPS, если она неизвестна"""
+    if get_sequence_paths(source) is not None:
+        return DEFAULT_VIDEO_FPS
+
+    capture = open_video_capture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+
+    return fps if fps > 0 else DEFAULT_VIDEO_FPS
+
+
+def read_frames(source):
+    """Генератор кадров источника, уменьшенных так же, как при загрузке одиночного изображения"""
+    paths = get_sequence_paths(source)
+    if paths is not None:
+        for path in paths:
+            frame = load_image(path)
+            if frame is not None:
+                yield frame
+        return
+
+    capture = open_video_capture(source)
+    if not capture.isOpened():
+        raise IOError(f"Не удалось открыть источник: {source}")
+
+    try:
+        while True:
+            success, frame = capture.read()
+            if not success:
+                break
+            yield resize_image(frame)
+    finally:
+        capture.release()
+
+
+def prefetch_frames(frames, queue_size=STREAM_PREFETCH_SIZE):
+    """Декодирует кадры в отдельном потоке, опережая обработку не больше чем на queue_size кадров. Ошибки
+    декодирования передаются потребителю, а при его остановке поток декодирования завершается"""
+    frame_queue = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    end_marker = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def decode():
+        try:
+            for frame in frames:
+                if not put(frame):
+                    return
+        except Exception as e:
+            put(e)
+        put(end_marker)
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = frame_queue.get()
+            if item is end_marker:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def detect_frames(frames, parameters, seed=True, fit_max_points=FIT_MAX_POINTS, fit_workers=FIT_WORKERS):
+    """Генератор результатов поиска эллипсов по кадрам в исходном порядке. Эллипсы каждого кадра передаются
+    следующему как начальное приближение"""
+    detector = EllipseDetector(None, ParameterStore(parameters), fit_max_points=fit_max_points,
+                               fit_workers=fit_workers)
+
+    try:
+        for index, frame in enumerate(frames):
+            detector.set_image(frame)
+            results = detector.find_ellipses()
+            if seed:
+                detector.set_seed_ellipses(results['ellipses'])
+
+            yield index, frame, detector, results
+    finally:
+        detector.close()
+
+
+def run_stream(source, parameters, output_path=None, video_path=None, prefetch=STREAM_PREFETCH_SIZE, seed=True,
+               report=None, fit_max_points=FIT_MAX_POINTS, fit_workers=FIT_WORKERS):
+    """Обрабатывает видео или последовательность изображений. Таблицы эллипсов записываются построчно в JSON
+    Lines, изображения с эллипсами - в видеофайл. Функция report вызывается не чаще чем раз в
+    STREAM_REPORT_INTERVAL секунд со сводкой по уже обработанным кадрам. Возвращает итоговую сводку"""
+    frames = read_frames(source)
+    if prefetch > 0:
+        frames = prefetch_frames(frames, prefetch)
+
+    output_file = open(output_path, 'w', encoding='utf-8') if output_path else None
+    video_writer = None
+    summary = {'frames': 0, 'ellipses': 0, 'seconds': 0.0, 'fps': 0.0, 'seeded': 0, 'fitted': 0}
+    start_time = time.perf_counter()
+    last_report_time = start_time
+
+    try:
+        for index, frame, detector, results in detect_frames(frames, parameters, seed, fit_max_points, fit_workers):
+            records = get_ellipse_records(results['ellipses'])
+            if output_file is not None:
+                output_file.write(json.dumps({'frame': index, 'ellipses': records}, ensure_ascii=False) + '\n')
+
+            if video_path:
+                result_image = detector.draw_results(frame, results['ellipses'], results['contours'])
+                if video_writer is None:
+                    height, width = result_image.shape[:2]
+                    video_writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'),
+                                                   get_source_fps(source), (width, height))
+                video_writer.write(result_image)
+
+            now = time.perf_counter()
+            summary['frames'] = index + 1
+            summary['ellipses'] += len(records)
+            summary['seconds'] = now - start_time
+            summary['fps'] = summary['frames'] / summary['seconds'] if summary['seconds'] > 0 else 0.0
+            summary.update(detector.seed_statistics)
+
+            if report is not None and now - last_report_time >= STREAM_REPORT_INTERVAL:
+                report(summary)
+                last_report_time = now
+    finally:
+        if output_file is not None:
+            output_file.close()
+        if video_writer is not None:
+            video_writer.release()
+
+    return summary
+
+
+def print_progress(summary):
+    print(f"Кадров: {summary['frames']}, {summary['fps']:.1f} кадр/с", file=sys.stderr)
+
+
+def print_summary(summary):
+    """Выводит итоговую скорость обработки и долю контуров, проверенных по эллипсам предыдущих кадров"""
+    checked = summary['seeded'] + summary['fitted']
+    seeded_share = summary['seeded'] / checked * 100 if checked else 0.0
+
+    print(f"Кадров: {summary['frames']}, эллипсов: {summary['ellipses']}")
+    print(f"Время: {summary['seconds']:.2f} с, {summary['fps']:.2f} кадр/с")
+    print(f"Контуров без повторной аппроксимации: {summary['seeded']} из {checked} ({seeded_share:.1f}%)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Поиск эллипсов на кадрах видео или последовательности '
+                                                 'изображений')
+    parser.add_argument('source', help='видеофайл, номер камеры, каталог с кадрами, шаблон пути '
+                                       '(например, "frames/*.png") или шаблон вида "frames/%%04d.png"')
+    parser.add_argument('-o', '--output', help='файл JSON Lines для таблиц эллипсов по кадрам')
+    parser.add_argument('-v', '--video', help='видеофайл для кадров с найденными эллипсами')
+    parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров')
+    parser.add_argument('--prefetch', type=int, default=STREAM_PREFETCH_SIZE,
+                        help='количество кадров, декодируемых заранее (0 - без отдельного потока)')
+    parser.add_argument('--no-seed', action='store_true',
+                        help='не использовать эллипсы предыдущего кадра')
+    parser.add_argument('--fit-points', type=int, default=FIT_MAX_POINTS,
+                        help='прореживать контуры до этого числа точек перед аппроксимацией (0 - без прореживания)')
+    parser.add_argument('--fit-workers', type=int, default=FIT_WORKERS,
+                        help='количество процессов для аппроксимации контуров кадра (0 - по числу ядер)')
+
+    args = parser.parse_args(argv)
+    if 0 < args.fit_points < 5:
+        parser.error('для аппроксимации эллипсом нужно не меньше 5 точек')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    parameters = ParameterStore(load_parameters(args.params) if args.params else None).get_all()
+
+    try:
+        summary = run_stream(args.source, parameters, args.output, args.video, args.prefetch, not args.no_seed,
+                             print_progress, args.fit_points, args.fit_workers)
+    except IOError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    print_summary(summary)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
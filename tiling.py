@@ -0,0 +1,212 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from defaults import (TILE_SIZE, TILE_OVERLAP, TILE_WORKERS, SEAM_WINDOW_MAX_SIZE,
+                      EXTERNAL_GRID_CELL_SIZE)
+from image_preprocessing import apply_preprocessing_stages, get_preprocessing_margin
+from utils import find_contours
+
+
+def get_tile_rects(image_shape, tile_size):
+    """Разбивает изображение на прямоугольники (x0, y0, x1, y1) со стороной не больше tile_size"""
+    height, width = image_shape[:2]
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in range(0, height, tile_size)
+            for x in range(0, width, tile_size)]
+
+
+def expand_rect(rect, amount, image_shape):
+    """Расширяет прямоугольник на amount пикселей в каждую сторону в пределах изображения"""
+    height, width = image_shape[:2]
+    x0, y0, x1, y1 = rect
+
+    return max(x0 - amount, 0), max(y0 - amount, 0), min(x1 + amount, width), min(y1 + amount, height)
+
+
+def get_contour_rect(contour):
+    """Возвращает ограничивающий прямоугольник контура в виде (x0, y0, x1, y1)"""
+    x, y, w, h = cv2.boundingRect(contour)
+
+    return x, y, x + w, y + h
+
+
+def is_rects_intersect(first, second):
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
+
+
+def is_contour_cut(contour_rect, valid_rect, image_shape):
+    """Проверяет, касается ли контур границы области, в которой результат предобработки точен. Границы
+    изображения не считаются: там контур обрезан и при обработке всего изображения"""
+    height, width = image_shape[:2]
+    x0, y0, x1, y1 = contour_rect
+    valid_x0, valid_y0, valid_x1, valid_y1 = valid_rect
+
+    return ((valid_x0 > 0 and x0 <= valid_x0) or (valid_y0 > 0 and y0 <= valid_y0) or
+            (valid_x1 < width and x1 >= valid_x1) or (valid_y1 < height and y1 >= valid_y1))
+
+
+def find_window_contours(image, valid_rect, params, margin, contour_method):
+    """Ищет контуры в области valid_rect, выполняя предобработку фрагмента, расширенного на margin пикселей.
+    Возвращает контуры в координатах изображения, разделенные на целые и обрезанные границей области"""
+    x0, y0, x1, y1 = expand_rect(valid_rect, margin, image.shape)
+    _, edges = apply_preprocessing_stages(image[y0:y1, x0:x1], params)
+
+    complete, cut = [], []
+    for contour in find_contours(edges, contour_method):
+        contour += (x0, y0)
+        if is_contour_cut(get_contour_rect(contour), valid_rect, image.shape):
+            cut.append(contour)
+        else:
+            complete.append(contour)
+
+    return complete, cut
+
+
+def merge_seam_rects(rects, max_size):
+    """Объединяет прямоугольники обрезанных контуров, расстояние между которыми меньше TILE_OVERLAP, чтобы
+    соседние контуры на стыке искались в одном окне. Объединение не делается больше max_size по каждой стороне"""
+    merged = []
+    active = []
+    for rect in sorted(rects):
+        active = [k for k in active if merged[k][2] + TILE_OVERLAP >= rect[0]]
+        for k in active:
+            x0, y0, x1, y1 = merged[k]
+            union = (min(x0, rect[0]), min(y0, rect[1]), max(x1, rect[2]), max(y1, rect[3]))
+            if (rect[0] < x1 + TILE_OVERLAP and rect[1] < y1 + TILE_OVERLAP and x0 < rect[2] + TILE_OVERLAP and
+                    y0 < rect[3] + TILE_OVERLAP and union[2] - union[0] <= max_size and
+                    union[3] - union[1] <= max_size):
+                merged[k] = union
+                break
+        else:
+            active.append(len(merged))
+            merged.append(rect)
+
+    return merged
+
+
+def find_seam_contours(image, seam_rect, params, margin, contour_method):
+    """Заново ищет контур, обрезанный на стыке фрагментов, в окне вокруг него. Пока продолжение контура
+    обрезано границей окна, окно расширяется (но не больше SEAM_WINDOW_MAX_SIZE по каждой стороне, после чего
+    контур остается обрезанным)"""
+    valid_rect = expand_rect(seam_rect, TILE_OVERLAP, image.shape)
+    while True:
+        complete, cut = find_window_contours(image, valid_rect, params, margin, contour_method)
+
+        seam_cut = [contour for contour in cut if is_rects_intersect(get_contour_rect(contour), seam_rect)]
+        if not seam_cut:
+            return complete
+
+        rects = [get_contour_rect(contour) for contour in seam_cut]
+        grown_rect = expand_rect((min(rect[0] for rect in rects), min(rect[1] for rect in rects),
+                                  max(rect[2] for rect in rects), max(rect[3] for rect in rects)),
+                                 TILE_OVERLAP, image.shape)
+        grown_rect = (min(grown_rect[0], valid_rect[0]), min(grown_rect[1], valid_rect[1]),
+                      max(grown_rect[2], valid_rect[2]), max(grown_rect[3], valid_rect[3]))
+
+        if (grown_rect == valid_rect or grown_rect[2] - grown_rect[0] > SEAM_WINDOW_MAX_SIZE or
+                grown_rect[3] - grown_rect[1] > SEAM_WINDOW_MAX_SIZE):
+            return complete + seam_cut
+
+        valid_rect = grown_rect
+
+
+def select_external_contours(contours, cell_size=EXTERNAL_GRID_CELL_SIZE):
+    """Оставляет из полного списка контуров только внешние, как при поиске контуров с RETR_EXTERNAL. Внутренние
+    границы (с положительной ориентированной площадью) отбрасываются, а внешняя граница удаляется, если ее первая
+    точка лежит внутри другой внешней границы. Кандидаты на объемлющий контур выбираются по сетке из ячеек со
+    стороной cell_size и отсеиваются по ограничивающим прямоугольникам сразу для всех пар"""
+    outer_contours = [contour for contour in contours if cv2.contourArea(contour, oriented=True) <= 0]
+    if not outer_contours:
+        return []
+
+    rects = np.array([get_contour_rect(contour) for contour in outer_contours])
+    first_points = np.array([contour[0, 0] for contour in outer_contours])
+
+    grid = {}
+    for j, (x0, y0, x1, y1) in enumerate(rects.tolist()):
+        for cell_y in range(y0 // cell_size, (y1 - 1) // cell_size + 1):
+            for cell_x in range(x0 // cell_size, (x1 - 1) // cell_size + 1):
+                grid.setdefault((cell_x, cell_y), []).append(j)
+
+    cells = {}
+    for i, (x, y) in enumerate((first_points // cell_size).tolist()):
+        cells.setdefault((x, y), []).append(i)
+
+    pairs = [(np.repeat(children, len(grid[cell])), np.tile(grid[cell], len(children)))
+             for cell, children in cells.items()]
+    inner = np.concatenate([pair[0] for pair in pairs])
+    outer = np.concatenate([pair[1] for pair in pairs])
+    mask = ((inner != outer) & (rects[outer, 0] <= rects[inner, 0]) & (rects[outer, 1] <= rects[inner, 1]) &
+            (rects[outer, 2] >= rects[inner, 2]) & (rects[outer, 3] >= rects[inner, 3]))
+
+    is_nested = np.zeros(len(outer_contours), dtype=bool)
+    for i, j in zip(inner[mask].tolist(), outer[mask].tolist()):
+        if not is_nested[i]:
+            point = tuple(float(value) for value in first_points[i])
+            is_nested[i] = cv2.pointPolygonTest(outer_contours[j], point, False) > 0
+
+    return [contour for contour, nested in zip(outer_contours, is_nested) if not nested]
+
+
+def map_bounded(executor, function, items, max_in_flight):
+    """Аналог executor.map, который держит в работе не больше max_in_flight задач и возвращает результаты в
+    исходном порядке"""
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def find_contours_tiled(image, params, contour_method, tile_size=TILE_SIZE, workers=TILE_WORKERS):
+    """Ищет контуры на изображении без уменьшения, обрабатывая его перекрывающимися фрагментами в пуле потоков.
+    Одновременно обрабатывается не больше 2 * workers фрагментов, поэтому потребление памяти на промежуточные
+    изображения зависит от размера фрагмента, а не всего изображения.
+
+    Каждый фрагмент предобрабатывается с запасом по краям, равным сумме радиусов фильтров, поэтому в пределах
+    фрагмента, расширенного на TILE_OVERLAP, результат совпадает с предобработкой всего изображения. Целый контур
+    берется из того фрагмента, в котором находится его первая точка. Контуры, обрезанные на стыках, ищутся
+    заново в окнах вокруг них, а совпадающие контуры из разных окон удаляются.
+
+    Вложенность контуров не определяется внутри одного фрагмента (объемлющий контур может быть обрезан), поэтому
+    во фрагментах всегда ищутся все контуры, а внешние выбираются из них в конце"""
+    workers = workers or os.cpu_count() or 1
+    margin = get_preprocessing_margin(params)
+    tile_rects = get_tile_rects(image.shape, tile_size)
+
+    contours = {}
+    seam_rects = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tile_results = map_bounded(
+            executor,
+            lambda tile_rect: find_window_contours(image, expand_rect(tile_rect, TILE_OVERLAP, image.shape),
+                                                   params, margin, 'list'),
+            tile_rects, 2 * workers)
+
+        for tile_rect, (complete, cut) in zip(tile_rects, tile_results):
+            for contour in complete:
+                x, y = contour[0, 0]
+                if tile_rect[0] <= x < tile_rect[2] and tile_rect[1] <= y < tile_rect[3]:
+                    contours.setdefault(contour.tobytes(), contour)
+
+            seam_rects.extend(get_contour_rect(contour) for contour in cut)
+
+        seam_results = map_bounded(
+            executor,
+            lambda seam_rect: find_seam_contours(image, seam_rect, params, margin, 'list'),
+            merge_seam_rects(seam_rects, tile_size), 2 * workers)
+
+        for seam_contours in seam_results:
+            for contour in seam_contours:
+                contours.setdefault(contour.tobytes(), contour)
+
+    if contour_method == 'external':
+        return select_external_contours(list(contours.values()))
+
+    return list(contours.values())
@@ -0,0 +1,469 @@
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from batch import collect_image_paths, get_output_name
+from benchmarks.scenes import SCENES, generate_scene
+from defaults import (CONFIGURABLE_PARAMS, TUNING_TRIALS, TUNING_STARTUP_TRIALS, TUNING_GAMMA, TUNING_CANDIDATES,
+                      TUNING_MIN_BANDWIDTH, TUNING_TOP, TUNING_TIMING_REPEAT, TUNING_SEARCH_SPACE)
+from ellipse_detector import EllipseDetector
+from evaluation import evaluate_detection
+from parameter_store import ParameterStore, load_parameters
+from utils import load_image
+
+SEARCH_METHODS = ['random', 'bayes']
+
+# Изображения с известными эллипсами и детекторы процесса пула. Детекторы создаются один раз при запуске
+# процесса, поэтому кэши этапов предобработки и аппроксимаций контуров переживают отдельные пробы
+worker_state = {'sources': [], 'detectors': []}
+
+
+def get_search_space(specs):
+    """Пространство поиска по описаниям областей значений параметров (см. get_parameter_space)"""
+    return {name: get_parameter_space(name, spec) for name, spec in specs.items()}
+
+
+def get_parameter_space(name, spec):
+    """Описание области значений параметра: ('choice', значения) или ('range', минимум, максимум, шаг, целый ли
+    параметр). spec - список значений или словарь с ключами min, max и step, не заданные ключи берутся из
+    описания параметра"""
+    config = CONFIGURABLE_PARAMS.get(name)
+    if config is None:
+        raise KeyError(f"Неизвестный параметр: {name}")
+
+    if isinstance(spec, list):
+        return 'choice', spec
+    if config['type'] == 'boolean':
+        return 'choice', [False, True]
+    if 'options' in config:
+        return 'choice', list(config['options'])
+
+    is_int = config['type'] == 'int'
+    step = spec.get('step', config.get('step', 0.0))
+
+    return 'range', spec.get('min', config['min']), spec.get('max', config['max']), step, is_int
+
+
+def load_search_space(path):
+    """Загружает пространство поиска из JSON-файла вида {"threshold": {"min": 20, "max": 120},
+    "error_method": ["algebraic", "geometric"]}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        specs = json.load(f)
+
+    if not isinstance(specs, dict):
+        raise ValueError('Файл пространства поиска должен содержать JSON-объект')
+
+    return get_search_space(specs)
+
+
+def quantize(value, space):
+    """Приводит значение из диапазона к ближайшему допустимому с учетом шага"""
+    _, low, high, step, is_int = space
+    if step > 0:
+        value = low + round((value - low) / step) * step
+    value = min(max(value, low), high)
+
+    # Округление убирает погрешность умножения на дробный шаг
+    return int(round(value)) if is_int else round(float(value), 6)
+
+
+def sample_random(rng, search_space):
+    values = {}
+    for name, space in search_space.items():
+        if space[0] == 'choice':
+            values[name] = space[1][rng.integers(len(space[1]))]
+        else:
+            values[name] = quantize(rng.uniform(space[1], space[2]), space)
+
+    return values
+
+
+def get_unit_position(value, space):
+    """Положение значения в диапазоне параметра, от 0 до 1"""
+    low, high = space[1], space[2]
+
+    return (value - low) / (high - low) if high > low else 0.5
+
+
+class ParzenEstimator:
+    """Оценка распределения значений одного параметра по значениям в пробах: для выбора - частоты значений с
+    единичной априорной добавкой, для диапазона - смесь нормальных ядер вокруг значений и равномерного
+    распределения"""
+
+    def __init__(self, space, values):
+        self.space = space
+        if space[0] == 'choice':
+            counts = np.array([sum(value == option for value in values) for option in space[1]], dtype=np.float64)
+            self.probabilities = (counts + 1) / (counts.sum() + len(counts))
+        else:
+            self.points = np.array([get_unit_position(value, space) for value in values])
+            spread = self.points.std() if len(self.points) > 1 else 1.0
+            self.bandwidth = max(spread * len(self.points) ** -0.2, TUNING_MIN_BANDWIDTH)
+
+    def sample(self, rng):
+        if self.space[0] == 'choice':
+            return self.space[1][rng.choice(len(self.probabilities), p=self.probabilities)]
+
+        # Априорное равномерное распределение выбирается с тем же весом, что и каждое ядро
+        k = rng.integers(len(self.points) + 1)
+        position = rng.uniform() if k == len(self.points) else rng.normal(self.points[k], self.bandwidth)
+        low, high = self.space[1], self.space[2]
+
+        return quantize(low + min(max(position, 0.0), 1.0) * (high - low), self.space)
+
+    def log_density(self, value):
+        if self.space[0] == 'choice':
+            return math.log(self.probabilities[self.space[1].index(value)])
+
+        x = get_unit_position(value, self.space)
+        kernels = np.exp(-0.5 * ((x - self.points) / self.bandwidth) ** 2) / (self.bandwidth * math.sqrt(2 * math.pi))
+
+        return math.log((kernels.sum() + 1.0) / (len(self.points) + 1))
+
+
+def suggest_bayes(rng, search_space, trials):
+    """Предлагает следующую пробу по методу TPE: строит распределения значений параметров в лучшей доле
+    TUNING_GAMMA проб и в остальных и выбирает из TUNING_CANDIDATES кандидатов, сгенерированных по лучшим,
+    кандидата с наибольшим отношением плотностей"""
+    ordered = sorted(trials, key=lambda trial: trial['f1'], reverse=True)
+    good_count = max(1, int(math.ceil(TUNING_GAMMA * len(ordered))))
+    good, bad = ordered[:good_count], ordered[good_count:]
+
+    estimators = {name: (ParzenEstimator(space, [trial['values'][name] for trial in good]),
+                         ParzenEstimator(space, [trial['values'][name] for trial in bad]))
+                  for name, space in search_space.items()}
+
+    best_values, best_score = None, -math.inf
+    for _ in range(TUNING_CANDIDATES):
+        values = {name: good_estimator.sample(rng) for name, (good_estimator, _) in estimators.items()}
+        score = sum(good_estimator.log_density(values[name]) - bad_estimator.log_density(values[name])
+                    for name, (good_estimator, bad_estimator) in estimators.items())
+        if score > best_score:
+            best_values, best_score = values, score
+
+    return best_values
+
+
+def get_preprocessing_key(values):
+    """Ключ параметров предобработки пробы: пробы с одинаковым ключом используют одни и те же этапы
+    предобработки и контуры"""
+    return tuple(sorted((name, value) for name, value in values.items()
+                        if CONFIGURABLE_PARAMS[name]['category'] == 'preprocessing'))
+
+
+def load_annotations(path):
+    """Загружает известные эллипсы из JSON-файла в формате таблиц batch.py (список записей с полями center_x,
+    center_y, axis_a, axis_b, angle) или ответа service.py (объект с полем ellipses)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        records = json.load(f)
+
+    if isinstance(records, dict):
+        records = records['ellipses']
+
+    return [{'center': (record['center_x'], record['center_y']), 'axes': (record['axis_a'], record['axis_b']),
+             'angle': record.get('angle', 0.0)} for record in records]
+
+
+def get_file_sources(source, annotations_dir):
+    """Изображения с файлами разметки <имя>.json из annotations_dir (по умолчанию - из каталога изображений).
+    Изображения без разметки пропускаются"""
+    sources = []
+    for path in collect_image_paths(source):
+        annotation_path = os.path.join(annotations_dir or os.path.dirname(path), f"{get_output_name(path)}.json")
+        if os.path.isfile(annotation_path):
+            sources.append(('file', path, annotation_path))
+
+    return sources
+
+
+def load_source(source, full_resolution):
+    """Возвращает название, изображение и известные эллипсы для описания источника: ('file', изображение,
+    разметка) или ('scene', название стандартной сцены, начальное значение)"""
+    if source[0] == 'scene':
+        _, name, seed = source
+        image, truth = generate_scene(seed, **SCENES[name])
+        return f"{name}:{seed}", image, truth
+
+    _, path, annotation_path = source
+    image = load_image(path, full_resolution)
+    if image is None:
+        raise ValueError(f"Не удалось загрузить изображение: {path}")
+
+    return path, image, load_annotations(annotation_path)
+
+
+def init_worker(sources, full_resolution):
+    worker_state['sources'] = [load_source(source, full_resolution) for source in sources]
+    worker_state['detectors'] = []
+    for _, image, _ in worker_state['sources']:
+        detector = EllipseDetector(None, ParameterStore(), full_resolution)
+        detector.set_image(image)
+        worker_state['detectors'].append(detector)
+
+
+def evaluate_values(values):
+    """Выполняет поиск на всех изображениях процесса с заданными значениями параметров и возвращает суммарные
+    полноту, точность и F1-меру. Детекторы сохраняют кэши между пробами, поэтому при совпадении параметров
+    предобработки с предыдущей пробой заново выполняется только фильтрация"""
+    start_time = time.perf_counter()
+    true_positives, detected, truth_count = 0, 0, 0
+    for detector, (_, _, truth) in zip(worker_state['detectors'], worker_state['sources']):
+        preprocessing = detector.param_manager.get_snapshot('preprocessing')
+        detector.param_manager.update(values)
+        if detector.param_manager.get_snapshot('preprocessing') != preprocessing:
+            detector.update_cache('preprocessing')
+
+        quality = evaluate_detection(detector.find_ellipses()['ellipses'], truth)
+        true_positives += quality['true_positives']
+        detected += quality['detected']
+        truth_count += quality['truth']
+
+    recall = true_positives / truth_count if truth_count else 1.0
+    precision = true_positives / detected if detected else 1.0
+    f1 = 2 * recall * precision / (recall + precision) if recall + precision > 0 else 0.0
+
+    return {'recall': recall, 'precision': precision, 'f1': f1, 'detected': detected,
+            'trial_ms': (time.perf_counter() - start_time) * 1000}
+
+
+def evaluate_trials(trials):
+    return [evaluate_values(values) for values in trials]
+
+
+def get_trial_chunks(trials, workers):
+    """Делит пробы между процессами так, чтобы пробы с одинаковыми параметрами предобработки попадали в один
+    процесс подряд. Возвращает порции номеров проб"""
+    order = sorted(range(len(trials)), key=lambda i: repr(get_preprocessing_key(trials[i])))
+    chunk_size = max(1, math.ceil(len(order) / workers))
+
+    return [order[i:i + chunk_size] for i in range(0, len(order), chunk_size)]
+
+
+def measure_runtime(values, sources, repeat):
+    """Медианное время поиска (в миллисекундах) на всех изображениях без кэшей"""
+    times = []
+    for _ in range(repeat):
+        total = 0.0
+        for _, image, _ in sources:
+            detector = EllipseDetector(None, ParameterStore(values))
+            detector.set_image(image)
+            start_time = time.perf_counter()
+            detector.find_ellipses()
+            total += time.perf_counter() - start_time
+            detector.close()
+        times.append(total * 1000)
+
+    return statistics.median(times)
+
+
+def mark_pareto_front(results):
+    """Отмечает наборы параметров, для которых нет другого набора не хуже по F1-мере и времени и лучше хотя бы
+    по одному из них"""
+    for result in results:
+        result['pareto'] = not any(
+            other['f1'] >= result['f1'] and other['runtime_ms'] <= result['runtime_ms'] and
+            (other['f1'] > result['f1'] or other['runtime_ms'] < result['runtime_ms'])
+            for other in results)
+
+
+class Tuner:
+    """Подбор параметров по изображениям с известными эллипсами. Пробы выполняются раундами в пуле процессов,
+    в каждом из которых изображения загружены и детекторы с кэшами созданы заранее. После поиска для лучших по
+    F1-мере наборов параметров замеряется время работы без кэшей"""
+
+    def __init__(self, sources, search_space, base_values=None, workers=1, method='bayes', seed=0,
+                 full_resolution=False):
+        self.sources = sources
+        self.search_space = search_space
+        self.base_values = ParameterStore(base_values).get_all()
+        self.workers = max(workers, 1)
+        self.method = method
+        self.rng = np.random.default_rng(seed)
+        self.full_resolution = full_resolution
+        self.trials = []
+        self.executor = None
+
+    def get_values(self, suggested):
+        values = dict(self.base_values)
+        values.update(suggested)
+        # Эллипсы нужны для оценки качества, даже если их отображение выключено в базовых параметрах
+        values['show_ellipses'] = True
+
+        return values
+
+    def suggest(self):
+        # Первая проба - базовые значения, чтобы результат подбора был не хуже текущих параметров
+        if not self.trials:
+            return {name: self.base_values[name] for name in self.search_space}
+        if self.method == 'bayes' and len(self.trials) >= TUNING_STARTUP_TRIALS:
+            return suggest_bayes(self.rng, self.search_space, self.trials)
+
+        return sample_random(self.rng, self.search_space)
+
+    def run_round(self, suggestions):
+        """Выполняет пробы одного раунда и добавляет их результаты к списку проб"""
+        trials = [self.get_values(suggested) for suggested in suggestions]
+        if self.executor is None:
+            results = evaluate_trials(trials)
+        else:
+            results = [None] * len(trials)
+            chunks = get_trial_chunks(trials, self.workers)
+            futures = [self.executor.submit(evaluate_trials, [trials[i] for i in chunk]) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                for i, result in zip(chunk, future.result()):
+                    results[i] = result
+
+        for suggested, result in zip(suggestions, results):
+            self.trials.append({'number': len(self.trials), 'values': suggested, **result})
+
+    def search(self, trial_count, progress=None):
+        """Выполняет trial_count проб. Случайный поиск выполняет все пробы одним раундом, байесовский - раундами
+        по числу процессов, каждый следующий с учетом результатов предыдущих"""
+        if self.workers > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                                initargs=(self.sources, self.full_resolution))
+        else:
+            init_worker(self.sources, self.full_resolution)
+
+        try:
+            round_size = trial_count if self.method == 'random' else self.workers
+            while len(self.trials) < trial_count:
+                size = min(round_size, trial_count - len(self.trials))
+                if self.method == 'bayes' and len(self.trials) < TUNING_STARTUP_TRIALS:
+                    size = min(max(size, TUNING_STARTUP_TRIALS - len(self.trials)), trial_count - len(self.trials))
+
+                suggestions = [self.suggest()]
+                suggestions += [self.suggest() if self.trials else sample_random(self.rng, self.search_space)
+                                for _ in range(size - 1)]
+                self.run_round(suggestions)
+                if progress is not None:
+                    progress(self)
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+        return self.trials
+
+    def get_best(self, top=TUNING_TOP, repeat=TUNING_TIMING_REPEAT):
+        """Замеряет время работы без кэшей для top лучших по F1-мере проб (с разными параметрами) и возвращает их,
+        упорядоченными по убыванию F1-меры и возрастанию времени, с отметкой парето-оптимальных"""
+        candidates = []
+        seen = set()
+        for trial in sorted(self.trials, key=lambda trial: (-trial['f1'], trial['trial_ms'])):
+            key = repr(sorted(trial['values'].items()))
+            if key not in seen:
+                seen.add(key)
+                candidates.append(trial)
+            if len(candidates) == top:
+                break
+
+        sources = [load_source(source, self.full_resolution) for source in self.sources]
+        best = []
+        for trial in candidates:
+            runtime_ms = measure_runtime(self.get_values(trial['values']), sources, repeat)
+            best.append({**trial, 'runtime_ms': runtime_ms})
+
+        best.sort(key=lambda result: (-result['f1'], result['runtime_ms']))
+        mark_pareto_front(best)
+
+        return best
+
+
+def format_values(values):
+    """Значения, отличающиеся от значений по умолчанию"""
+    changed = [f"{name}={value}" for name, value in sorted(values.items())
+               if CONFIGURABLE_PARAMS[name]['default'] != value]
+
+    return ', '.join(changed) or 'по умолчанию'
+
+
+def print_best(best):
+    print('Лучшие наборы параметров (* - лучшие по сочетанию F1-меры и времени):')
+    for rank, result in enumerate(best, 1):
+        mark = '*' if result['pareto'] else ' '
+        print(f"{mark}{rank:3d}. F1 {result['f1']:.3f} (полнота {result['recall']:.3f}, точность "
+              f"{result['precision']:.3f}), {result['runtime_ms']:.1f} мс, проба {result['number']}: "
+              f"{format_values(result['values'])}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Подбор параметров поиска эллипсов по изображениям с известными '
+                                                 'эллипсами')
+    parser.add_argument('source', nargs='?',
+                        help='каталог с изображениями или шаблон пути; разметка - в файлах <имя>.json')
+    parser.add_argument('--annotations', help='каталог с файлами разметки (по умолчанию - каталог изображений)')
+    parser.add_argument('--synthetic', nargs='+', choices=list(SCENES),
+                        help='подбирать по стандартным синтетическим сценам вместо изображений')
+    parser.add_argument('--seed', type=int, default=0, help='начальное значение генераторов сцен и поиска')
+    parser.add_argument('-s', '--space', help='JSON-файл с пространством поиска (по умолчанию - '
+                                              'TUNING_SEARCH_SPACE)')
+    parser.add_argument('-p', '--params', help='JSON-файл со значениями параметров, не входящих в пространство '
+                                               'поиска')
+    parser.add_argument('-m', '--method', choices=SEARCH_METHODS, default='bayes', help='метод поиска')
+    parser.add_argument('-n', '--trials', type=int, default=TUNING_TRIALS, help='количество проб')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='количество процессов')
+    parser.add_argument('-r', '--full-resolution', action='store_true',
+                        help='обрабатывать изображения без уменьшения (разметка - в координатах исходных '
+                             'изображений)')
+    parser.add_argument('--top', type=int, default=TUNING_TOP,
+                        help='для скольких лучших наборов параметров замерить время работы')
+    parser.add_argument('-o', '--output', help='JSON-файл для всех проб и лучших наборов параметров')
+    parser.add_argument('--best-params', help='JSON-файл для лучшего набора параметров (для -p batch.py)')
+
+    args = parser.parse_args(argv)
+    if not args.source and not args.synthetic:
+        parser.error('укажите изображения или --synthetic')
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.synthetic:
+        sources = [('scene', name, args.seed) for name in args.synthetic]
+    else:
+        try:
+            sources = get_file_sources(args.source, args.annotations)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+    if not sources:
+        print('Изображения с разметкой не найдены', file=sys.stderr)
+        return 1
+
+    search_space = load_search_space(args.space) if args.space else get_search_space(TUNING_SEARCH_SPACE)
+    base_values = load_parameters(args.params) if args.params else None
+    tuner = Tuner(sources, search_space, base_values, args.workers, args.method, args.seed, args.full_resolution)
+
+    def print_progress(tuner):
+        best = max(tuner.trials, key=lambda trial: trial['f1'])
+        print(f"Проб: {len(tuner.trials)}, лучшая F1-мера: {best['f1']:.3f}", file=sys.stderr)
+
+    start_time = time.perf_counter()
+    tuner.search(args.trials, print_progress)
+    best = tuner.get_best(args.top)
+    print(f"Время подбора: {time.perf_counter() - start_time:.1f} с")
+    print_best(best)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'sources': sources, 'method': args.method, 'trials': tuner.trials, 'best': best}, f,
+                      ensure_ascii=False, indent=2)
+
+    if args.best_params:
+        with open(args.best_params, 'w', encoding='utf-8') as f:
+            json.dump(tuner.get_values(best[0]['values']), f, ensure_ascii=False, indent=2)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,23 @@
+import mmap
 import os
+from collections import OrderedDict
 import cv2
 import numpy as np
-from defaults import RESIZE_WIDTH, MIN_KERNEL_SIZE
+from defaults import RESIZE_WIDTH, REDUCED_DECODE, MIN_KERNEL_SIZE
+
+
+# Маркеры начала кадра JPEG, содержащие размер изображения (кроме DHT, JPG и DAC), и маркер начала данных
+JPEG_FRAME_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_START_OF_SCAN = 0xDA
+EXIF_ORIENTATION_TAG = 0x0112
+# Ориентации EXIF, при которых ширина и высота меняются местами
+EXIF_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+# Режимы декодирования с уменьшением: коэффициент -> (цветной, в оттенках серого)
+REDUCED_DECODE_FLAGS = {
+    2: (cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    4: (cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    8: (cv2.IMREAD_REDUCED_COLOR_8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+}
 
 
 def find_contours(edges, method):
@@ -29,23 +45,100 @@ def resize_image(image):
     return image
 
 
-def load_image(path):
-    try:
-        with open(path, 'rb') as f:
-            file_bytes = f.read()
+def read_exif_orientation(tiff):
+    """Возвращает ориентацию из блока EXIF (данных в формате TIFF) или 1, если она не указана"""
+    byte_order = 'little' if tiff[:2] == b'II' else 'big'
+    offset = int.from_bytes(tiff[4:8], byte_order)
+    entry_count = int.from_bytes(tiff[offset:offset + 2], byte_order)
+
+    for entry in range(offset + 2, offset + 2 + 12 * entry_count, 12):
+        if int.from_bytes(tiff[entry:entry + 2], byte_order) == EXIF_ORIENTATION_TAG:
+            return int.from_bytes(tiff[entry + 8:entry + 10], byte_order)
+
+    return 1
+
+
+def get_jpeg_width(data):
+    """Возвращает ширину JPEG-изображения по его заголовку (с учетом поворота по EXIF, который выполняется при
+    декодировании) или None, если это не JPEG или заголовок не удалось разобрать"""
+    if data[:2] != b'\xff\xd8':
+        return None
+
+    orientation = 1
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+
+        marker = data[position + 1]
+        if marker == 0xFF:
+            position += 1
+            continue
+
+        length = int.from_bytes(data[position + 2:position + 4], 'big')
+        if marker == 0xE1 and data[position + 4:position + 10] == b'Exif\x00\x00':
+            orientation = read_exif_orientation(data[position + 10:position + 2 + length])
+        elif marker in JPEG_FRAME_MARKERS:
+            height = int.from_bytes(data[position + 5:position + 7], 'big')
+            width = int.from_bytes(data[position + 7:position + 9], 'big')
+            return height if orientation in EXIF_TRANSPOSED_ORIENTATIONS else width
+        elif marker == JPEG_START_OF_SCAN:
+            return None
+
+        position += 2 + length
+
+    return None
+
+
+def get_decode_flags(data, full_resolution, grayscale):
+    """Выбирает режим декодирования: для JPEG, который все равно будет уменьшен до RESIZE_WIDTH, - декодирование
+    сразу в 2, 4 или 8 раз меньшего размера (но не меньше RESIZE_WIDTH)"""
+    reduce_factor = 1
+    if REDUCED_DECODE and not full_resolution:
+        try:
+            width = get_jpeg_width(data)
+        except (IndexError, ValueError):
+            width = None
+
+        if width is not None:
+            reduce_factor = max((factor for factor in REDUCED_DECODE_FLAGS if -(-width // factor) >= RESIZE_WIDTH),
+                                default=1)
+
+    if reduce_factor == 1:
+        return cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
 
-        np_array = np.frombuffer(file_bytes, np.uint8)
-        image = cv2.imdecode(np_array, cv2.IMREAD_COLOR)
+    return REDUCED_DECODE_FLAGS[reduce_factor][grayscale]
+
+
+def load_image(path, full_resolution=False, grayscale=False):
+    """Загружает изображение, уменьшая его до RESIZE_WIDTH по ширине (если не задано full_resolution). Файл
+    отображается в память, а не читается целиком. При grayscale изображение сразу декодируется в оттенки серого"""
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+            buffer = np.frombuffer(mapped_file, np.uint8)
+            image = cv2.imdecode(buffer, get_decode_flags(mapped_file, full_resolution, grayscale))
+            # Отображение нельзя закрыть, пока на него ссылается массив
+            del buffer
 
         if image is None:
             return None
 
-        return resize_image(image)
+        return image if full_resolution else resize_image(image)
 
     except Exception:
         return None
 
 
+def decode_image(data, full_resolution=False, grayscale=False):
+    """Декодирует изображение из байтов файла так же, как load_image. Возвращает None, если данные не являются
+    изображением"""
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), get_decode_flags(data, full_resolution, grayscale))
+    if image is None:
+        return None
+
+    return image if full_resolution else resize_image(image)
+
+
 def is_valid_image_extension(path):
     extension = os.path.splitext(path)[1].lower()
     return extension in ['.jpg', '.jpeg', '.png', '.bmp']
@@ -74,3 +167,34 @@ def get_supported_formats():
         ('PNG', '*.png'),
         ('BMP', '*.bmp'),
     ]
+
+
+class LRUCache:
+    """Кэш ограниченного размера, вытесняющий элементы, которые дольше всего не использовались"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()